@@ -0,0 +1,98 @@
+"""
+Price Watcher address cache -- it keeps the addresses of our cards on disk, so we don't have to ask the broker for them on every run.
+
+The cache is a small JSON file. It is replaced atomically and written under a lock, so several runs (or processes) can share it.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+class AddressCache(object):
+    """
+    Represents the on-disk cache of card addresses
+    """
+
+    def __init__( self, path, ttl, owner='' ):
+        """
+        Create the AddressCache object
+
+        :param String path Where to keep the cache
+        :param Number ttl How long (in seconds) the cached addresses are good for
+        :param String owner Something that identifies the account the addresses belong to (e.g. its PAT); it is only stored hashed
+        """
+        self.version = 0
+
+        self.path  = path
+        self.ttl   = ttl
+        self.owner = hashlib.sha1( owner ).hexdigest()
+
+
+    def __lock__( self ):
+        """
+        Get an exclusive lock on the cache, shared by every process using it.
+
+        :rtype: The open lock file; closing it releases the lock
+        """
+
+        lock = open( self.path + '.lock', 'a' )
+        fcntl.flock( lock, fcntl.LOCK_EX )
+        return lock
+
+
+    def load( self ):
+        """
+        Get the cached addresses, if we have them and they are still fresh.
+
+        :rtype: A dictionary of { currency: address }, or None
+        """
+
+        try:
+            with open( self.path ) as cache_file:
+                cached = json.load( cache_file )
+        except ( IOError, ValueError ):
+            return None
+
+        if cached.get( 'owner' ) != self.owner:
+            return None
+        if time.time() - cached.get( 'fetched_at', 0 ) > self.ttl:
+            return None
+        return cached.get( 'addresses' )
+
+
+    def store( self, addresses ):
+        """
+        Save the addresses in the cache.
+
+        :param Dictionary addresses A dictionary of { currency: address }
+        """
+
+        directory = os.path.dirname( os.path.abspath( self.path ))
+        lock = self.__lock__()
+        try:
+            fd, temp_path = tempfile.mkstemp( dir=directory, prefix='.addresses' )
+            with os.fdopen( fd, 'w' ) as temp_file:
+                json.dump({
+                    'owner':      self.owner,
+                    'fetched_at': time.time(),
+                    'addresses':  addresses,
+                }, temp_file )
+            os.rename( temp_path, self.path )
+        finally:
+            lock.close()
+
+
+    def invalidate( self ):
+        """
+        Throw the cached addresses away.
+        """
+
+        lock = self.__lock__()
+        try:
+            if os.path.exists( self.path ):
+                os.remove( self.path )
+        finally:
+            lock.close()
@@ -0,0 +1,167 @@
+"""
+Price Watcher backtester -- it replays a history of rates through the money maker, to see how a strategy (e.g. a rebalance_threshold) would have done.
+
+The simulation is vectorised with NumPy (http://www.numpy.org/): between two rebalances our holdings don't change, so the value of the portfolio at every step can be worked out in bulk and the money maker only has to be consulted where a rebalance actually happens.
+"""
+
+import numpy
+
+def load_rates( path ):
+    """
+    Load a history of rates from a file.
+
+    Two formats are understood:
+
+    - CSV, with a header line naming the currencies (an optional first
+      'timestamp' column is skipped) and one line per step with the rate of
+      each currency in base_currency
+    - NumPy's .npz, with a 'currencies' array and a 'rates' array (one row
+      per step, one column per currency)
+
+    :param String path The path to the file
+
+    :rtype: A tuple with the list of currencies and the (steps x currencies) array of rates
+    """
+
+    if path.endswith( '.npz' ):
+        data = numpy.load( path )
+        return [ str(currency) for currency in data['currencies'] ], numpy.asarray( data['rates'], dtype=float )
+
+    with open( path ) as rates_file:
+        header = [ column.strip() for column in rates_file.readline().split( ',' ) ]
+    first = 1 if header[0].lower() == 'timestamp' else 0
+    rates = numpy.loadtxt( path, delimiter=',', skiprows=1, usecols=range( first, len( header )), ndmin=2 )
+    return header[first:], rates
+
+
+def select_currencies( currencies, rates, wanted, base_currency ):
+    """
+    Keep only the currencies we want out of a history of rates, adding the
+    base currency (at a constant rate of 1) if the history doesn't have it.
+
+    :param List currencies The currencies, one per column of rates
+    :param Array rates The (steps x currencies) rates, in base_currency
+    :param Dictionary wanted The currencies we want, e.g. the [Setup] currencies
+    :param String base_currency The base currency identifier
+
+    :rtype: A tuple with the list of currencies and the array of rates
+    """
+
+    columns = [ i for i, currency in enumerate( currencies ) if currency in wanted ]
+    currencies = [ currencies[i] for i in columns ]
+    rates = numpy.asarray( rates, dtype=float )[:, columns]
+    if base_currency in wanted and base_currency not in currencies:
+        currencies.append( base_currency )
+        rates = numpy.hstack( [ rates, numpy.ones( ( len( rates ), 1 )) ] )
+    return currencies, rates
+
+
+class Backtester(object):
+    """
+    Represents a backtest of a money maker over a history of rates
+    """
+
+    def __init__( self, money_maker, fee=0.0, chunk=64 ):
+        """
+        Create the Backtester
+
+        :param MoneyMaker money_maker The money maker whose strategy we are testing
+        :param Number fee The fee charged on each transaction, as a fraction of the amount
+        :param Integer chunk How many steps to look at, at first, when searching for the next rebalance (the search doubles it until it finds one)
+        """
+        self.version = 0
+
+        self.money_maker = money_maker
+        self.fee         = fee
+        self.chunk       = chunk
+
+
+    def __next_rebalance__( self, rates, holdings, start ):
+        """
+        Find the first step, from `start` on, where the spread between the
+        heaviest and the lightest currency reaches the rebalance_threshold.
+
+        :rtype: The step, or None if it never happens
+        """
+
+        threshold = self.money_maker.rebalance_threshold
+        chunk = self.chunk
+        while start < len( rates ):
+            values = rates[start:start+chunk] * holdings
+            weights = values / values.sum( axis=1 )[:, None]
+            spread = weights.max( axis=1 ) - weights.min( axis=1 )
+            hits = numpy.flatnonzero( spread >= threshold )
+            if len( hits ):
+                return start + hits[0]
+            start += chunk
+            chunk *= 2
+        return None
+
+
+    def run( self, currencies, rates, initial_value=1000.0 ):
+        """
+        Run the backtest, starting from a portfolio evenly spread over the
+        currencies.
+
+        :param List currencies The currencies, one per column of rates
+        :param Array rates The (steps x currencies) rates, in base_currency
+        :param Number initial_value The value of the portfolio at the first step
+
+        :rtype: A dictionary with the results:
+            { 'final_value': value of the portfolio at the last step,
+              'hold_value': what the initial portfolio would be worth if we never rebalanced,
+              'turnover': total value moved between currencies,
+              'fees': total fees paid,
+              'transactions': number of transactions,
+              'rebalances': number of rebalances,
+              'steps': number of steps }
+        """
+
+        rates = numpy.asarray( rates, dtype=float )
+        base_currency = self.money_maker.base_currency
+        index = dict( ( currency, i ) for i, currency in enumerate( currencies ))
+
+        initial_holdings = initial_value / len( currencies ) / rates[0]
+        holdings = initial_holdings.copy()
+
+        turnover = 0.0
+        fees = 0.0
+        transactions = 0
+        rebalances = 0
+
+        step = self.__next_rebalance__( rates, holdings, 1 )
+        while step is not None:
+            step_rates = rates[step]
+            values = step_rates * holdings
+            portfolio = { 'TOTAL': { 'value': float( values.sum() ), 'base_currency': base_currency } }
+            for currency, i in index.items():
+                portfolio[currency] = {
+                    'amount': float( holdings[i] ),
+                    'value': float( values[i] ),
+                    'rate': float( step_rates[i] ),
+                    'base_currency': base_currency,
+                }
+
+            step_transactions = self.money_maker.rebalance_portfolio( portfolio )
+            if step_transactions:
+                rebalances += 1
+            for trans in step_transactions:
+                origin = index[trans['origin']]
+                destination = index[trans['destination']]
+                holdings[origin] -= trans['amount'] / step_rates[origin]
+                holdings[destination] += trans['amount'] * ( 1.0 - self.fee ) / step_rates[destination]
+                turnover += trans['amount']
+                fees += trans['amount'] * self.fee
+                transactions += 1
+
+            step = self.__next_rebalance__( rates, holdings, step + 1 )
+
+        return {
+            'final_value':  float( ( rates[-1] * holdings ).sum() ),
+            'hold_value':   float( ( rates[-1] * initial_holdings ).sum() ),
+            'turnover':     turnover,
+            'fees':         fees,
+            'transactions': transactions,
+            'rebalances':   rebalances,
+            'steps':        len( rates ),
+        }
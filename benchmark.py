@@ -0,0 +1,269 @@
+#!/bin/env python
+# coding=utf-8
+"""
+Price Watcher benchmarks -- they time the hot paths (rebalancing, parsing the broker's answers and building the record keeper's cells) on synthetic data, with the stand-ins for the broker's API and the spreadsheet (see `standin`, every call instant), so no network is involved.
+
+Every case runs in a process of its own, and its memory is how much one call raises that process's peak over the one it had reached once the case was set up, so that it can be told apart from everyone else's. The metrics the calls record are forgotten before each call, so they don't pile up over thousands of calls. The results can be saved as a JSON baseline and later runs compared against it, failing when any case got slower (or bigger) than the tolerance allows.
+"""
+
+import sys
+import os
+import argparse
+import json
+import multiprocessing
+import random
+import resource
+import tempfile
+import time
+
+sys.path.append('.')
+
+from broker import Broker
+from metrics import metrics
+from model import Portfolio
+from moneymaker import MoneyMaker
+from recordkeeper import RecordKeeper, transaction_rows
+from standin import Endpoints, StandInBroker, StandInSpreadsheet
+
+BASE_CURRENCY = 'USD'
+
+CONFIG = """
+[MoneyMaker]
+rebalance_threshold: 0.01
+
+[Broker]
+pat: benchmark
+ticker_ttl: 0
+
+[RecordKeeper]
+worksheet_transactions: auto_transactions
+worksheet_portfolios: auto_portfolios
+max_retries: 1
+"""
+
+
+def make_currencies( n ):
+    """
+    :rtype: A dictionary of n currencies, the base currency amongst them, with their min_transaction (see `PriceWatcher`)
+    """
+
+    currencies = { BASE_CURRENCY: { 'min_transaction': 0.01 } }
+    for i in xrange( n - 1 ):
+        currencies[ 'C%04d' % i ] = { 'min_transaction': 0.001 }
+    return currencies
+
+
+def make_portfolio( currencies ):
+    """
+    :rtype: An unbalanced portfolio (see `MoneyMaker`) holding every currency
+    """
+
+    portfolio = {}
+    total = 0.0
+    for currency in sorted( currencies ):
+        rate = 1.0 if currency == BASE_CURRENCY else random.uniform( 0.01, 500.0 )
+        amount = random.uniform( 1.0, 100.0 ) / rate
+        portfolio[currency] = { 'amount': amount, 'value': amount * rate, 'rate': rate, 'base_currency': BASE_CURRENCY }
+        total += amount * rate
+    portfolio['TOTAL'] = { 'value': total, 'base_currency': BASE_CURRENCY }
+    return Portfolio.from_dict( portfolio )
+
+
+def make_transactions( n ):
+    """
+    :rtype: A list of n transactions (see `MoneyMaker.shake`)
+    """
+
+    names = sorted( make_currencies( 100 ))
+    return [ {
+        'origin':        random.choice( names ),
+        'destination':   random.choice( names ),
+        'amount':        random.uniform( 0.01, 100.0 ),
+        'base_currency': BASE_CURRENCY,
+    } for i in xrange( n ) ]
+
+
+# Each case sets itself up (given the config file and its size) and returns the call to time
+def rebalance( config_file, n ):
+    currencies = make_currencies( n )
+    money_maker = MoneyMaker( config_file, BASE_CURRENCY, currencies )
+    portfolio = make_portfolio( currencies )
+    return lambda: money_maker.rebalance_portfolio( portfolio )
+
+def get_tickers( config_file, n ):
+    currencies = make_currencies( n )
+    broker = Broker( config_file, currencies, BASE_CURRENCY, api=StandInBroker( Endpoints(), currencies, BASE_CURRENCY ))
+    return broker.get_tickers
+
+def get_portfolio( config_file, n ):
+    currencies = make_currencies( n )
+    broker = Broker( config_file, currencies, BASE_CURRENCY, api=StandInBroker( Endpoints(), currencies, BASE_CURRENCY ))
+    return broker.get_portfolio
+
+def build_transaction_rows( config_file, n ):
+    transactions = make_transactions( n )
+    return lambda: transaction_rows( transactions, '2015-01-01 00:00:00 +0000' )
+
+def write_transactions( config_file, n ):
+    recorder = RecordKeeper( config_file, spreadsheet=StandInSpreadsheet( Endpoints() ))
+    transactions = make_transactions( n )
+    return lambda: recorder.write_transactions( transactions, '2015-01-01 00:00:00 +0000' )
+
+def write_portfolio( config_file, n ):
+    recorder = RecordKeeper( config_file, spreadsheet=StandInSpreadsheet( Endpoints() ))
+    portfolio = make_portfolio( make_currencies( n ))
+    return lambda: recorder.write_portfolio( portfolio, portfolio['TOTAL']['value'], '2015-01-01 00:00:00 +0000' )
+
+CASES = []
+for n in [ 3, 10, 100, 1000 ]:
+    CASES.append( ( 'rebalance/' + str(n), rebalance, n ))
+    CASES.append( ( 'get_tickers/' + str(n), get_tickers, n ))
+    CASES.append( ( 'get_portfolio/' + str(n), get_portfolio, n ))
+    CASES.append( ( 'write_portfolio/' + str(n), write_portfolio, n ))
+for n in [ 1, 10, 100, 1000, 10000 ]:
+    CASES.append( ( 'transaction_rows/' + str(n), build_transaction_rows, n ))
+    CASES.append( ( 'write_transactions/' + str(n), write_transactions, n ))
+
+
+def run_case( case, config_file, min_time, repeat ):
+    """
+    Time one case, in a process of its own.
+
+    Its memory is taken over the first call, from the process's peak once
+    the case is set up to the peak the call takes it to (the peak only goes
+    up, so later calls would hide theirs behind it; a call that stays under
+    the setup's peak counts as nothing). The call is then repeated until it has run for at least min_time seconds, and that
+    `repeat` times over; the best of them is kept.
+
+    :rtype: A dictionary with the seconds per call and the bytes of memory one call takes
+    """
+
+    name, setup, n = case
+    random.seed( 0 )
+    call = setup( config_file, n )
+
+    # ru_maxrss is in kilobytes on Linux
+    metrics.reset()
+    before = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    call()
+    memory = max( resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss - before, 0 ) * 1024
+
+    best = None
+    for i in xrange( repeat ):
+        calls = 0
+        started = time.time()
+        while True:
+            metrics.reset()
+            call()
+            calls += 1
+            elapsed = time.time() - started
+            if elapsed >= min_time:
+                break
+        if best is None or elapsed / calls < best:
+            best = elapsed / calls
+
+    return { 'time': best, 'memory': memory }
+
+
+def compare( results, baseline, tolerance, memory_slack ):
+    """
+    :rtype: The list of cases (with what got worse) that regressed past the tolerance
+    """
+
+    regressions = []
+    for name, result in results:
+        if name not in baseline:
+            continue
+        if result['time'] > baseline[name]['time'] * ( 1.0 + tolerance ):
+            regressions.append( name + ' (time)' )
+        if result['memory'] > baseline[name]['memory'] * ( 1.0 + tolerance ) + memory_slack:
+            regressions.append( name + ' (memory)' )
+    return regressions
+
+
+##############################################
+# Here we go
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--baseline",
+        help="the JSON file with the baseline results",
+        default="benchmark-baseline.json"
+    )
+    parser.add_argument(
+        "--save",
+        help="save this run's results as the baseline instead of comparing against it",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--tolerance",
+        help="how much slower (or bigger) than the baseline a case may get, as a fraction",
+        type=float,
+        default=0.25
+    )
+    parser.add_argument(
+        "--memory-slack",
+        help="bytes of peak memory growth allowed on top of the tolerance (the measurement is page grained)",
+        type=int,
+        default=1024 * 1024
+    )
+    parser.add_argument(
+        "--cases",
+        help="only run the cases whose name contains this"
+    )
+    parser.add_argument(
+        "--min-time",
+        help="seconds each timing runs for, at least",
+        type=float,
+        default=0.2
+    )
+    parser.add_argument(
+        "--repeat",
+        help="how many timings are taken of each case (the best one counts)",
+        type=int,
+        default=3
+    )
+    args = parser.parse_args()
+
+    fd, config_file = tempfile.mkstemp( suffix='.cfg' )
+    os.write( fd, CONFIG )
+    os.close( fd )
+
+    results = []
+    try:
+        # A new process for every case, so peak memory is each case's own
+        pool = multiprocessing.Pool( 1, maxtasksperchild=1 )
+        for case in CASES:
+            if args.cases and args.cases not in case[0]:
+                continue
+            result = pool.apply( run_case, ( case, config_file, args.min_time, args.repeat ))
+            results.append( ( case[0], result ))
+            print '%-26s %12.3f ms %10d KB' % ( case[0], result['time'] * 1000, result['memory'] / 1024 )
+            sys.stdout.flush()
+        pool.close()
+        pool.join()
+    finally:
+        os.remove( config_file )
+
+    if args.save:
+        baseline = {}
+        if os.path.exists( args.baseline ):
+            baseline = json.load( open( args.baseline ))
+        baseline.update( dict( results ))
+        with open( args.baseline, 'w' ) as baseline_file:
+            json.dump( baseline, baseline_file, indent=2, sort_keys=True )
+        print 'Baseline saved to ' + args.baseline
+        sys.exit(0)
+
+    if not os.path.exists( args.baseline ):
+        print 'No baseline in ' + args.baseline + ' to compare against (run with --save to make one)'
+        sys.exit(0)
+
+    regressions = compare( results, json.load( open( args.baseline )), args.tolerance, args.memory_slack )
+    if regressions:
+        print 'Regressions past ' + str(int( args.tolerance * 100 )) + '%:'
+        for regression in regressions:
+            print '    ' + regression
+        sys.exit(1)
+    print 'No regressions past ' + str(int( args.tolerance * 100 )) + '%'
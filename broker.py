@@ -4,47 +4,121 @@ Price Watcher broker class -- it encapsulates the connection with the broker we
 At this time we are using Bitreserve (http://bitreserve.org/) through the Bitreserve Python SDK (http://github.com/byrnereese/bitreserve-python-sdk).
 """
 
-import ConfigParser
-from bitreserve import Bitreserve
+from addresscache import AddressCache
+from metrics import metrics, timed
+from settings import load_config
+from model import Holding, Portfolio
+from prices import PriceSources
+from ratelimit import RateLimiter
+from transport import Transport
+from multiprocessing.pool import ThreadPool
 import pprint
+import threading
+import time
 
 class Broker(object):
     """
     Represents the broker that handles our portfolio
     """
 
-    def __init__( self, config_file, currencies, base_currency, DEBUG=False ):
+    def __init__( self, config_file, currencies, base_currency, DEBUG=False, api=None, cross_rates=None ):
         """
         Create the Broker object
 
         :param String config_file The path to a config file that ConfigParser can read and that has a "Broker" section.
+        :param Object api An object with the Bitreserve SDK's interface to use instead of the SDK (e.g. a stand-in, for benchmarks)
+        :param CrossRates cross_rates The cross rates to keep up to date with the tickers, if any (see `CrossRates`)
         """
         self.version = 0
 
-        config = ConfigParser.ConfigParser()
-        config.read( config_file )
+        config = load_config( config_file )
 
-        self.api = Bitreserve()
-        self.api.auth_pat( config.get( 'Broker', 'pat' ) )
+        self.pat = config.get( 'Broker', 'pat' )
+        if api is None:
+            from bitreserve import Bitreserve
+            api = Bitreserve()
+        self.api = api
+        self.api.auth_pat( self.pat )
         self.currencies    = currencies
         self.base_currency = base_currency
         self.DEBUG         = DEBUG
         self.pp            = pprint.PrettyPrinter()
 
+        # Calls wait for their turn under the rate limits, if we have any
+        self.limiter = None
+        if config.has_section( 'RateLimit' ):
+            self.limiter = RateLimiter( config_file, DEBUG=DEBUG )
 
-    def get_tickers( self ):
+        # Every call to the API goes through the transport (timeouts, retries
+        # and circuit breaking); an execution is not safe to repeat
+        self.transport = Transport( 'broker', config_file, 'Broker', { 'execute_txn': { 'retries': 0, 'timeout': 30.0 } }, DEBUG, self.limiter )
+        self.transport.pool( getattr( self.api, 'session', None ))
+
+        # Optionally keep the best rates between every pair of currencies
+        self.cross_rates = cross_rates
+
+        # The tickers can come from several sources instead of just our API
+        self.prices = None
+        if config.has_section( 'Prices' ):
+            self.prices = PriceSources( config_file, self, DEBUG )
+
+        # The pairs we want out of the ticker, by pair name
+        self.relevant_pairs = {}
+        for currency in self.currencies:
+            self.relevant_pairs[ currency + self.base_currency ] = { 'currency': currency, 'direction': 'direct' }
+            self.relevant_pairs[ self.base_currency + currency ] = { 'currency': currency, 'direction': 'reverse', 'direct': currency + self.base_currency }
+
+        # Tickers are cached for a little while, as several callers may want them
+        self.ticker_ttl = 0.0
+        if config.has_option( 'Broker', 'ticker_ttl' ):
+            self.ticker_ttl = float( config.get( 'Broker', 'ticker_ttl' ))
+        self.ticker_lock         = threading.Lock()
+        self.ticker_request      = None
+        self.tickers             = None
+        self.tickers_expire_at   = 0.0
+        self.ticker_cache_hits   = 0
+        self.ticker_cache_misses = 0
+        self.ticker_cache_shared = 0
+
+        # How many quotes we ask for at the same time and how long they last
+        self.max_workers = 4
+        if config.has_option( 'Broker', 'max_workers' ):
+            self.max_workers = int( config.get( 'Broker', 'max_workers' ))
+        self.quote_ttl = 30.0
+        if config.has_option( 'Broker', 'quote_ttl' ):
+            self.quote_ttl = float( config.get( 'Broker', 'quote_ttl' ))
+        self.pool      = None
+        self.pool_lock = threading.Lock()
+
+        # Our cards' addresses hardly ever change, so they can be kept on disk
+        self.address_cache = None
+        if config.has_option( 'Broker', 'address_cache_file' ):
+            ttl = 86400.0
+            if config.has_option( 'Broker', 'address_cache_ttl' ):
+                ttl = float( config.get( 'Broker', 'address_cache_ttl' ))
+            self.address_cache = AddressCache( config.get( 'Broker', 'address_cache_file' ), ttl, self.pat )
+
+
+    def reauthenticate( self ):
         """
-        Get the tickers for the currencies in the configuration (paired with the base_currency)
+        Authenticate our (long-lived) API session again, for instance after
+        the broker has rejected our token.
+        """
+
+        self.api.auth_pat( self.pat )
+
+
+    def parse_tickers( self, tickers ):
+        """
+        Pick the tickers we care about out of the broker's full list, turning
+        the reverse pairs around so they are all quoted in base_currency.
+
+        :param List tickers The tickers, as returned by the broker's API
 
         :rtype: A dictionary of currency tickers with 3 fields: ask, bid, pair
         """
 
-        tickers = self.api.get_ticker()
-        relevant_pairs = {}
-        
-        for currency in self.currencies:
-            relevant_pairs[ currency + self.base_currency ] = { 'currency': currency, 'direction': 'direct' }
-            relevant_pairs[ self.base_currency + currency ] = { 'currency': currency, 'direction': 'reverse', 'direct': currency + self.base_currency }
+        relevant_pairs = self.relevant_pairs
         my_tickers = {}
         for ticker in tickers:
             if ticker[ 'pair' ] in relevant_pairs:
@@ -64,6 +138,102 @@ class Broker(object):
                     my_tickers[ relevant_pairs[ ticker[ 'pair' ] ][ 'currency'] ] = new_ticker
         return my_tickers
 
+
+    def fetch_tickers( self ):
+        """
+        Get every ticker there is, from our price sources if we have any (see
+        `PriceSources`), or else from the broker.
+
+        :rtype: A list of tickers, as returned by the broker's API
+        """
+
+        if self.prices:
+            return self.prices.fetch()
+        return self.transport.call( 'get_ticker', self.api.get_ticker )
+
+
+    @timed( 'get_tickers' )
+    def get_tickers( self ):
+        """
+        Get the tickers for the currencies in the configuration (paired with the base_currency)
+
+        The tickers are cached for ticker_ttl seconds and, while they are being
+        fetched, any other caller waits for that same request instead of
+        making its own.
+
+        :rtype: A dictionary of currency tickers with 3 fields: ask, bid, pair
+        """
+
+        with self.ticker_lock:
+            if self.tickers is not None and time.time() < self.tickers_expire_at:
+                self.ticker_cache_hits += 1
+                return dict( ( currency, dict( ticker )) for currency, ticker in self.tickers.items() )
+
+            request = self.ticker_request
+            if request is None:
+                self.ticker_cache_misses += 1
+                request = self.ticker_request = { 'done': threading.Event(), 'tickers': None, 'error': None }
+                fetching = True
+            else:
+                self.ticker_cache_shared += 1
+                fetching = False
+
+        if fetching:
+            try:
+                tickers = self.fetch_tickers()
+                if self.cross_rates:
+                    self.cross_rates.update_tickers( tickers )
+                request['tickers'] = self.parse_tickers( tickers )
+            except Exception as e:
+                request['error'] = e
+            with self.ticker_lock:
+                if request['error'] is None:
+                    self.tickers = request['tickers']
+                    self.tickers_expire_at = time.time() + self.ticker_ttl
+                self.ticker_request = None
+            request['done'].set()
+        else:
+            request['done'].wait()
+
+        if request['error'] is not None:
+            raise request['error']
+        return dict( ( currency, dict( ticker )) for currency, ticker in request['tickers'].items() )
+
+
+    def prime_tickers( self, tickers, ttl=None ):
+        """
+        Fill the ticker cache with tickers someone else has fetched (e.g. once
+        for a whole fleet of accounts), so that get_tickers doesn't have to.
+
+        :param List tickers The tickers, as returned by the broker's API
+        :param Number ttl How long (in seconds) they are good for (defaults to ticker_ttl)
+        """
+
+        if ttl is None:
+            ttl = self.ticker_ttl
+        if self.cross_rates:
+            self.cross_rates.update_tickers( tickers )
+        my_tickers = self.parse_tickers( tickers )
+        with self.ticker_lock:
+            self.tickers = my_tickers
+            self.tickers_expire_at = time.time() + ttl
+
+
+    def ticker_cache_stats( self ):
+        """
+        Get the ticker cache counters, to help tune ticker_ttl.
+
+        :rtype: A dictionary with the number of hits, misses and shared (requests that waited for another caller's fetch)
+        """
+
+        with self.ticker_lock:
+            return {
+                'hits':   self.ticker_cache_hits,
+                'misses': self.ticker_cache_misses,
+                'shared': self.ticker_cache_shared,
+            }
+
+    @timed( 'get_portfolio' )
     def get_portfolio( self ):
         """
         Get all of my assets, from my cards
@@ -82,27 +252,26 @@ class Broker(object):
             }
         """
 
-        my_portfolio = {}
-        all_of_me = self.api.get_me()
+        my_portfolio = Portfolio()
+        all_of_me = self.transport.call( 'get_me', self.api.get_me )
         if self.DEBUG:
-            print "Broker: Balances I got:"
-            self.pp.pprint( all_of_me['balances'] )
+            metrics.dump( "Broker: Balances I got:", all_of_me['balances'] )
 
-        total_balance = {
-            'value':         float(all_of_me['balances']['total']),
-            'base_currency': all_of_me['settings']['currency'],
-        }
+        total_balance = Holding(
+            value=float(all_of_me['balances']['total']),
+            base_currency=all_of_me['settings']['currency'],
+        )
         my_portfolio['TOTAL'] = total_balance
         for currency in all_of_me['balances']['currencies']:
             if currency not in self.currencies:
                 continue
 
-            balance = {
-                'amount': float(all_of_me['balances']['currencies'][currency]['balance']),
-                'value':   float(all_of_me['balances']['currencies'][currency]['amount']),
-                'rate':    float(all_of_me['balances']['currencies'][currency]['rate']),
-                'base_currency': all_of_me['balances']['currencies'][currency]['currency'],
-            }
+            balance = Holding(
+                amount=float(all_of_me['balances']['currencies'][currency]['balance']),
+                value=float(all_of_me['balances']['currencies'][currency]['amount']),
+                rate=float(all_of_me['balances']['currencies'][currency]['rate']),
+                base_currency=all_of_me['balances']['currencies'][currency]['currency'],
+            )
             if balance['base_currency'] != my_portfolio['TOTAL']['base_currency']:
                 print "Broker: Warning: suspicious base_currency in balance for " + currency
             my_portfolio[currency] = balance
@@ -110,10 +279,123 @@ class Broker(object):
         return my_portfolio
 
 
-    def run_transactions( self, transactions ):
+    def get_addresses( self, use_cache=True ):
+        """
+        Get the (bitcoin) addresses of our cards, from the cache if we have
+        them there.
+
+        :param Boolean use_cache Whether we may use the cached addresses
+
+        :rtype: A tuple with a dictionary of { currency: address } and whether it came from the cache
+        """
+
+        if use_cache and self.address_cache:
+            addresses = self.address_cache.load()
+            if addresses:
+                return addresses, True
+
+        my_cards = self.transport.call( 'get_cards', self.api.get_cards )
+        addresses = {}
+        for card in my_cards:
+            addresses[card['currency']] = card['address']['bitcoin']
+
+        if self.address_cache:
+            self.address_cache.store( addresses )
+        return addresses, False
+
+
+    def __pool__( self ):
+        """
+        :rtype: The pool the quotes are prepared on, started on first use and kept for as long as we live (see `close`)
+        """
+
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ThreadPool( self.max_workers )
+            return self.pool
+
+
+    def __prepare__( self, trans, addresses ):
+        """
+        Ask the broker for a quote for one transaction.
+
+        :rtype: A dictionary describing how it went (see `run_transactions`)
+        """
+
+        result = {
+            'transaction':     trans,
+            'txn_id':          None,
+            'status':          'failed',
+            'prepare_latency': None,
+            'execute_latency': None,
+        }
+        started = time.time()
+        try:
+            result['txn_id'] = self.transport.call(
+                        'prepare_txn',
+                        self.api.prepare_txn,
+                        addresses[trans['origin']],
+                        addresses[trans['destination']],
+                        trans['amount'],
+                        trans['base_currency']
+                    )
+        except KeyError as e:
+            result['error'] = 'Unknown address for ' + str(e)
+        except Exception as e:
+            result['error'] = str(e)
+        result['prepared_at']     = time.time()
+        result['prepare_latency'] = result['prepared_at'] - started
+        metrics.record_span( 'prepare_txn', {}, started, result['prepare_latency'], result.get( 'error' ))
+        if result['txn_id']:
+            result['status'] = 'prepared'
+        return result
+
+
+    def __execution_order__( self, transactions, portfolio ):
+        """
+        Find an order in which to run the transactions so that no card is ever
+        asked to send more than it holds at that point.
+
+        :param List transactions The transactions to run (see `run_transactions`)
+        :param Dictionary portfolio The portfolio the transactions will be run on (see `get_portfolio`)
+
+        :rtype: A list of indexes into transactions, or None if there is no safe order
+        """
+
+        balances = {}
+        for currency, data in portfolio.items():
+            if currency != 'TOTAL':
+                balances[currency] = data['value']
+
+        order = []
+        pending = range( len( transactions ))
+        while pending:
+            for index in pending:
+                trans = transactions[index]
+                if balances.get( trans['origin'], 0.0 ) >= trans['amount']:
+                    break
+            else:
+                return None
+            pending.remove( index )
+            order.append( index )
+            balances[trans['origin']] -= trans['amount']
+            balances[trans['destination']] = balances.get( trans['destination'], 0.0 ) + trans['amount']
+        return order
+
+
+    @timed( 'run_transactions' )
+    def run_transactions( self, transactions, portfolio=None ):
         """
         Get a list of transactions and run them on bitreserve.
 
+        All the quotes are prepared concurrently and only executed once every
+        one of them was successfully prepared, so a failure while preparing
+        leaves the portfolio untouched. The executions then run one at a time,
+        in an order that never overdraws a card. Should a quote expire (or an
+        execution fail) before its turn, the remaining transactions are
+        abandoned: the quotes we got are simply left to expire, but the
+        transfers already executed can not be undone.
+
         :param List transactions A list of transactions of the form:
             [{'base_currency': 'USD',
               'destination': u'BTC',
@@ -127,33 +409,113 @@ class Broker(object):
               'destination': u'BTC',
               'origin': u'CNY',
               'amount': 0.13}]
+        :param Dictionary portfolio The portfolio the transactions will run on (see `get_portfolio`), used to order them safely. If it is not given the transactions run in the order they come in.
+
+        :rtype: A list with one dictionary per transaction, in execution order:
+            { 'transaction': the transaction,
+              'txn_id': the broker's id for the quote,
+              'status': 'executed', 'failed', 'expired' or 'aborted',
+              'prepare_latency': seconds, 'execute_latency': seconds }
         """
 
+        if not transactions:
+            return []
+
         # Get cards addresses
-        my_cards = self.api.get_cards()
-        addresses = {}
-        for card in my_cards:
-            addresses[card['currency']] = card['address']['bitcoin']
+        addresses, cached = self.get_addresses()
 
-        # Run through the transacctions and prepare them
-        for trans in transactions:
-            txn_id = self.api.prepare_txn(
-                        addresses[trans['origin']],
-                        addresses[trans['destination']],
-                        trans['amount'],
-                        trans['base_currency']
-                    )
-            if txn_id:
-                txn_result = self.api.execute_txn(
-                    addresses[trans['origin']],
-                    txn_id,
+        # Make sure we can run them without overdrawing any card
+        order = range( len( transactions ))
+        if portfolio is not None:
+            order = self.__execution_order__( transactions, portfolio )
+            if order is None:
+                print "Broker: Can't run these transactions without overdrawing a card:"
+                self.pp.pprint( transactions )
+                return []
+
+        # Prepare all of the quotes at the same time
+        pool = self.__pool__()
+        results = pool.map( lambda index: self.__prepare__( transactions[index], addresses ), order )
+
+        # A failure with cached addresses may just mean they are stale
+        failed = [ position for position, result in enumerate( results ) if result['status'] != 'prepared' ]
+        if failed and cached:
+            if self.DEBUG:
+                print 'Broker: Preparing with cached addresses failed, fetching them again'
+            self.address_cache.invalidate()
+            metrics.increment( 'retries', { 'component': 'broker' }, len( failed ))
+            addresses, cached = self.get_addresses( use_cache=False )
+            retried = pool.map( lambda position: self.__prepare__( transactions[order[position]], addresses ), failed )
+            for position, result in zip( failed, retried ):
+                results[position] = result
+
+        if [ result for result in results if result['status'] != 'prepared' ]:
+            print "Broker: Something went wrong preparing the transactions, none of them will be run:"
+            for result in results:
+                if result['status'] == 'prepared':
+                    result['status'] = 'aborted'
+            self.pp.pprint( results )
+            return results
+
+        # And run them, one at a time
+        aborted = False
+        for result in results:
+            if aborted:
+                result['status'] = 'aborted'
+                continue
+            if time.time() - result['prepared_at'] > self.quote_ttl:
+                print "Broker: The quote for the following transaction expired, stopping here:"
+                self.pp.pprint( result['transaction'] )
+                result['status'] = 'expired'
+                aborted = True
+                continue
+
+            started = time.time()
+            try:
+                txn_result = self.transport.call(
+                    'execute_txn',
+                    self.api.execute_txn,
+                    addresses[result['transaction']['origin']],
+                    result['txn_id'],
                     'Money Maker automatic transaction'
                 )
+                result['status'] = 'executed'
                 if self.DEBUG:
                     print 'Result:'
                     self.pp.pprint( txn_result )
-            else:
-                print "Broker: Something went wrong with the following transaction:"
-                self.pp.pprint( trans )
-                return
+            except Exception as e:
+                print "Broker: Something went wrong executing the following transaction, stopping here:"
+                self.pp.pprint( result['transaction'] )
+                result['status'] = 'failed'
+                result['error'] = str(e)
+                aborted = True
+            result['execute_latency'] = time.time() - started
+            metrics.record_span( 'execute_txn', {}, started, result['execute_latency'], result.get( 'error' ))
+
+        if self.DEBUG:
+            print 'Broker: Transaction latencies (prepare / execute):'
+            for result in results:
+                print '    ' + result['transaction']['origin'] \
+                    + ' -> ' + result['transaction']['destination'] \
+                    + ': ' + str(result['prepare_latency']) \
+                    + ' / ' + str(result['execute_latency']) \
+                    + ' (' + result['status'] + ')'
+
+        return results
+
+
+    def close( self ):
+        """
+        Stop the pool the quotes are prepared on, if it was ever started, and
+        the price sources' one, and let go of the rate limiter's state file
+        """
 
+        with self.pool_lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if self.prices is not None:
+            self.prices.close()
+        if self.limiter is not None:
+            self.limiter.close()
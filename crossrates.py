@@ -0,0 +1,351 @@
+"""
+Price Watcher cross rates -- the best rate between any two currencies, and the way to get it, using every pair in the tickers and not only the ones quoted against the base currency. A way round that gives back more than it takes (an arbitrage cycle) is spotted as soon as the tickers that make it show up.
+
+The rates are kept in a dense NumPy (http://www.numpy.org/) matrix of -log(rate), so that the best conversion between two currencies is the shortest path between them (found with Floyd-Warshall, keeping the next hop of every path) and an arbitrage cycle is a cycle of negative weight. When a few tickers change, only the paths they touch are worked out again: a better rate costs O(n^2) per ticker, and a worse one O(n^2) per currency whose paths it touches on every round of relaxing them, falling back to the full O(n^3) when that would cost more.
+"""
+
+import math
+import threading
+
+import numpy
+
+from metrics import metrics
+from settings import load_config
+
+INFINITY = float( 'inf' )
+
+class CrossRates(object):
+    """
+    Represents the rates between every pair of currencies we have tickers for
+    """
+
+    def __init__( self, tolerance=1e-9, DEBUG=False ):
+        """
+        Create the CrossRates
+
+        :param Number tolerance How much better (as a fraction) a path or a cycle must be to count, so that rounding is not taken for a gain
+        :param Boolean DEBUG Debug level
+        """
+        self.version = 0
+
+        self.tolerance = tolerance
+        self.DEBUG     = DEBUG
+        self.lock      = threading.Lock()
+
+        self.index  = {}
+        self.names  = []
+        # The -log(rate) each ticker gives every conversion, by ( from, to ) and pair
+        self.quotes = {}
+
+        # The best direct conversions, the best paths' weights and their next hops
+        self.weights = numpy.zeros(( 0, 0 ))
+        self.dist    = numpy.zeros(( 0, 0 ))
+        self.next    = numpy.zeros(( 0, 0 ), dtype=int )
+        self.cycles  = []
+        self.stats   = { 'full': 0, 'incremental': 0 }
+
+
+    @classmethod
+    def from_config( cls, config_file, DEBUG=False ):
+        """
+        Create the CrossRates a config file asks for.
+
+        :param String config_file The path to a config file that ConfigParser can read and that has a "CrossRates" section, with an optional tolerance
+        :param Boolean DEBUG Debug level
+
+        :rtype: A CrossRates
+        """
+
+        config = load_config( config_file )
+        tolerance = 1e-9
+        if config.has_option( 'CrossRates', 'tolerance' ):
+            tolerance = float( config.get( 'CrossRates', 'tolerance' ))
+        return cls( tolerance, DEBUG )
+
+
+    def __split__( self, ticker ):
+        """
+        :rtype: The currency a ticker's pair sells and the one it is quoted in, or None if we can't tell them apart
+        """
+
+        pair, currency = ticker['pair'], ticker.get( 'currency' )
+        if currency and pair.endswith( currency ) and len( pair ) > len( currency ):
+            return pair[:-len( currency )], currency
+        if len( pair ) == 6:
+            return pair[:3], pair[3:]
+        return None
+
+
+    def __grow__( self, currency ):
+        """
+        Make room in the matrices for a new currency, with no conversions yet
+        """
+
+        n = len( self.names )
+        self.index[currency] = n
+        self.names.append( currency )
+        for name in [ 'weights', 'dist' ]:
+            matrix = numpy.full(( n + 1, n + 1 ), INFINITY )
+            matrix[:n, :n] = getattr( self, name )
+            matrix[n, n] = 0.0
+            setattr( self, name, matrix )
+        next_hops = numpy.full(( n + 1, n + 1 ), -1, dtype=int )
+        next_hops[:n, :n] = self.next
+        next_hops[n, n] = n
+        self.next = next_hops
+
+
+    def __quote__( self, source, destination, pair, weight ):
+        """
+        Set what a ticker says about one conversion.
+
+        :rtype: A tuple with the conversion's previous and new weights (a pair quoted both ways counts at its best)
+        """
+
+        edge = ( self.index[source], self.index[destination] )
+        quotes = self.quotes.setdefault( edge, {} )
+        old = min( quotes.values() ) if quotes else INFINITY
+        quotes[pair] = weight
+        return old, min( quotes.values() )
+
+
+    def update_tickers( self, tickers ):
+        """
+        Take in a list of tickers (all of them, or just the ones that
+        changed). The paths are worked out again from scratch if there are
+        new currencies or more changes than currencies (when that is
+        cheaper), and only where the changes touch them otherwise.
+
+        :param List tickers The tickers, as returned by the broker's API (see `PriceSources`)
+
+        :rtype: The arbitrage cycles there are now (see `arbitrage`)
+        """
+
+        with self.lock:
+            grown = False
+            changes = []
+            for ticker in tickers:
+                currencies = self.__split__( ticker )
+                bid, ask = float( ticker['bid'] ), float( ticker['ask'] )
+                if currencies is None or bid <= 0 or ask <= 0:
+                    continue
+                for currency in currencies:
+                    if currency not in self.index:
+                        self.__grow__( currency )
+                        grown = True
+                sold, quoted = currencies
+                # Selling one unit gets us the bid; buying one costs the ask
+                for source, destination, weight in [ ( sold, quoted, -math.log( bid )), ( quoted, sold, math.log( ask )) ]:
+                    old, new = self.__quote__( source, destination, ticker['pair'], weight )
+                    if old != new:
+                        changes.append( ( self.index[source], self.index[destination], old, new ))
+
+            if grown or self.cycles or len( changes ) > len( self.names ):
+                for u, v, old, new in changes:
+                    self.weights[u, v] = new
+                self.__recompute__()
+            elif changes:
+                for u, v, old, new in changes:
+                    self.weights[u, v] = new
+                    if new < old:
+                        self.__decrease__( u, v, new )
+                    else:
+                        self.__increase__( u, v, old, new )
+                self.stats['incremental'] += 1
+                metrics.increment( 'cross_rate_updates', { 'kind': 'incremental' } )
+                self.__find_cycles__()
+            return list( self.cycles )
+
+
+    def __recompute__( self ):
+        """
+        Work out every best path from scratch (Floyd-Warshall, one NumPy pass
+        per intermediate currency)
+        """
+
+        n = len( self.names )
+        dist = self.weights.copy()
+        next_hops = numpy.where( numpy.isfinite( dist ), numpy.arange( n )[None, :], -1 )
+        for k in xrange( n ):
+            through = dist[:, k, None] + dist[None, k, :]
+            better = through < dist - self.tolerance
+            if better.any():
+                dist = numpy.where( better, through, dist )
+                next_hops = numpy.where( better, next_hops[:, k, None], next_hops )
+        self.dist = dist
+        self.next = next_hops
+        self.stats['full'] += 1
+        metrics.increment( 'cross_rate_updates', { 'kind': 'full' } )
+        self.__find_cycles__()
+
+
+    def __first_hops__( self, u, v ):
+        """
+        :rtype: For every currency, the first hop of its path through the conversion u -> v
+        """
+
+        hops = self.next[:, u].copy()
+        hops[u] = v
+        return hops
+
+
+    def __decrease__( self, u, v, weight ):
+        """
+        A conversion got better: every path can only get better by going through it
+        """
+
+        through = self.dist[:, u, None] + weight + self.dist[None, v, :]
+        better = through < self.dist - self.tolerance
+        if better.any():
+            self.dist = numpy.where( better, through, self.dist )
+            self.next = numpy.where( better, self.__first_hops__( u, v )[:, None], self.next )
+
+
+    def __increase__( self, u, v, old, weight ):
+        """
+        A conversion got worse: only the paths that went through it can
+        change. They start off at what going through it costs now and are
+        then relaxed (Bellman-Ford style, from the paths that didn't change)
+        until none of them gets any better.
+
+        Each round of relaxing costs O(n^2) per currency whose paths changed,
+        so once the rounds have cost as much as a full recompute (O(n^3)) we
+        do that instead.
+        """
+
+        through_old = self.dist[:, u, None] + old + self.dist[None, v, :]
+        affected = numpy.isfinite( through_old ) & ( numpy.abs( through_old - self.dist ) <= self.tolerance )
+        # Staying put is free, even when a round trip through u -> v was too
+        # (a pair quoted without a spread)
+        numpy.fill_diagonal( affected, False )
+        if not affected.any():
+            return
+
+        through = self.dist[:, u, None] + weight + self.dist[None, v, :]
+        self.dist = numpy.where( affected, through, self.dist )
+        self.next = numpy.where( affected, numpy.where( numpy.isfinite( through ), self.__first_hops__( u, v )[:, None], -1 ), self.next )
+
+        rows = numpy.nonzero( affected.any( axis=1 ))[0]
+        rounds = max( len( self.names ) // len( rows ), 1 )
+        for iteration in xrange( rounds + 1 ):
+            if iteration == rounds:
+                self.__recompute__()
+                break
+            # The best last hop k -> j for every affected path i -> j
+            candidates = self.dist[rows][:, :, None] + self.weights[None, :, :]
+            last = candidates.argmin( axis=1 )
+            best = candidates.min( axis=1 )
+            better = affected[rows] & ( best < self.dist[rows] - self.tolerance )
+            if not better.any():
+                break
+            hops = numpy.where( last == rows[:, None], numpy.arange( len( self.names ))[None, :], self.next[rows[:, None], last] )
+            self.dist[rows] = numpy.where( better, best, self.dist[rows] )
+            self.next[rows] = numpy.where( better, hops, self.next[rows] )
+
+
+    def __find_cycles__( self ):
+        """
+        Look for arbitrage cycles: currencies whose best path back to
+        themselves is worth more than staying put
+        """
+
+        cycles = []
+        seen = set()
+        for start in numpy.nonzero( numpy.diag( self.dist ) < -self.tolerance )[0].tolist():
+            # Follow the path back to start, or to whichever loop it falls into
+            walk, current = [ start ], self.next[start, start]
+            while current >= 0 and current not in walk:
+                walk.append( current )
+                current = self.next[current, start]
+            if current < 0:
+                continue
+            cycle = walk[walk.index( current ):]
+            weight = sum( self.weights[a, b] for a, b in zip( cycle, cycle[1:] + cycle[:1] ))
+            key = frozenset( cycle )
+            if weight < -self.tolerance and key not in seen:
+                seen.add( key )
+                cycles.append({
+                    'cycle':  [ self.names[i] for i in cycle + cycle[:1] ],
+                    'profit': math.exp( -weight ) - 1.0,
+                })
+
+        if cycles and self.DEBUG:
+            for cycle in cycles:
+                print 'CrossRates: Arbitrage: ' + ' -> '.join( cycle['cycle'] ) + ' gives back ' + str(cycle['profit'] * 100) + '% more'
+        if cycles and not self.cycles:
+            metrics.increment( 'arbitrage_cycles', amount=len( cycles ))
+        self.cycles = cycles
+
+
+    def arbitrage( self ):
+        """
+        :rtype: A list of the arbitrage cycles: { 'cycle': [ 'USD', 'BTC', 'EUR', 'USD' ], 'profit': what a round gives back on top, as a fraction }
+        """
+
+        with self.lock:
+            return list( self.cycles )
+
+
+    def rate( self, origin, destination ):
+        """
+        :rtype: How much of destination one unit of origin gets us, along the best path (0 if there is none)
+        """
+
+        with self.lock:
+            if origin not in self.index or destination not in self.index:
+                return 0.0
+            return math.exp( -self.dist[self.index[origin], self.index[destination]] )
+
+
+    def path( self, origin, destination ):
+        """
+        :rtype: The currencies along the best path from origin to destination (both included), or None if there is none (or it goes round an arbitrage cycle)
+        """
+
+        with self.lock:
+            return self.__path__( origin, destination )
+
+
+    def __path__( self, origin, destination ):
+        if origin not in self.index or destination not in self.index:
+            return None
+        i, j = self.index[origin], self.index[destination]
+        path = [ i ]
+        while i != j:
+            i = self.next[i, j]
+            if i < 0 or i in path:
+                return None
+            path.append( i )
+        return [ self.names[i] for i in path ]
+
+
+    def annotate( self, transactions ):
+        """
+        Add a route to every transaction that has a better path than the
+        direct conversion: the currencies along it and how much better it
+        is, as a fraction (None if there is no direct conversion; see
+        `Transaction`).
+
+        :param List transactions The transactions (see `MoneyMaker.shake`)
+
+        :rtype: How many transactions got a route
+        """
+
+        routed = 0
+        with self.lock:
+            for transaction in transactions:
+                origin, destination = transaction['origin'], transaction['destination']
+                path = self.__path__( origin, destination )
+                if path is None or len( path ) < 3:
+                    continue
+                i, j = self.index[origin], self.index[destination]
+                # Without a direct conversion, any path is better
+                gain = None
+                if numpy.isfinite( self.weights[i, j] ):
+                    gain = math.exp( self.weights[i, j] - self.dist[i, j] ) - 1.0
+                    if gain <= self.tolerance:
+                        continue
+                transaction['route']      = path
+                transaction['route_gain'] = gain
+                routed += 1
+        return routed
@@ -0,0 +1,135 @@
+"""
+Price Watcher drift tracker -- it keeps track of how far a portfolio has drifted from balance as the rates change, one currency at a time.
+"""
+
+import heapq
+import math
+
+class DriftTracker(object):
+    """
+    Represents the drift of a portfolio whose amounts are fixed but whose
+    rates keep changing
+
+    The total value is kept up to date as each rate comes in, and the
+    currencies are kept in two heaps (by value), so the heaviest and the
+    lightest of them are known at any time. Each update costs O(log n).
+    Old heap entries are dropped lazily, as they reach the top, and the heaps
+    are rebuilt whenever they grow too big.
+    """
+
+    def __init__( self, portfolio, rebalance_threshold, resum_every=1000 ):
+        """
+        Create the DriftTracker
+
+        :param Dictionary portfolio The portfolio to track (see `MoneyMaker`); it is copied, never changed
+        :param Number rebalance_threshold The spread between the highest and the lowest percentage that calls for a rebalance
+        :param Integer resum_every How many updates go by before the total value is summed up again from scratch (to keep rounding errors from piling up)
+        """
+        self.version = 0
+
+        self.rebalance_threshold = rebalance_threshold
+        self.resum_every         = resum_every
+
+        self.amounts  = {}
+        self.values   = {}
+        self.versions = {}
+        for currency, data in portfolio.items():
+            if currency == 'TOTAL':
+                continue
+            self.amounts[currency]  = data['amount']
+            self.values[currency]   = data['value']
+            self.versions[currency] = 0
+
+        self.total   = math.fsum( self.values.values() )
+        self.updates = 0
+        self.__rebuild_heaps__()
+
+
+    def __rebuild_heaps__( self ):
+        """
+        Build both heaps from scratch, with only the current values in them
+        """
+
+        self.lowest  = [ ( value, self.versions[currency], currency ) for currency, value in self.values.items() ]
+        self.highest = [ ( -value, self.versions[currency], currency ) for currency, value in self.values.items() ]
+        heapq.heapify( self.lowest )
+        heapq.heapify( self.highest )
+
+
+    def __top__( self, heap ):
+        """
+        Get the current top entry of a heap, dropping any stale ones on the way
+        """
+
+        while heap[0][1] != self.versions[heap[0][2]]:
+            heapq.heappop( heap )
+        return heap[0]
+
+
+    def update( self, currency, rate ):
+        """
+        Take a new rate for one of the currencies.
+
+        :param String currency The currency
+        :param Number rate Its new rate, in base_currency
+        """
+
+        value = self.amounts[currency] * rate
+        self.total += value - self.values[currency]
+        self.values[currency] = value
+        self.versions[currency] += 1
+
+        self.updates += 1
+        if self.updates % self.resum_every == 0:
+            self.total = math.fsum( self.values.values() )
+
+        if len( self.lowest ) > 4 * len( self.values ):
+            self.__rebuild_heaps__()
+        else:
+            heapq.heappush( self.lowest, ( value, self.versions[currency], currency ) )
+            heapq.heappush( self.highest, ( -value, self.versions[currency], currency ) )
+
+
+    def update_tickers( self, tickers ):
+        """
+        Take new rates, at the middle of each ticker's spread, for every
+        currency we track that shows up in the tickers.
+
+        :param Dictionary tickers The tickers (see `Broker.get_tickers`)
+        """
+
+        for currency, ticker in tickers.items():
+            if currency in self.amounts:
+                self.update( currency, ( ticker['ask'] + ticker['bid'] ) / 2.0 )
+
+
+    def total_value( self ):
+        """
+        :rtype: The current total value of the portfolio, in base_currency
+        """
+
+        return self.total
+
+
+    def percentage( self, currency ):
+        """
+        :rtype: The share of the portfolio's value that is in the given currency
+        """
+
+        return self.values[currency] / self.total
+
+
+    def spread( self ):
+        """
+        :rtype: The difference between the highest and the lowest percentages of the portfolio
+        """
+
+        return ( -self.__top__( self.highest )[0] - self.__top__( self.lowest )[0] ) / self.total
+
+
+    def crossed( self ):
+        """
+        :rtype: Whether the spread has reached the rebalance_threshold (see `MoneyMaker.rebalance_portfolio`)
+        """
+
+        return self.spread() >= self.rebalance_threshold
@@ -0,0 +1,191 @@
+"""
+Price Watcher fleet -- it runs the price watcher for many accounts (one config file each) at the same time, fetching the tickers only once per cycle for all of those that use them.
+"""
+
+import glob
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+from metrics import metrics
+from settings import load_config
+from watcher import PriceWatcher
+
+# The files an account keeps to itself, by config section and option
+PRIVATE_FILES = [ ( 'Broker', 'address_cache_file' ), ( 'RecordKeeper', 'journal_file' ) ]
+
+class Fleet(object):
+    """
+    Represents a fleet of price watchers, one per account
+    """
+
+    def __init__( self, config_dir, DEBUG=False, dry_run=False, max_workers=8, profiler=None ):
+        """
+        Create the Fleet and a PriceWatcher for every config file in config_dir
+
+        :param String config_dir A directory with one config file (*.cfg) per account
+        :param Boolean DEBUG Debug level
+        :param Boolean dry_run Analise but don't effect any change
+        :param Integer max_workers How many accounts we work on at the same time
+        :param Profiler profiler Profiles every cycle (of the whole fleet), if given (see `Profiler`)
+        """
+        self.version = 0
+
+        self.DEBUG    = DEBUG
+        self.running  = False
+        self.profiler = profiler
+
+        config_files = sorted( glob.glob( os.path.join( config_dir, '*.cfg' )))
+        if not config_files:
+            raise ValueError( 'Fleet: No config files found in ' + config_dir )
+
+        # An account would replay another's journal into its own spreadsheet,
+        # or take its addresses, so no two accounts may share those files
+        owners = {}
+        for config_file in config_files:
+            config = load_config( config_file )
+            for section, option in PRIVATE_FILES:
+                if config.has_option( section, option ):
+                    path = os.path.abspath( config.get( section, option ))
+                    if path in owners:
+                        raise ValueError( 'Fleet: ' + config_file + ' and ' + owners[path] + ' share the ' + option + ' ' + path )
+                    owners[path] = config_file
+
+        self.pool = ThreadPool( min( max_workers, len( config_files )))
+
+        # Setting an account up is mostly waiting on the network, so do them all at once
+        names = [ os.path.splitext( os.path.basename( config_file ))[0] for config_file in config_files ]
+        watchers = self.pool.map( lambda config_file: PriceWatcher( config_file, DEBUG, dry_run, profiler=profiler, export_metrics=False ), config_files )
+        self.watchers = zip( names, watchers )
+
+        self.poll_interval = min( watcher.poll_interval for watcher in watchers )
+
+
+    def __run_account__( self, account ):
+        """
+        Run one account's cycle, timing it and keeping its errors to itself.
+
+        :rtype: A dictionary with the account's name, how long it took, how many transactions it asked for and the error, if any
+        """
+
+        name, watcher = account
+        report = { 'account': name, 'transactions': 0, 'error': None }
+        started = time.time()
+        try:
+            report['transactions'] = len( watcher.run_cycle() )
+        except Exception as e:
+            print 'Fleet: Error running account ' + name + ' (' + str(e) + '), refreshing its sessions'
+            report['error'] = str(e)
+            try:
+                watcher.refresh_sessions()
+            except Exception as e:
+                print 'Fleet: Could not refresh sessions for ' + name + ' (' + str(e) + ')'
+        report['time'] = time.time() - started
+        return report
+
+
+    def run_cycle( self ):
+        """
+        Run one cycle for every account: fetch the tickers once, hand them to
+        the brokers of the accounts that use them (see
+        `PriceWatcher.reads_tickers`) and then run all the accounts
+        concurrently.
+
+        The whole fleet's cycle is profiled as one, if we have a profiler,
+        and the metrics of all the accounts are exported together at the end.
+
+        :rtype: A dictionary with the time spent fetching the tickers, the total time and a report per account (see `__run_account__`)
+        """
+
+        try:
+            if self.profiler:
+                with self.profiler.cycle( 'fleet' ):
+                    return self.__cycle__()
+            return self.__cycle__()
+        finally:
+            metrics.export()
+
+
+    def __cycle__( self ):
+        """
+        Run one cycle for every account (see `run_cycle`)
+        """
+
+        started = time.time()
+
+        # Tickers are the same for everyone, so one account fetches them for
+        # all of those that use them (if any). Should no account manage to,
+        # each one fetches its own.
+        readers = [ ( name, watcher ) for name, watcher in self.watchers if watcher.reads_tickers() ]
+        tickers = None
+        for name, watcher in readers:
+            try:
+                tickers = watcher.broker.fetch_tickers()
+                break
+            except Exception as e:
+                print 'Fleet: Could not fetch the tickers for ' + name + ' (' + str(e) + ')'
+        if tickers is not None:
+            for name, watcher in readers:
+                try:
+                    watcher.broker.prime_tickers( tickers, self.poll_interval )
+                except Exception as e:
+                    print 'Fleet: Could not hand the tickers to ' + name + ' (' + str(e) + ')'
+        ticker_time = time.time() - started
+
+        accounts = self.pool.map( self.__run_account__, self.watchers )
+
+        report = {
+            'ticker_time': ticker_time,
+            'total_time':  time.time() - started,
+            'accounts':    accounts,
+        }
+        if self.DEBUG:
+            print 'Fleet: Cycle took ' + str(report['total_time']) + 's (tickers: ' + str(ticker_time) + 's)'
+            for account in accounts:
+                print '    ' + account['account'] + ': ' + str(account['time']) + 's, ' \
+                    + str(account['transactions']) + ' transactions' \
+                    + ( ', error: ' + account['error'] if account['error'] else '' )
+        return report
+
+
+    def run_forever( self, interval=None ):
+        """
+        Keep running cycles, one every `interval` seconds, until `stop` is
+        called (see `PriceWatcher.run_forever`).
+
+        :param Number interval Seconds between the start of two cycles (defaults to the shortest configured poll_interval)
+        """
+
+        if interval is None:
+            interval = self.poll_interval
+
+        self.running = True
+        while self.running:
+            started = time.time()
+            try:
+                self.run_cycle()
+            except Exception as e:
+                print 'Fleet: Error running cycle (' + str(e) + ')'
+
+            wait = interval - ( time.time() - started )
+            if self.running and wait > 0:
+                time.sleep( wait )
+
+
+    def stop( self ):
+        """
+        Ask a running fleet to stop after the current cycle
+        """
+
+        self.running = False
+
+
+    def close( self ):
+        """
+        Close every account's price watcher and the worker pool
+        """
+
+        for name, watcher in self.watchers:
+            watcher.close()
+        self.pool.close()
+        self.pool.join()
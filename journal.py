@@ -0,0 +1,202 @@
+"""
+Price Watcher journaled record keeper -- it takes the writes to the record keeper off the trading path.
+
+Records are first appended to a local write-ahead journal (one JSON record per line) and then written to the spreadsheet, in batches, by a background thread. Whatever is still in the journal when we start up (e.g. after a crash or a long spreadsheet outage) is written first. The record keeper itself (logging in and opening the spreadsheet) is set up by the background thread too, so the spreadsheet being down never keeps us from journaling.
+"""
+
+import json
+import os
+import threading
+from datetime import datetime
+
+from metrics import metrics, timed
+from recordkeeper import portfolio_rows, transaction_rows
+
+class JournaledRecordKeeper(object):
+    """
+    Represents a record keeper that never makes its callers wait for the
+    spreadsheet
+
+    It has the same writing interface as the `RecordKeeper` it wraps.
+    """
+
+    # What a profile of its calls measures (see `profiler.Profiler.wrap`)
+    profile_note = 'The time to append the records to the journal only: they are written to the spreadsheet on the journal\'s own thread'
+
+    def __init__( self, build_recorder, journal_file, flush_interval=5.0, max_backoff=300.0, DEBUG=False ):
+        """
+        Create the JournaledRecordKeeper and start its writer thread
+
+        :param Function build_recorder Creates the record keeper that does the actual writing (on the writer thread, and again after a write fails)
+        :param String journal_file The path to the journal
+        :param Number flush_interval How long (in seconds) to wait for more records before writing a batch
+        :param Number max_backoff The longest (in seconds) we wait between two failed writes
+        :param Boolean DEBUG Debug level
+        """
+        self.version = 0
+
+        self.build_recorder = build_recorder
+        self.recorder       = None
+        self.journal_file   = journal_file
+        self.flush_interval = flush_interval
+        self.max_backoff    = max_backoff
+        self.DEBUG          = DEBUG
+
+        self.condition = threading.Condition()
+        self.stopping  = False
+
+        # Anything left over from a previous run goes first
+        self.pending = []
+        if os.path.exists( self.journal_file ):
+            with open( self.journal_file ) as journal:
+                for line in journal:
+                    if line.strip():
+                        self.pending.append( json.loads( line ))
+            if self.pending:
+                print 'JournaledRecordKeeper: Replaying ' + str(len( self.pending )) + ' unflushed records'
+
+        self.thread = threading.Thread( target=self.__run__, name='JournaledRecordKeeper' )
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def __append__( self, kind, rows ):
+        """
+        Add a record to the journal and wake the writer up.
+
+        :param String kind Which worksheet the record goes to: 'portfolio' or 'transactions'
+        :param List rows The rows to write (see `RecordKeeper.write_rows`)
+        """
+
+        record = { 'kind': kind, 'rows': rows }
+        with self.condition:
+            with open( self.journal_file, 'a' ) as journal:
+                journal.write( json.dumps( record ) + '\n' )
+                journal.flush()
+                os.fsync( journal.fileno() )
+            self.pending.append( record )
+            self.condition.notify()
+
+
+    def __rewrite_journal__( self ):
+        """
+        Replace the journal with the records that are still pending. Must be
+        called with the condition held.
+        """
+
+        temp_path = self.journal_file + '.tmp'
+        with open( temp_path, 'w' ) as journal:
+            for record in self.pending:
+                journal.write( json.dumps( record ) + '\n' )
+            journal.flush()
+            os.fsync( journal.fileno() )
+        os.rename( temp_path, self.journal_file )
+
+
+    def __flush__( self, records ):
+        """
+        Write a batch of records to the spreadsheet: one update per worksheet.
+        Each worksheet's records leave the journal as soon as they are
+        written, so a failure on the other one doesn't get them written twice.
+
+        :param List records The records to write, in the order they were made
+        """
+
+        if self.recorder is None:
+            self.recorder = self.build_recorder()
+        self.recorder.refresh()
+        for kind, worksheet in [ ( 'portfolio', 'portfolios' ), ( 'transactions', 'transactions' ) ]:
+            batch = [ record for record in records if record['kind'] == kind ]
+            if not batch:
+                continue
+
+            rows = []
+            for record in batch:
+                rows.extend( record['rows'] )
+            self.recorder.write_rows( worksheet, rows )
+
+            with self.condition:
+                written = set( id( record ) for record in batch )
+                self.pending = [ record for record in self.pending if id( record ) not in written ]
+                self.__rewrite_journal__()
+
+
+    def __run__( self ):
+        """
+        The writer thread: wait for records, give a few more a chance to come
+        in and write them all, backing off exponentially when it fails.
+        """
+
+        backoff = 1.0
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopping:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                if not self.stopping:
+                    self.condition.wait( self.flush_interval )
+                records = list( self.pending )
+
+            try:
+                with metrics.span( 'journal_flush' ):
+                    self.__flush__( records )
+            except Exception as e:
+                print 'JournaledRecordKeeper: Error writing ' + str(len( records )) + ' records (' + str(e) + '), trying again in ' + str(backoff) + ' seconds'
+                metrics.increment( 'retries', { 'component': 'journal' } )
+                # Start over with a new record keeper (and session) next time
+                self.recorder = None
+                with self.condition:
+                    if self.stopping:
+                        return
+                    self.condition.wait( backoff )
+                backoff = min( backoff * 2, self.max_backoff )
+                continue
+
+            backoff = 1.0
+            if self.DEBUG:
+                print 'JournaledRecordKeeper: Wrote ' + str(len( records )) + ' records'
+
+
+    def refresh( self ):
+        """
+        Nothing to do here: the writer thread refreshes the record keeper
+        before each write
+        """
+
+        pass
+
+
+    @timed( 'write_transactions' )
+    def write_transactions( self, transactions, date=None ):
+        """
+        Queue the given transactions to be recorded (see `RecordKeeper.write_transactions`)
+        """
+
+        if date is None:
+            date = datetime.utcnow().strftime( '%Y-%m-%d %H:%M:%S +0000' )
+        self.__append__( 'transactions', transaction_rows( transactions, date ))
+
+
+    @timed( 'write_portfolio' )
+    def write_portfolio( self, portfolio, total_value, date=None ):
+        """
+        Queue the given portfolio to be recorded (see `RecordKeeper.write_portfolio`)
+        """
+
+        if date is None:
+            date = datetime.utcnow().strftime( '%Y-%m-%d %H:%M:%S +0000' )
+        self.__append__( 'portfolio', portfolio_rows( portfolio, total_value, date ))
+
+
+    def close( self, timeout=30.0 ):
+        """
+        Stop the writer thread, giving it up to `timeout` seconds to write
+        whatever is pending. Anything it doesn't manage to write stays in the
+        journal for the next run.
+        """
+
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join( timeout )
@@ -0,0 +1,164 @@
+"""
+Price Watcher matching engine -- it works out which currencies have to send or receive value in order to reach a target and pairs them up into transactions.
+
+The deltas are computed with NumPy (http://www.numpy.org/), so they can be worked out for many currencies (or many portfolios) in a single pass.
+"""
+
+import heapq
+import numpy
+
+from model import Transaction
+
+def transaction_deltas( values, target_values, min_transactions ):
+    """
+    Work out how much value each currency has to send or receive in order to
+    get to its target value, rounded to a multiple of its min_transaction.
+
+    Anything that rounds to less than the min_transaction is left alone.
+    The arguments can be arrays of any (broadcastable) shape, so a whole batch
+    of portfolios can be handled in one go.
+
+    :param Array values The current value (in base_currency) of each currency
+    :param Array target_values The value (in base_currency) we want each currency to have
+    :param Array min_transactions The min_transaction of each currency
+
+    :rtype: A tuple of two float arrays, shaped like values: the (positive)
+            amounts that need to move and the rounded amounts that were
+            deemed too small to move. Each amount is sent if its currency is
+            above its target value and received otherwise.
+    """
+
+    values           = numpy.asarray( values, dtype=float )
+    min_transactions = numpy.asarray( min_transactions, dtype=float )
+
+    units = numpy.abs( values - target_values ) / min_transactions
+    # Round half away from zero, like the built in `round`
+    whole = numpy.floor( units )
+    rounded = ( whole + ( units - whole >= 0.5 ) ) * min_transactions
+
+    moving = rounded >= min_transactions
+    return numpy.where( moving, rounded, 0.0 ), numpy.where( moving, 0.0, rounded )
+
+
+class MatchingEngine(object):
+    """
+    Pairs the currencies that have too much value with the ones that have too
+    little, largest first, until one of the sides runs out.
+
+    The pairing is kept in two heaps, so it costs O(log n) per transaction
+    instead of re-sorting every list on each step.
+    """
+
+    def __init__( self, currencies, base_currency, DEBUG=False ):
+        """
+        Create the MatchingEngine
+
+        :param Dictionary currencies A dictionary with the following structure: { currency: { 'min_transaction': value } }
+        :param String base_currency The base currency identifier
+        :param Boolean DEBUG Debug level
+        """
+        self.version = 0
+
+        self.currencies    = currencies
+        self.base_currency = base_currency
+        self.DEBUG         = DEBUG
+
+
+    def split( self, portfolio, target_value ):
+        """
+        Split the currencies in a portfolio into the ones that need to send
+        value and the ones that need to receive it.
+
+        :param Dictionary portfolio The portfolio we wish to work on (see `MoneyMaker`)
+        :param Number target_value The value every currency should end up with
+
+        :rtype: A tuple with the senders and the receivers, each a list of
+                { 'currency': String, 'value': Number } in portfolio order.
+        """
+
+        names  = [ currency for currency in portfolio if currency != 'TOTAL' ]
+        values = [ portfolio[currency]['value'] for currency in names ]
+        mins   = [ self.currencies[portfolio[currency]['base_currency']]['min_transaction'] for currency in names ]
+
+        amounts, avoided = transaction_deltas( values, target_value, mins )
+        sending = ( numpy.asarray( values ) > target_value ).tolist()
+
+        senders   = []
+        receivers = []
+        for currency, value, amount, too_small, send, min_transaction in zip( names, values, amounts.tolist(), avoided.tolist(), sending, mins ):
+            if amount:
+                if send:
+                    senders.append({ 'currency': currency, 'value': amount })
+                else:
+                    receivers.append({ 'currency': currency, 'value': amount })
+            elif self.DEBUG and value != target_value:
+                print 'MatchingEngine: Avoiding transaction bellow ' \
+                    + str(min_transaction) \
+                    + ( ' (send ' if send else ' (receive ' ) \
+                    + str(too_small) \
+                    + ' ' \
+                    + currency \
+                    + ')'
+
+        return senders, receivers
+
+
+    def match( self, senders, receivers ):
+        """
+        Pair the senders with the receivers, always moving as much as we can
+        from the largest sender to the largest receiver.
+
+        Ties are broken the way a stable sort of the lists would: a currency
+        that was just partially filled comes first, then the others in their
+        original order.
+
+        :param List senders The currencies sending value (see `split`)
+        :param List receivers The currencies receiving value (see `split`)
+
+        :rtype: A list of transactions (see `MoneyMaker.shake`)
+        """
+
+        sender_heap   = [ [ -item['value'], order, item['currency'] ] for order, item in enumerate( senders ) ]
+        receiver_heap = [ [ -item['value'], order, item['currency'] ] for order, item in enumerate( receivers ) ]
+        heapq.heapify( sender_heap )
+        heapq.heapify( receiver_heap )
+
+        transactions = []
+        step = 0
+        while sender_heap and receiver_heap:
+            step += 1
+            sender   = heapq.heappop( sender_heap )
+            receiver = heapq.heappop( receiver_heap )
+            sender_value   = -sender[0]
+            receiver_value = -receiver[0]
+
+            if sender_value >= receiver_value:
+                amount_to_transfer = receiver_value
+                leftover, heap, item = sender_value - amount_to_transfer, sender_heap, sender
+            else:
+                amount_to_transfer = sender_value
+                leftover, heap, item = receiver_value - amount_to_transfer, receiver_heap, receiver
+
+            transactions.append( Transaction(
+                sender[2],
+                receiver[2],
+                amount_to_transfer,
+                self.base_currency
+            ))
+
+            if leftover >= self.currencies[item[2]]['min_transaction']:
+                heapq.heappush( heap, [ -leftover, -step, item[2] ] )
+
+        return transactions
+
+
+    def transactions( self, portfolio, target_value ):
+        """
+        Work out the transactions that take every currency in the portfolio to
+        the target value.
+
+        See `split` for the parameters and `match` for the return value.
+        """
+
+        senders, receivers = self.split( portfolio, target_value )
+        return self.match( senders, receivers )
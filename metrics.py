@@ -0,0 +1,298 @@
+"""
+Price Watcher metrics -- timing spans, latency histograms and retry counters for every rebalance cycle, exported as a Prometheus textfile (for node_exporter's textfile collector) and/or as JSON lines.
+
+Every component records into the same registry, `metrics`, so the numbers of a whole cycle end up together whichever component they come from.
+"""
+
+import functools
+import json
+import os
+import pprint
+import tempfile
+import threading
+import time
+
+# The upper bounds (in seconds) of the histograms' buckets
+BUCKETS = [ 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0 ]
+
+class Span(object):
+    """
+    Times a block of code (see `Metrics.span`)
+    """
+
+    def __init__( self, registry, name, labels ):
+        self.registry = registry
+        self.name     = name
+        self.labels   = labels
+
+    def __enter__( self ):
+        self.started = time.time()
+        return self
+
+    def __exit__( self, kind, value, traceback ):
+        self.registry.record_span( self.name, self.labels, self.started, time.time() - self.started, value )
+        return False
+
+
+class Metrics(object):
+    """
+    Represents the registry of metrics: histograms of span durations and API
+    latencies, counters (retries, errors...) and the spans of the current
+    cycle, waiting to be exported.
+    """
+
+    def __init__( self ):
+        """
+        Create the Metrics registry, with nowhere to export to yet (see `configure`)
+        """
+        self.version = 0
+
+        self.lock            = threading.Lock()
+        self.prometheus_file = None
+        self.json_file       = None
+        self.dumps           = True
+        self.histograms      = {}
+        self.counters        = {}
+        self.spans           = []
+
+
+    def configure( self, prometheus_file=None, json_file=None, dumps=True ):
+        """
+        Set where the metrics are exported to.
+
+        :param String prometheus_file The Prometheus textfile to (re)write on every export
+        :param String json_file The file to append a JSON line per exported cycle to
+        :param Boolean dumps Whether `dump` prints the structures it is given
+        """
+
+        self.prometheus_file = prometheus_file
+        self.json_file       = json_file
+        self.dumps           = dumps
+
+
+    def reset( self ):
+        """
+        Forget everything recorded so far: histograms, counters and spans
+        """
+
+        with self.lock:
+            self.histograms = {}
+            self.counters   = {}
+            self.spans      = []
+
+
+    def __key__( self, name, labels ):
+        return ( name, tuple( sorted( ( labels or {} ).items() )))
+
+
+    def observe( self, name, value, labels=None ):
+        """
+        Add a value (e.g. a latency, in seconds) to a histogram.
+
+        :param String name The histogram's name
+        :param Number value The value
+        :param Dictionary labels The labels that tell this series apart, e.g. { 'endpoint': 'get_ticker' }
+        """
+
+        key = self.__key__( name, labels )
+        with self.lock:
+            histogram = self.histograms.get( key )
+            if histogram is None:
+                histogram = self.histograms[key] = { 'buckets': [ 0 ] * len( BUCKETS ), 'count': 0, 'sum': 0.0 }
+            for i, bound in enumerate( BUCKETS ):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['count'] += 1
+            histogram['sum']   += value
+
+
+    def increment( self, name, labels=None, amount=1 ):
+        """
+        Add to a counter.
+
+        :param String name The counter's name, e.g. 'retries'
+        :param Dictionary labels The labels that tell this series apart, e.g. { 'component': 'recorder' }
+        :param Number amount How much to add
+        """
+
+        key = self.__key__( name, labels )
+        with self.lock:
+            self.counters[key] = self.counters.get( key, 0 ) + amount
+
+
+    def span( self, name, **labels ):
+        """
+        Time a block of code, as in `with metrics.span( 'get_portfolio' ):`.
+        Its duration goes to the span_seconds histogram and the span itself
+        to the next JSON line.
+
+        :param String name The span's name
+        :param Dictionary labels Any labels to go with it
+        """
+
+        return Span( self, name, labels )
+
+
+    def record_span( self, name, labels, started, duration, error=None ):
+        """
+        Record a finished span (see `span`).
+        """
+
+        labels = dict( labels, span=name )
+        self.observe( 'span_seconds', duration, labels )
+        record = { 'span': name, 'start': started, 'duration': duration }
+        if len( labels ) > 1:
+            record['labels'] = dict( ( key, value ) for key, value in labels.items() if key != 'span' )
+        if error is not None:
+            record['error'] = str( error )
+        with self.lock:
+            self.spans.append( record )
+
+
+    def api_call( self, endpoint, call, *args ):
+        """
+        Make a call to an outside service, keeping its latency in the
+        api_latency_seconds histogram (and counting it in api_errors if it
+        fails).
+
+        :param String endpoint The name of the call, e.g. 'get_ticker'
+        :param Function call The call
+        :param List args Its arguments
+
+        :rtype: Whatever the call returns
+        """
+
+        started = time.time()
+        try:
+            return call( *args )
+        except Exception:
+            self.increment( 'api_errors', { 'endpoint': endpoint } )
+            raise
+        finally:
+            self.observe( 'api_latency_seconds', time.time() - started, { 'endpoint': endpoint } )
+
+
+    def dump( self, title, value ):
+        """
+        Print a (possibly big) structure for debugging, unless dumps are
+        turned off. The structure is only formatted when it is printed, and
+        the time that takes goes to the debug_dump_seconds histogram.
+
+        :param String title What to print before it
+        :param Object value The structure
+        """
+
+        if not self.dumps:
+            return
+        started = time.time()
+        print title
+        print pprint.pformat( value )
+        self.observe( 'debug_dump_seconds', time.time() - started )
+
+
+    def __labels__( self, labels, extra=None ):
+        labels = list( labels ) + ( [ extra ] if extra else [] )
+        if not labels:
+            return ''
+        return '{' + ','.join( '%s="%s"' % ( key, str( value ).replace( '\\', '\\\\' ).replace( '"', '\\"' )) for key, value in labels ) + '}'
+
+
+    def prometheus( self ):
+        """
+        :rtype: The metrics, in Prometheus' text exposition format
+        """
+
+        with self.lock:
+            histograms = sorted( self.histograms.items() )
+            counters   = sorted( self.counters.items() )
+
+        lines = []
+        declared = set()
+        for ( name, labels ), histogram in histograms:
+            metric = 'price_watcher_' + name
+            if metric not in declared:
+                lines.append( '# TYPE ' + metric + ' histogram' )
+                declared.add( metric )
+            for bound, count in zip( BUCKETS, histogram['buckets'] ):
+                lines.append( metric + '_bucket' + self.__labels__( labels, ( 'le', repr( bound ))) + ' ' + str(count) )
+            lines.append( metric + '_bucket' + self.__labels__( labels, ( 'le', '+Inf' )) + ' ' + str(histogram['count']) )
+            lines.append( metric + '_sum' + self.__labels__( labels ) + ' ' + repr( histogram['sum'] ))
+            lines.append( metric + '_count' + self.__labels__( labels ) + ' ' + str(histogram['count']) )
+        for ( name, labels ), count in counters:
+            metric = 'price_watcher_' + name + '_total'
+            if metric not in declared:
+                lines.append( '# TYPE ' + metric + ' counter' )
+                declared.add( metric )
+            lines.append( metric + self.__labels__( labels ) + ' ' + str(count) )
+        return '\n'.join( lines ) + '\n'
+
+
+    def export( self ):
+        """
+        Export what we have: rewrite the Prometheus textfile (atomically, as
+        the collector may read it at any time) and append the spans recorded
+        since the last export, and the counters, as one JSON line.
+
+        Exporting never fails the caller: an error is printed and counted in
+        export_errors, and the next export tries again.
+        """
+
+        with self.lock:
+            spans = self.spans
+            self.spans = []
+
+        if self.prometheus_file:
+            try:
+                self.__write_prometheus__()
+            except Exception as e:
+                print 'Metrics: Could not write ' + self.prometheus_file + ' (' + str(e) + ')'
+                self.increment( 'export_errors', { 'format': 'prometheus' } )
+
+        if self.json_file and spans:
+            with self.lock:
+                counters = [ dict( labels, name=name, value=count ) for ( name, labels ), count in sorted( self.counters.items() ) ]
+            try:
+                with open( self.json_file, 'a' ) as json_file:
+                    json_file.write( json.dumps({ 'time': time.time(), 'spans': spans, 'counters': counters }) + '\n' )
+            except Exception as e:
+                print 'Metrics: Could not write ' + self.json_file + ' (' + str(e) + ')'
+                self.increment( 'export_errors', { 'format': 'json' } )
+
+
+    def __write_prometheus__( self ):
+        """
+        Write the Prometheus textfile to a temporary file of its own, next to
+        it, and then move it into place
+        """
+
+        directory, name = os.path.split( os.path.abspath( self.prometheus_file ))
+        fd, temporary = tempfile.mkstemp( prefix='.' + name + '.', dir=directory )
+        try:
+            with os.fdopen( fd, 'w' ) as prometheus_file:
+                prometheus_file.write( self.prometheus() )
+            os.chmod( temporary, 0644 )
+            os.rename( temporary, self.prometheus_file )
+        except:
+            if os.path.exists( temporary ):
+                os.remove( temporary )
+            raise
+
+
+# The registry every component records into
+metrics = Metrics()
+
+
+def timed( name ):
+    """
+    Decorate a method so every call to it is a span (see `Metrics.span`).
+
+    :param String name The span's name
+    """
+
+    def decorator( method ):
+        @functools.wraps( method )
+        def wrapper( *args, **kwargs ):
+            with metrics.span( name ):
+                return method( *args, **kwargs )
+        return wrapper
+    return decorator
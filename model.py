@@ -0,0 +1,146 @@
+"""
+Price Watcher model -- compact representations of the portfolios and transactions that move between the broker, the money maker, the record keeper and the script.
+
+Holdings and transactions keep their fields in `__slots__` instead of a dictionary each, which takes a lot less memory when we keep long histories or simulate many portfolios. They still behave like the dictionaries we have always used (`holding['value']`, `'pctg' in holding`, `holding.items()`, ...), so they can be handed to any code written for those as they are, without converting them.
+"""
+
+class Record(object):
+    """
+    Gives a slotted object the (read and write) interface of a dictionary
+    whose keys are its slots. A slot that was never set is a missing key.
+    """
+
+    __slots__ = ()
+
+    def __getitem__( self, key ):
+        if key not in self.__slots__:
+            raise KeyError( key )
+        try:
+            return getattr( self, key )
+        except AttributeError:
+            raise KeyError( key )
+
+    def __setitem__( self, key, value ):
+        if key not in self.__slots__:
+            raise KeyError( key )
+        setattr( self, key, value )
+
+    def __contains__( self, key ):
+        return key in self.__slots__ and hasattr( self, key )
+
+    def __iter__( self ):
+        return iter( self.keys() )
+
+    def __len__( self ):
+        return len( self.keys() )
+
+    def get( self, key, default=None ):
+        if key in self:
+            return getattr( self, key )
+        return default
+
+    def keys( self ):
+        return [ key for key in self.__slots__ if hasattr( self, key ) ]
+
+    def values( self ):
+        return [ getattr( self, key ) for key in self.keys() ]
+
+    def items( self ):
+        return [ ( key, getattr( self, key )) for key in self.keys() ]
+
+    def to_dict( self ):
+        """
+        :rtype: The record as a plain dictionary
+        """
+        return dict( self.items() )
+
+    def __eq__( self, other ):
+        if isinstance( other, Record ):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__( self, other ):
+        return not self == other
+
+    def __repr__( self ):
+        return repr( self.to_dict() )
+
+
+class Holding(Record):
+    """
+    Represents what we hold of one currency (or, for 'TOTAL', of all of them)
+    """
+
+    __slots__ = ( 'amount', 'value', 'rate', 'base_currency', 'pctg' )
+
+    def __init__( self, amount=None, value=None, rate=None, base_currency=None ):
+        """
+        Create the Holding; any field left as None is left out.
+
+        :param Number amount Amount held, in the holding's currency
+        :param Number value Value, in base_currency
+        :param Number rate Conversion rate to base_currency
+        :param String base_currency The base currency identifier
+        """
+        for key, value in ( ( 'amount', amount ), ( 'value', value ), ( 'rate', rate ), ( 'base_currency', base_currency )):
+            if value is not None:
+                setattr( self, key, value )
+
+
+class Transaction(Record):
+    """
+    Represents a transfer of value from one currency to another, and
+    possibly a better route for it than the direct conversion (see
+    `CrossRates.annotate`)
+    """
+
+    __slots__ = ( 'origin', 'destination', 'amount', 'base_currency', 'route', 'route_gain' )
+
+    def __init__( self, origin, destination, amount, base_currency ):
+        """
+        Create the Transaction
+
+        :param String origin The currency the value leaves
+        :param String destination The currency the value goes to
+        :param Number amount How much value moves, in base_currency
+        :param String base_currency The base currency identifier
+        """
+        self.origin        = origin
+        self.destination   = destination
+        self.amount        = amount
+        self.base_currency = base_currency
+
+
+class Portfolio(dict):
+    """
+    Represents a portfolio: a dictionary of { currency: Holding }, possibly
+    with a 'TOTAL' holding (see `MoneyMaker`)
+    """
+
+    @classmethod
+    def from_dict( cls, portfolio ):
+        """
+        Build a Portfolio out of a portfolio made of plain dictionaries.
+
+        :param Dictionary portfolio The portfolio (see `MoneyMaker`)
+
+        :rtype: A Portfolio
+        """
+
+        my_portfolio = cls()
+        for currency, data in portfolio.items():
+            if not isinstance( data, Holding ):
+                holding = Holding()
+                for key, value in data.items():
+                    holding[key] = value
+                data = holding
+            my_portfolio[currency] = data
+        return my_portfolio
+
+
+    def to_dict( self ):
+        """
+        :rtype: The portfolio made of plain dictionaries
+        """
+
+        return dict( ( currency, holding.to_dict() ) for currency, holding in self.items() )
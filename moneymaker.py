@@ -2,8 +2,10 @@
 Price Watcher money maker class -- a collection of ways to handle a portfolio in order to (hopefuly) make money
 """
 
-import ConfigParser
-import pprint
+from matching import MatchingEngine
+from metrics import metrics, timed
+from planner import MinTransferPlanner
+from settings import load_config
 
 class MoneyMaker(object):
     """
@@ -27,7 +29,7 @@ class MoneyMaker(object):
             }
     """
 
-    def __init__( self, config_file, base_currency, currencies, DEBUG=False ):
+    def __init__( self, config_file, base_currency, currencies, DEBUG=False, cross_rates=None ):
         """
         Create the MoneyMaker
 
@@ -35,11 +37,11 @@ class MoneyMaker(object):
         :param String config_file The path to a config file that ConfigParser can read and that has a "MoneyMaker" section.
         :param String currencies a dictionary with the following structure: { currency:min_transaction_value }
         :param String DEBUG Debug level
+        :param CrossRates cross_rates The cross rates to route the transactions with, if any (see `CrossRates`)
         """
         self.version = 0
 
-        config = ConfigParser.ConfigParser()
-        config.read( config_file )
+        config = load_config( config_file )
 
 # TODO: How do I get rid of this nasty `eval`?
         self.rebalance_threshold = float( config.get( 'MoneyMaker', 'rebalance_threshold' ))
@@ -47,6 +49,26 @@ class MoneyMaker(object):
         self.base_currency = base_currency
         self.currencies    = currencies
 
+        self.matching_engine = MatchingEngine( currencies, base_currency, DEBUG )
+
+        # Given the cross rates (see `CrossRates`), transactions that have a
+        # better route than the direct conversion are annotated with it
+        self.cross_rates = cross_rates
+
+        # Optionally look for the plan with the fewest transfers
+        self.planner           = None
+        self.round_trips_saved = 0
+        planner = 'greedy'
+        if config.has_option( 'MoneyMaker', 'planner' ):
+            planner = config.get( 'MoneyMaker', 'planner' )
+        if planner == 'min_transfers':
+            max_exact = 14
+            if config.has_option( 'MoneyMaker', 'planner_max_exact' ):
+                max_exact = int( config.get( 'MoneyMaker', 'planner_max_exact' ))
+            self.planner = MinTransferPlanner( currencies, base_currency, max_exact, DEBUG )
+        elif planner != 'greedy':
+            raise ValueError( 'MoneyMaker: Unknown planner ' + planner )
+
 
     def __calculate_portfolio_value__( self, portfolio ):
         """
@@ -81,6 +103,7 @@ class MoneyMaker(object):
         return portfolio
 
 
+    @timed( 'shake' )
     def shake( self, portfolio ):
         """
         Execute whatever algorithm was chosen in order to re-balance the 
@@ -133,9 +156,7 @@ class MoneyMaker(object):
         min_pctg = min(pctgs)
 
         if self.DEBUG:
-            pp = pprint.PrettyPrinter()
-            print "MoneyMaker: Current status:"
-            pp.pprint( current_status )
+            metrics.dump( "MoneyMaker: Current status:", current_status )
             print "MoneyMaker: Current value: " + str(current_portfolio_value)
             print 'MoneyMaker: Lowest pctg found: ' + str(min_pctg)
             print 'MoneyMaker: Highest pctg found: ' + str(max_pctg)
@@ -157,88 +178,30 @@ class MoneyMaker(object):
 
 
         # Balance each currency
-        senders   = []
-        receivers = []
-        for currency in current_status:
-            if currency == 'TOTAL':
-                continue
-            transaction_value = 0
-            min_transaction = self.currencies[current_status[currency]['base_currency']]['min_transaction']
-            if target_value < current_status[currency]['value']:
-                transaction_value = current_status[currency]['value'] \
-                                    - target_value
-                transaction_value = round(transaction_value/min_transaction)*min_transaction
-                if transaction_value < min_transaction:
-                    if self.DEBUG:
-                        print 'MoneyMaker: Avoiding transaction bellow ' \
-                            + str(min_transaction)\
-                            + ' (send ' \
-                            + str(transaction_value) \
-                            + ' ' \
-                            + currency \
-                            + ')'
-                    continue
-                senders.append({
-                    'currency': currency,
-                    'value': transaction_value
-                })
-            elif target_value > current_status[currency]['value']:
-                transaction_value = target_value \
-                                    - current_status[currency]['value']
-                transaction_value = round(transaction_value/min_transaction)*min_transaction
-                if transaction_value < min_transaction:
-                    if self.DEBUG:
-                        print 'MoneyMaker: Avoiding transaction bellow ' \
-                            + str(min_transaction)\
-                            + ' (receive ' \
-                            + str(transaction_value) \
-                            + ' ' \
-                            + currency \
-                            + ')'
-                    continue
-                receivers.append({ 
-                        'currency': currency, 
-                        'value': transaction_value
-                })
-
-        # Calculate the necessary transactions
-        transactions = []
-
-        while senders and receivers:
-            senders.sort(key=lambda currency: currency['value'], reverse=True)
-            receivers.sort(key=lambda currency: currency['value'], reverse=True)
-            sender = senders[0]
-            receiver = receivers[0]
-
-            amount_to_transfer = sender['value']
-            if amount_to_transfer >= receiver['value']:
-                amount_to_transfer = receiver['value']
-                transactions.append({
-                    'origin': sender['currency'],
-                    'destination': receiver['currency'],
-                    'amount': amount_to_transfer,
-                    'base_currency': self.base_currency
-                })
-                receivers.pop(0)
-                senders[0]['value'] -= amount_to_transfer
-                if senders[0]['value'] < self.currencies[sender['currency']]['min_transaction']:
-                    senders.pop(0)
-            else:
-                transactions.append({
-                    'origin': sender['currency'],
-                    'destination': receiver['currency'],
-                    'amount': amount_to_transfer,
-                    'base_currency': self.base_currency
-                })
-                senders.pop(0)
-                receivers[0]['value'] -= amount_to_transfer
-                if receivers[0]['value'] < self.currencies[receiver['currency']]['min_transaction']:
-                    receivers.pop(0)
+        senders, receivers = self.matching_engine.split( current_status, target_value )
+        transactions = self.matching_engine.match( senders, receivers )
+
+        self.round_trips_saved = 0
+        if self.planner:
+            planned = self.planner.plan( senders, receivers )
+            if len( planned ) < len( transactions ):
+                # Every transfer is two round trips: prepare and execute
+                self.round_trips_saved = 2 * ( len( transactions ) - len( planned ) )
+                transactions = planned
+            if self.DEBUG:
+                print 'MoneyMaker: The planner saved ' \
+                    + str(self.round_trips_saved) \
+                    + ' round trips to the broker'
+
+
+        if self.cross_rates:
+            routed = self.cross_rates.annotate( transactions )
+            if self.DEBUG:
+                print 'MoneyMaker: ' + str(routed) + ' transactions have a better route than the direct one'
 
 
         if self.DEBUG:
-            print "MoneyMaker: Transactions:"
-            pp.pprint( transactions )
+            metrics.dump( "MoneyMaker: Transactions:", transactions )
 
 
         return transactions
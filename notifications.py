@@ -4,39 +4,181 @@ Price Watcher notifications class -- it encapsulates the notification mechanisms
 At this time we are using Amazon SQS services (http://aws.amazon.com/sqs/) for this purpose, together with a SQS-to-XMPP gateway that we already had implmented.
 """
 
-import ConfigParser
-import boto3
+import threading
+import time
+
+from metrics import timed
+from settings import load_config
+from transport import Transport
 
 class Notifier(object):
     """
     Represents the notifier object
     """
 
-    def __init__( self, config_file ):
+    def __init__( self, config_file, queue=None ):
         """
         Create the Notifier object
 
         :param String config_file The path to a config file that ConfigParser can read and that has a "Notifier" section.
+        :param Object queue An object with boto3's SQS Queue interface to use instead of the real queue (e.g. a stand-in, for load tests)
         """
         self.version = 0
 
-        config = ConfigParser.ConfigParser()
-        config.read( config_file )
+        config = load_config( config_file )
 
-        self.session = boto3.session.Session(
-            aws_access_key_id=config.get('Notifier','aws_access_key_id'),
-            aws_secret_access_key=config.get('Notifier','aws_secret_access_key'),
-            region_name=config.get('Notifier','region_name'),
-        )
-        self.sqs = self.session.resource('sqs')
-        self.queue = self.sqs.get_queue_by_name(QueueName=config.get('Notifier','queue_name'))
+        self.session = None
+        self.sqs     = None
+        if queue is None:
+            import boto3
+            self.session = boto3.session.Session(
+                aws_access_key_id=config.get('Notifier','aws_access_key_id'),
+                aws_secret_access_key=config.get('Notifier','aws_secret_access_key'),
+                region_name=config.get('Notifier','region_name'),
+            )
+            self.sqs = self.session.resource('sqs')
+            queue = self.sqs.get_queue_by_name(QueueName=config.get('Notifier','queue_name'))
+        self.queue = queue
         self.recipient = config.get('Notifier','recipient_jid')
+        self.transport = Transport( 'notifier', config_file, 'Notifier' )
+
+        # Notifications are queued and sent in batches (SQS takes up to 10)
+        self.max_batch      = 10
+        self.batch_interval = 1.0
+        if config.has_option( 'Notifier', 'batch_interval' ):
+            self.batch_interval = float( config.get( 'Notifier', 'batch_interval' ))
+        self.condition = threading.Condition()
+        self.stopping  = False
+        self.pending   = []
+        self.stats     = {
+            'sent':               0,
+            'batches':            0,
+            'coalesced':          0,
+            'last_send_latency':  0.0,
+            'total_send_latency': 0.0,
+            'max_send_latency':   0.0,
+        }
+
+        self.thread = threading.Thread( target=self.__run__, name='Notifier' )
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def __body__( self, entry ):
+        """
+        Build the SQS message body for a (possibly coalesced) notification
+        """
+
+        body = 'Notify ' + self.recipient + ': price_watcher: ' + entry['message']
+        if entry['count'] > 1:
+            body += ' (x' + str(entry['count']) + ')'
+        return body
+
 
+    def __send__( self, entries ):
+        """
+        Send a batch of (up to 10) notifications to the queue.
+
+        :param List entries The notifications to send
+        """
+
+        started = time.time()
+        try:
+            response = self.transport.call( 'send_message_batch', lambda: self.queue.send_message_batch( Entries=[
+                { 'Id': str(i), 'MessageBody': self.__body__( entry ) }
+                for i, entry in enumerate( entries )
+            ]))
+            for failure in response.get( 'Failed', [] ):
+                print 'Notifier: Could not send ' + entries[int( failure['Id'] )]['message'] + ' (' + str(failure.get( 'Message' )) + ')'
+        except Exception as e:
+            print 'Notifier: Error sending ' + str(len( entries )) + ' notifications (' + str(e) + ')'
+        latency = time.time() - started
+
+        with self.condition:
+            self.stats['batches']            += 1
+            self.stats['sent']               += len( entries )
+            self.stats['last_send_latency']   = latency
+            self.stats['total_send_latency'] += latency
+            self.stats['max_send_latency']    = max( self.stats['max_send_latency'], latency )
 
 
-    def notify( self, message ):
+    def __run__( self ):
         """
-        Send a message to the recipient indicated in the config file
+        The sender thread: send a batch as soon as we have 10 notifications,
+        the oldest one has waited for batch_interval seconds or we are asked
+        to stop.
         """
-        
-        return self.queue.send_message( MessageBody='Notify ' + self.recipient + ': price_watcher: ' + message )
+
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopping:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                while not self.stopping and len( self.pending ) < self.max_batch:
+                    wait = self.pending[0]['queued_at'] + self.batch_interval - time.time()
+                    if wait <= 0:
+                        break
+                    self.condition.wait( wait )
+                entries = self.pending[:self.max_batch]
+                del self.pending[:self.max_batch]
+
+            self.__send__( entries )
+
+
+    @timed( 'notify' )
+    def notify( self, message, key=None ):
+        """
+        Queue a message to be sent to the recipient indicated in the config
+        file. Messages are sent in batches, from a background thread.
+
+        A message that is still waiting to go out absorbs any repeats of it
+        (or, if a key is given, any later message with the same key, which
+        replaces it) and goes out once, with the number of times it happened.
+
+        :param String message The message to send
+        :param String key What identifies repeats of this message (defaults to the message itself)
+        """
+
+        if key is None:
+            key = message
+
+        with self.condition:
+            for entry in self.pending:
+                if entry['key'] == key:
+                    entry['message'] = message
+                    entry['count']  += 1
+                    self.stats['coalesced'] += 1
+                    return
+            self.pending.append({
+                'key':       key,
+                'message':   message,
+                'count':     1,
+                'queued_at': time.time(),
+            })
+            self.condition.notify()
+
+
+    def metrics( self ):
+        """
+        Get the notification queue's metrics.
+
+        :rtype: A dictionary with the queue depth, the numbers of notifications sent, batches sent and notifications coalesced, and the last, total and maximum time (in seconds) spent sending a batch
+        """
+
+        with self.condition:
+            metrics = dict( self.stats )
+            metrics['queue_depth'] = len( self.pending )
+        return metrics
+
+
+    def close( self, timeout=30.0 ):
+        """
+        Send whatever is still queued and stop the sender thread, waiting for
+        it for up to `timeout` seconds.
+        """
+
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join( timeout )
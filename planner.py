@@ -0,0 +1,121 @@
+"""
+Price Watcher rebalancing planner -- it looks for the plan with the fewest transfers that takes a portfolio to its targets.
+
+Every transfer costs us two round trips to the broker (and a fee), so a plan with fewer of them is faster and cheaper to run.
+"""
+
+from matching import MatchingEngine
+
+class MinTransferPlanner(object):
+    """
+    Plans the transactions needed to rebalance a portfolio as a flow problem,
+    minimising the number of transfers.
+
+    Settling a group of currencies whose deltas add up to zero takes one
+    transfer less than the number of currencies in it, so the fewest
+    transfers come from splitting the currencies into as many zero-sum
+    groups as possible. Finding that split is exponential in the number of
+    currencies, so above `max_exact` currencies we fall back to the greedy
+    pairing of the `MatchingEngine`.
+    """
+
+    def __init__( self, currencies, base_currency, max_exact=14, DEBUG=False ):
+        """
+        Create the MinTransferPlanner
+
+        :param Dictionary currencies A dictionary with the following structure: { currency: { 'min_transaction': value } }
+        :param String base_currency The base currency identifier
+        :param Integer max_exact The largest number of senders plus receivers we will plan for exactly
+        :param Boolean DEBUG Debug level
+        """
+        self.version = 0
+
+        self.currencies    = currencies
+        self.base_currency = base_currency
+        self.max_exact     = max_exact
+        self.DEBUG         = DEBUG
+
+        self.matching_engine = MatchingEngine( currencies, base_currency, DEBUG )
+
+
+    def __zero_sum_groups__( self, units ):
+        """
+        Split a list of integer deltas into as many groups adding up to zero
+        as possible.
+
+        :param List units The deltas, in multiples of the base currency's min_transaction
+
+        :rtype: A list of groups, each a list of indexes into units. If the
+                deltas don't add up to zero, the last group holds the
+                leftovers.
+        """
+
+        n = len( units )
+        size = 1 << n
+        total = [0] * size
+        best  = [0] * size
+        last  = [0] * size
+
+        # best[mask] is the largest number of zero-sum groups we can make out
+        # of the items in mask, taking them in some order and closing a group
+        # every time the running total gets back to zero
+        for mask in xrange( 1, size ):
+            low = mask & -mask
+            total[mask] = total[mask ^ low] + units[low.bit_length() - 1]
+
+            groups = -1
+            remaining = mask
+            while remaining:
+                bit = remaining & -remaining
+                if best[mask ^ bit] > groups:
+                    groups = best[mask ^ bit]
+                    last[mask] = bit
+                remaining ^= bit
+            best[mask] = groups + ( total[mask] == 0 )
+
+        # Walk back from the full set to find the order the items were taken in
+        order = []
+        mask = size - 1
+        while mask:
+            order.append( last[mask].bit_length() - 1 )
+            mask ^= last[mask]
+        order.reverse()
+
+        groups = [[]]
+        running = 0
+        for index in order:
+            groups[-1].append( index )
+            running += units[index]
+            if running == 0:
+                groups.append( [] )
+        return [ group for group in groups if group ]
+
+
+    def plan( self, senders, receivers ):
+        """
+        Pair the senders with the receivers using as few transfers as we can.
+
+        :param List senders The currencies sending value (see `MatchingEngine.split`)
+        :param List receivers The currencies receiving value (see `MatchingEngine.split`)
+
+        :rtype: A list of transactions (see `MoneyMaker.shake`)
+        """
+
+        if not senders or not receivers or len( senders ) + len( receivers ) > self.max_exact:
+            return self.matching_engine.match( senders, receivers )
+
+        # The deltas are all rounded to the base currency's min_transaction,
+        # so we can look for groups that add up to exactly zero in integers
+        quantum = self.currencies[self.base_currency]['min_transaction']
+        items = [ ( item, 1 ) for item in senders ] + [ ( item, -1 ) for item in receivers ]
+        units = [ sign * int( round( item['value'] / quantum )) for item, sign in items ]
+
+        transactions = []
+        for group in self.__zero_sum_groups__( units ):
+            group.sort()
+            transactions.extend( self.matching_engine.match(
+                [ dict( items[index][0] ) for index in group if items[index][1] > 0 ],
+                [ dict( items[index][0] ) for index in group if items[index][1] < 0 ],
+            ))
+
+        return transactions
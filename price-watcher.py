@@ -1,16 +1,16 @@
 #!/bin/env python
 # coding=utf-8
 
-import ConfigParser
 import sys
-import pprint
 import os
+import signal
 import argparse
+import time
 from datetime import datetime
 
+started_at = time.time()
+
 sys.path.append('.')
-from broker import Broker
-from moneymaker import MoneyMaker
 
 
 ##############################################
@@ -30,6 +30,86 @@ parser.add_argument(
     help="analise but don't effect any change (implies debug)", 
     action="store_true"
 )
+parser.add_argument(
+    "--daemon",
+    help="keep running, rebalancing once every poll interval, until SIGTERM",
+    action="store_true"
+)
+parser.add_argument(
+    "--interval",
+    help="seconds between cycles in daemon mode (overrides poll_interval in the config)",
+    type=float
+)
+parser.add_argument(
+    "--backtest",
+    help="replay a history of rates (CSV or .npz) through the money maker instead of trading",
+    metavar="FILE"
+)
+parser.add_argument(
+    "--fee",
+    help="fee charged on each backtest transaction, as a fraction of its amount",
+    type=float,
+    default=0.0
+)
+parser.add_argument(
+    "--initial-value",
+    help="value (in base currency) of the backtest's initial portfolio",
+    type=float,
+    default=1000.0
+)
+parser.add_argument(
+    "--sweep",
+    help="backtest a grid of parameters over a history of rates (CSV or .npz), using every core",
+    metavar="FILE"
+)
+parser.add_argument(
+    "--thresholds",
+    help="comma separated rebalance thresholds for --sweep (defaults to the configured one)"
+)
+parser.add_argument(
+    "--min-scales",
+    help="comma separated factors to multiply every min_transaction by, for --sweep",
+    default="1"
+)
+parser.add_argument(
+    "--subset-size",
+    help="for --sweep, try every set of this many currencies instead of all of them",
+    type=int,
+    default=0
+)
+parser.add_argument(
+    "--output",
+    help="where --sweep writes its ranked results",
+    default="sweep.csv"
+)
+parser.add_argument(
+    "--fleet",
+    help="run every account with a config file (*.cfg) in this directory, sharing the ticker fetch",
+    metavar="DIR"
+)
+parser.add_argument(
+    "--workers",
+    help="how many accounts --fleet works on at the same time",
+    type=int,
+    default=8
+)
+parser.add_argument(
+    "--profile",
+    help="profile every cycle, with cProfile (cprofile, the default) or by sampling every thread's stack (sample, which also shows time spent waiting)",
+    nargs="?",
+    const="cprofile",
+    choices=[ "cprofile", "sample" ]
+)
+parser.add_argument(
+    "--profile-dir",
+    help="where --profile writes a profile (and the broker, record keeper and notifier times) per cycle",
+    default="profiles"
+)
+parser.add_argument(
+    "--timing",
+    help="report how long importing and setting up each component took",
+    action="store_true"
+)
 args = parser.parse_args()
 if args.debug:
     DEBUG = True
@@ -46,107 +126,90 @@ if DEBUG:
         print 'This is a dry-run. No change will be effected'
 
 
-# Setup pretty printing of data structures
-if DEBUG:
-    pp = pprint.PrettyPrinter()
-
-
-# Read in the configs
-Config = ConfigParser.ConfigParser()
-Config.read('./price-watcher.cfg')
-
-
-# Set up our currencies
-# TODO: kill this eval with extreme prejudice!
-base_currency = Config.get('Setup','base_currency')
-wanted_currencies = eval(Config.get('Setup','currencies'))
-
-if DEBUG:
-    print "Currencies I'm looking for:"
-    pp.pprint( wanted_currencies )
-
-
-# Set up the record keeper to store our history
-recorder = False
-if Config.has_section('RecordKeeper'):
-    from recordkeeper import RecordKeeper
-    recorder = RecordKeeper( './price-watcher.cfg' )
+# Backtests only need the money maker
+if args.backtest or args.sweep:
+    from settings import load_config
+    from moneymaker import MoneyMaker
+    from backtest import Backtester, load_rates, select_currencies
+
+    Config = load_config('./price-watcher.cfg')
+    # TODO: kill this eval with extreme prejudice!
+    base_currency = Config.get('Setup','base_currency')
+    wanted_currencies = eval(Config.get('Setup','currencies'))
+
+    money_maker = MoneyMaker( './price-watcher.cfg', base_currency, wanted_currencies )
+    currencies, rates = select_currencies(
+        *load_rates( args.backtest or args.sweep ),
+        wanted=wanted_currencies,
+        base_currency=base_currency
+    )
+
+    if args.sweep:
+        from sweep import ParameterSweep
+        thresholds = [ money_maker.rebalance_threshold ]
+        if args.thresholds:
+            thresholds = [ float( threshold ) for threshold in args.thresholds.split( ',' ) ]
+        min_scales = [ float( scale ) for scale in args.min_scales.split( ',' ) ]
+
+        sweep = ParameterSweep( './price-watcher.cfg', base_currency, wanted_currencies, args.fee, args.initial_value )
+        points = sweep.grid( currencies, thresholds, min_scales, args.subset_size )
+        print 'Sweeping ' + str(len( points )) + ' points over ' + str(len( rates )) + ' steps with ' + str(sweep.workers) + ' workers'
+        results = sweep.run( currencies, rates, points, args.output )
+        print 'Best: ' + str(results[0]['final_value']) + ' with threshold ' + str(results[0]['threshold']) \
+            + ', min_transaction x' + str(results[0]['min_scale']) + ' and ' + results[0]['currencies'] \
+            + ' (full results in ' + args.output + ')'
+        sys.exit(0)
+
+    results = Backtester( money_maker, args.fee ).run( currencies, rates, args.initial_value )
+
+    print 'Backtest of ' + ', '.join( currencies ) + ' over ' + str(results['steps']) + ' steps:'
+    for key in [ 'final_value', 'hold_value', 'turnover', 'fees', 'transactions', 'rebalances' ]:
+        print '    ' + key + ': ' + str(results[key])
+    sys.exit(0)
 
 
-# Set up the broker object for dealing with the money
-broker = Broker( 
-    './price-watcher.cfg', 
-    wanted_currencies, 
-    base_currency, 
-    DEBUG 
-)
+# Set up everything we need (this is the expensive bit, so it's done only once)
+setup_at = time.time()
+profiler = None
+if args.profile:
+    from profiler import Profiler
+    profiler = Profiler( args.profile_dir, args.profile, DEBUG=DEBUG )
+if args.fleet:
+    from fleet import Fleet
+    watcher = Fleet( args.fleet, DEBUG, dry_run, args.workers, profiler )
+else:
+    from watcher import PriceWatcher
+    watcher = PriceWatcher( './price-watcher.cfg', DEBUG, dry_run, profiler=profiler )
+ready_at = time.time()
 
-current_portfolio = broker.get_portfolio()
-if DEBUG:
-    print "Current portfolio:"
-    pp.pprint( current_portfolio )
-
-
-# Find the new currency equilibrium
-money_maker = MoneyMaker(
-    './price-watcher.cfg', 
-    base_currency, 
-    wanted_currencies, 
-    DEBUG 
-)
-transactions = money_maker.shake( current_portfolio )
-
-
-# Get the notifier ready
-notifier = False
-if Config.has_section('Notifier'):
-    from notifications import Notifier
-    notifier = Notifier('./price-watcher.cfg')
-
-
-# No transactions were deemed necessary
-if not transactions:
-    if DEBUG:
-        if notifier:
-            notifier.notify(
-              'No change needed in portfolio -- ' \
-              + str(
-                money_maker.__calculate_portfolio_value__(current_portfolio)
-              )
-            )
-        print "Done!"
-    sys.exit(0)
 
+if args.daemon:
+    # Stop gracefully, after the current cycle, when we are asked to
+    def shutdown( signum, frame ):
+        if DEBUG:
+            print 'Got signal ' + str(signum) + ', shutting down'
+        watcher.stop()
+    signal.signal( signal.SIGTERM, shutdown )
+    signal.signal( signal.SIGINT, shutdown )
 
-# Let's run those transactions
-if DEBUG:
-    print "Transactions to run:"
-    pp.pprint( transactions )
-
-if not dry_run:
-    broker.run_transactions( transactions )
-    if recorder:
-        # Record the original portfolio
-        recorder.write_portfolio( 
-            current_portfolio, 
-            money_maker.__calculate_portfolio_value__( current_portfolio )
-        )
-        # Record the new portfolio
-        new_portfolio = broker.get_portfolio()
-        recorder.write_portfolio( 
-            new_portfolio, 
-            money_maker.__calculate_portfolio_value__( new_portfolio )
-        )
-        # Record the transactions that were carried out
-        recorder.write_transactions( transactions )
-
-    if notifier:
-        notifier.notify( 
-            'Done rebalancing portfolio. New value: ' \
-            + str(money_maker.__calculate_portfolio_value__( new_portfolio )) \
-            + ' ' \
-            + base_currency 
-        )
+    watcher.run_forever( args.interval )
+else:
+    watcher.run_cycle()
+
+watcher.close()
+
+
+if args.timing:
+    print 'Timing (seconds):'
+    print '    script startup: %.3f' % ( setup_at - started_at )
+    print '    setup: %.3f' % ( ready_at - setup_at )
+    accounts = watcher.watchers if args.fleet else [ ( None, watcher ) ]
+    for name, account in accounts:
+        for component, timing in sorted( account.timings.items() ):
+            print '    ' + ( name + ' ' if name else '' ) + component \
+                + ': import %.3f, init %.3f' % ( timing['import'], timing['init'] )
+        for component, error in sorted( account.failures.items() ):
+            print '    ' + ( name + ' ' if name else '' ) + component + ': failed (' + error + ')'
 
 
 if DEBUG:
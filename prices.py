@@ -0,0 +1,291 @@
+"""
+Price Watcher prices -- where our tickers come from. Several sources (the broker's own ticker, a local file feed, HTTP feeds) can be asked at the same time; whichever answer within their deadline are merged, pair by pair, into the median ask and bid.
+
+Every source answers in the broker's ticker format: a list of { 'pair': 'BTCUSD', 'ask': '250.1', 'bid': '249.9', 'currency': 'USD' }, or a dictionary with that list in 'tickers' and the time (seconds since the epoch) the prices are from in 'time'.
+"""
+
+import json
+import os
+import Queue
+import threading
+import time
+import urllib2
+from multiprocessing.pool import ThreadPool
+
+from metrics import metrics
+from settings import load_config
+
+class NoPricesError(Exception):
+    """
+    Raised when none of the sources answered in time
+    """
+    pass
+
+
+def median( values ):
+    values = sorted( values )
+    middle = len( values ) // 2
+    if len( values ) % 2:
+        return values[middle]
+    return ( values[middle - 1] + values[middle] ) / 2.0
+
+
+def unpack( answer, default_time ):
+    """
+    :rtype: A tuple with a source's tickers and the time they are from
+    """
+
+    if isinstance( answer, dict ):
+        return answer['tickers'], float( answer.get( 'time', default_time ))
+    return answer, default_time
+
+
+class BrokerSource(object):
+    """
+    The broker's own ticker (see `Broker`)
+    """
+
+    def __init__( self, name, broker, deadline ):
+        self.name     = name
+        self.broker   = broker
+        self.deadline = deadline
+        self.max_age  = None
+
+    def fetch( self ):
+        return self.broker.transport.call( 'get_ticker', self.broker.api.get_ticker ), time.time()
+
+
+class FileSource(object):
+    """
+    A file someone else keeps up to date, read again whenever it changes;
+    its prices are as old as the file, unless it says otherwise
+    """
+
+    def __init__( self, name, path, deadline, max_age=None ):
+        self.name     = name
+        self.path     = path
+        self.deadline = deadline
+        self.max_age  = max_age
+        self.read_at  = None
+        self.tickers  = None
+
+    def fetch( self ):
+        modified = os.path.getmtime( self.path )
+        if modified != self.read_at:
+            with open( self.path ) as feed:
+                self.tickers = unpack( json.load( feed ), modified )
+            self.read_at = modified
+        return self.tickers
+
+
+class HTTPSource(object):
+    """
+    A JSON feed over HTTP; its prices are as old as the feed says, or fresh
+    """
+
+    def __init__( self, name, url, deadline, max_age=None ):
+        self.name     = name
+        self.url      = url
+        self.deadline = deadline
+        self.max_age  = max_age
+
+    def fetch( self ):
+        response = urllib2.urlopen( self.url, timeout=self.deadline )
+        try:
+            return unpack( json.load( response ), time.time() )
+        finally:
+            response.close()
+
+
+class PriceSources(object):
+    """
+    Represents the sources we get our tickers from
+    """
+
+    def __init__( self, config_file, broker, DEBUG=False ):
+        """
+        Create the PriceSources
+
+        :param String config_file The path to a config file that ConfigParser can read and that has a "Prices" section listing the sources (sources: name, name...) and a "Prices <name>" section for each one, with its type (broker, file or http), its path or url, its deadline (seconds) and, optionally, the max_age (seconds) of the prices we take from it
+        :param Broker broker The broker, for the sources of type broker
+        :param Boolean DEBUG Debug level
+        """
+        self.version = 0
+
+        config = load_config( config_file )
+
+        self.DEBUG   = DEBUG
+        self.sources = []
+        for name in [ name.strip() for name in config.get( 'Prices', 'sources' ).split( ',' ) if name.strip() ]:
+            section = 'Prices ' + name
+            kind = config.get( section, 'type' )
+            deadline = 2.0
+            if config.has_option( section, 'deadline' ):
+                deadline = float( config.get( section, 'deadline' ))
+            max_age = None
+            if config.has_option( section, 'max_age' ):
+                max_age = float( config.get( section, 'max_age' ))
+
+            if kind == 'broker':
+                source = BrokerSource( name, broker, deadline )
+            elif kind == 'file':
+                source = FileSource( name, config.get( section, 'path' ), deadline, max_age )
+            elif kind == 'http':
+                source = HTTPSource( name, config.get( section, 'url' ), deadline, max_age )
+            else:
+                raise ValueError( 'PriceSources: Unknown type of source ' + kind + ' for ' + name )
+            self.sources.append( source )
+
+        self.pool   = ThreadPool( len( self.sources ))
+        self.busy   = set()
+        self.report = {}
+
+
+    def __fetch__( self, source, answers, started ):
+        """
+        Ask one source for its tickers (on the pool) and hand its answer over
+        """
+
+        try:
+            tickers, as_of = source.fetch()
+            answer = ( source, tickers, as_of, None, time.time() - started )
+        except Exception as e:
+            answer = ( source, None, None, e, time.time() - started )
+        self.busy.discard( source.name )
+        answers.put( answer )
+
+
+    def __collect__( self ):
+        """
+        Ask every source (but those still busy with an earlier request) at the
+        same time and wait for their answers, each until its deadline.
+
+        :rtype: A list of ( source, tickers ) for the sources that answered in time with fresh enough prices
+        """
+
+        started = time.time()
+        answers = Queue.Queue()
+        pending = {}
+        report  = {}
+        for source in self.sources:
+            if source.name in self.busy:
+                report[source.name] = { 'status': 'busy' }
+                continue
+            self.busy.add( source.name )
+            pending[source.name] = source
+            self.pool.apply_async( self.__fetch__, ( source, answers, started ))
+
+        # Python 2's timed waits poll, so rather than waiting with a timeout
+        # we have a timer drop a marker in the queue once time is up
+        timer = None
+        if pending:
+            timer = threading.Timer( max( source.deadline for source in pending.values() ), answers.put, ( None, ))
+            timer.daemon = True
+            timer.start()
+
+        answered = []
+        while pending:
+            answer = answers.get()
+            if answer is None:
+                break
+            source, tickers, as_of, error, latency = answer
+            del pending[source.name]
+
+            metrics.observe( 'price_source_latency_seconds', latency, { 'source': source.name } )
+            if error is not None:
+                report[source.name] = { 'status': 'failed', 'latency': latency, 'error': str(error) }
+                continue
+            if latency > source.deadline:
+                report[source.name] = { 'status': 'late', 'latency': latency }
+                continue
+            age = max( time.time() - as_of, 0.0 )
+            metrics.observe( 'price_source_staleness_seconds', age, { 'source': source.name } )
+            if source.max_age is not None and age > source.max_age:
+                report[source.name] = { 'status': 'stale', 'latency': latency, 'staleness': age }
+                continue
+            report[source.name] = { 'status': 'ok', 'latency': latency, 'staleness': age }
+            answered.append( ( source, tickers ))
+
+        if timer is not None:
+            timer.cancel()
+
+        # Whoever is still out there is late, and stays busy until it answers
+        for name in pending:
+            report[name] = { 'status': 'late' }
+
+        for name, entry in report.items():
+            if entry['status'] != 'ok':
+                metrics.increment( 'price_source_misses', { 'source': name, 'status': entry['status'] } )
+        self.report = report
+        if self.DEBUG:
+            print 'PriceSources: ' + ', '.join(
+                name + ' ' + entry['status'] + ( ' in %.3fs' % entry['latency'] if 'latency' in entry else '' )
+                for name, entry in sorted( report.items() ))
+        return answered
+
+
+    def merge( self, answers ):
+        """
+        Merge the sources' tickers pair by pair: each pair's ask and bid are
+        the medians of those of the sources that have it (turned around to
+        the same direction, when they tell which is the quoted currency).
+
+        :param List answers A list of ( source, tickers ) (see `__collect__`)
+
+        :rtype: A list of tickers, in the broker's format
+        """
+
+        if len( answers ) == 1:
+            return answers[0][1]
+
+        merged = {}
+        order  = []
+        for source, tickers in answers:
+            # A source quoting a pair both ways only gets one say in it
+            seen = set()
+            for ticker in tickers:
+                pair, currency = ticker['pair'], ticker.get( 'currency' )
+                ask, bid = float( ticker['ask'] ), float( ticker['bid'] )
+                if currency and pair.endswith( currency ):
+                    reverse = currency + pair[:-len( currency )]
+                    if reverse in merged and pair not in merged:
+                        pair, currency = reverse, pair[:-len( currency )]
+                        ask, bid = 1.0 / bid, 1.0 / ask
+                if pair in seen:
+                    continue
+                seen.add( pair )
+                if pair not in merged:
+                    merged[pair] = { 'currency': currency, 'asks': [], 'bids': [] }
+                    order.append( pair )
+                merged[pair]['asks'].append( ask )
+                merged[pair]['bids'].append( bid )
+
+        tickers = []
+        for pair in order:
+            ticker = { 'pair': pair, 'ask': median( merged[pair]['asks'] ), 'bid': median( merged[pair]['bids'] ) }
+            if merged[pair]['currency']:
+                ticker['currency'] = merged[pair]['currency']
+            tickers.append( ticker )
+        return tickers
+
+
+    def fetch( self ):
+        """
+        Get the tickers from every source that answers in time.
+
+        :rtype: A list of tickers, in the broker's format (see `merge`)
+        """
+
+        answers = self.__collect__()
+        if not answers:
+            raise NoPricesError( 'No prices from any source in time: ' + ', '.join(
+                name + ' ' + entry['status'] for name, entry in sorted( self.report.items() )))
+        return self.merge( answers )
+
+
+    def close( self ):
+        """
+        Stop the pool the sources are asked on (without waiting for any late ones)
+        """
+
+        self.pool.close()
@@ -0,0 +1,260 @@
+"""
+Price Watcher profiler -- it profiles rebalance cycles, one output file per cycle, and splits the time spent in the broker, the record keeper and the notifier into CPU time and time blocked (on the network, mostly).
+
+Two kinds of profiles can be taken:
+
+- 'cprofile': Python's deterministic profiler, written in pstats format (see the `pstats` module, or snakeviz, gprof2dot...). cProfile only sees the thread it runs on, so it is run on the thread that starts the cycle and on those running the cycles nested in it (a fleet's accounts), and their profiles are added up; the threads the components start of their own (the broker's quotes, the notifier's deliveries) are left out.
+- 'sample': the stacks of every thread, sampled from a background thread every few milliseconds, written as collapsed stacks (for flamegraph.pl, speedscope, ...). As threads waiting on the network are sampled too, this shows where the wall clock time goes, not only the CPU's.
+"""
+
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+
+# getrusage can tell us about the calling thread alone on Linux
+RUSAGE_THREAD = getattr( resource, 'RUSAGE_THREAD', 1 if sys.platform.startswith( 'linux' ) else resource.RUSAGE_SELF )
+
+def thread_cpu_time():
+    """
+    :rtype: The CPU time (user and system, in seconds) used so far by the calling thread (or, where that can't be told, the whole process)
+    """
+
+    usage = resource.getrusage( RUSAGE_THREAD )
+    return usage.ru_utime + usage.ru_stime
+
+
+class ComponentProxy(object):
+    """
+    Stands in front of a component (e.g. the broker), timing every call
+    made to its methods, in wall clock and in CPU time.
+
+    Only the calls coming from outside go through it: whatever a method
+    calls on its own object, or runs on other threads, counts as part of
+    that method's wall time only.
+    """
+
+    def __init__( self, profiler, component, target ):
+        object.__setattr__( self, 'profiler', profiler )
+        object.__setattr__( self, 'component', component )
+        object.__setattr__( self, 'target', target )
+
+    def __getattr__( self, name ):
+        value = getattr( self.target, name )
+        if not callable( value ):
+            return value
+
+        def timed( *args, **kwargs ):
+            started, cpu_started = time.time(), thread_cpu_time()
+            try:
+                return value( *args, **kwargs )
+            finally:
+                self.profiler.record( self.component, time.time() - started, thread_cpu_time() - cpu_started )
+        return timed
+
+    def __setattr__( self, name, value ):
+        setattr( self.target, name, value )
+
+
+class Profiler(object):
+    """
+    Represents the profiling of the rebalance cycles
+    """
+
+    def __init__( self, output_dir, mode='cprofile', interval=0.005, DEBUG=False ):
+        """
+        Create the Profiler
+
+        :param String output_dir Where to write the profiles (it is created if need be)
+        :param String mode 'cprofile' or 'sample' (see above)
+        :param Number interval Seconds between two samples, in 'sample' mode
+        :param Boolean DEBUG Debug level
+        """
+        self.version = 0
+
+        if mode not in ( 'cprofile', 'sample' ):
+            raise ValueError( 'Profiler: Unknown mode ' + mode )
+
+        self.output_dir = output_dir
+        self.mode       = mode
+        self.interval   = interval
+        self.DEBUG      = DEBUG
+
+        if not os.path.isdir( output_dir ):
+            os.makedirs( output_dir )
+
+        self.lock       = threading.Lock()
+        self.active     = False
+        self.cycles     = 0
+        self.components = {}
+        self.notes      = {}
+        self.samples    = {}
+        self.thread     = None
+        self.profiles   = []
+
+
+    def wrap( self, component, target ):
+        """
+        :param String component The component's name, e.g. 'broker'
+        :param Object target The component
+
+        :rtype: The component, behind a proxy that times the calls made to it
+        """
+
+        # Components whose calls only hand the work over to a thread of
+        # their own say so, for the reports
+        note = getattr( target, 'profile_note', None )
+        if note:
+            with self.lock:
+                self.notes[component] = note
+        return ComponentProxy( self, component, target )
+
+
+    def record( self, component, wall, cpu ):
+        """
+        Account for one call to a component (see `ComponentProxy`)
+        """
+
+        with self.lock:
+            if not self.active:
+                return
+            times = self.components.setdefault( component, { 'calls': 0, 'wall': 0.0, 'cpu': 0.0 } )
+            times['calls'] += 1
+            times['wall']  += wall
+            times['cpu']   += cpu
+
+
+    def __frame_name__( self, frame ):
+        code = frame.f_code
+        return code.co_name + ' (' + os.path.basename( code.co_filename ) + ':' + str(code.co_firstlineno) + ')'
+
+
+    def __sample__( self, stop ):
+        """
+        The sampler thread: take the stacks of every other thread until asked to stop
+        """
+
+        me = threading.current_thread().ident
+        while not stop.wait( self.interval ):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append( self.__frame_name__( frame ))
+                    frame = frame.f_back
+                key = ';'.join( reversed( stack ))
+                self.samples[key] = self.samples.get( key, 0 ) + 1
+
+
+    @contextlib.contextmanager
+    def cycle( self, label='cycle' ):
+        """
+        Profile a block of code (a cycle), as in `with profiler.cycle():`,
+        and write its profile once it's done. A cycle started while another
+        one is being profiled (e.g. an account's, within a fleet's) is part
+        of that one; in 'cprofile' mode, it is profiled on its own thread and
+        added to it.
+
+        :param String label What the output files are named after
+        """
+
+        with self.lock:
+            nested = self.active
+            if not nested:
+                self.active     = True
+                self.components = {}
+                self.samples    = {}
+                self.thread     = threading.current_thread().ident
+                self.profiles   = []
+                self.cycles    += 1
+                number = self.cycles
+        if nested:
+            with self.__thread_profile__():
+                yield
+            return
+
+        profile = stop = sampler = None
+        if self.mode == 'cprofile':
+            profile = cProfile.Profile()
+            profile.enable()
+        else:
+            stop = threading.Event()
+            sampler = threading.Thread( target=self.__sample__, args=( stop, ), name='Profiler' )
+            sampler.daemon = True
+            sampler.start()
+
+        started, cpu_started = time.time(), time.clock()
+        try:
+            yield
+        finally:
+            wall, cpu = time.time() - started, time.clock() - cpu_started
+            if profile:
+                profile.disable()
+            else:
+                stop.set()
+                sampler.join()
+            with self.lock:
+                self.active = False
+            self.__write__( label, number, profile, wall, cpu )
+
+
+    @contextlib.contextmanager
+    def __thread_profile__( self ):
+        """
+        Profile a nested cycle running on a thread of its own (see `cycle`)
+        """
+
+        if self.mode != 'cprofile' or threading.current_thread().ident == self.thread:
+            yield
+            return
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self.lock:
+                self.profiles.append( profile )
+
+
+    def __write__( self, label, number, profile, wall, cpu ):
+        """
+        Write out a cycle's profile and its components' times
+        """
+
+        path = os.path.join( self.output_dir, label + '-' + '%04d' % number )
+        if profile:
+            with self.lock:
+                profiles, self.profiles = self.profiles, []
+            stats = pstats.Stats( profile )
+            for other in profiles:
+                stats.add( other )
+            stats.dump_stats( path + '.pstats' )
+        else:
+            with open( path + '.folded', 'w' ) as folded:
+                for stack, count in sorted( self.samples.items() ):
+                    folded.write( stack + ' ' + str(count) + '\n' )
+
+        report = { 'wall': wall, 'cpu': cpu, 'components': {}, 'notes': {} }
+        for component, times in self.components.items():
+            report['components'][component] = dict( times, blocked=max( times['wall'] - times['cpu'], 0.0 ))
+        if 'notifier' in report['components']:
+            report['notes']['notifier'] = 'The time to queue the notifications only: they are delivered on the notifier\'s own thread'
+        for component, note in self.notes.items():
+            if component in report['components']:
+                report['notes'][component] = note
+        with open( path + '.json', 'w' ) as report_file:
+            json.dump( report, report_file, indent=2, sort_keys=True )
+
+        if self.DEBUG:
+            print 'Profiler: ' + label + ' ' + str(number) + ' took %.3fs (%.3fs of CPU), written to %s.*' % ( wall, cpu, path )
+            for component, times in sorted( report['components'].items() ):
+                print '    %-10s %4d calls, %.3fs: %.3fs CPU, %.3fs blocked' % (
+                    component, times['calls'], times['wall'], times['cpu'], times['blocked'] )
@@ -0,0 +1,186 @@
+"""
+Price Watcher rate limiter -- token buckets that keep us under the broker's rate limits, shared by every thread and every process (e.g. several price watchers, or a fleet and a backtest) through a small state file locked with fcntl.
+
+The calls are split in classes (ticker, me, cards and transactions). They all draw from one overall bucket, and each class can have a bucket of its own too. Part of the overall bucket is held back for transactions, so when we run short it is the polling that slows down, not the trading.
+"""
+
+import fcntl
+import json
+import os
+import threading
+import time
+
+from metrics import metrics
+from settings import load_config
+
+# The class of each of the broker's calls
+ENDPOINT_CLASSES = {
+    'get_ticker':  'ticker',
+    'get_me':      'me',
+    'get_cards':   'cards',
+    'prepare_txn': 'transactions',
+    'execute_txn': 'transactions',
+}
+
+class RateLimitedError(Exception):
+    """
+    Raised when a call would have to wait longer than max_wait for its turn
+    """
+    pass
+
+
+class RateLimiter(object):
+    """
+    Represents our share of the broker's rate limits
+    """
+
+    def __init__( self, config_file, section='RateLimit', DEBUG=False ):
+        """
+        Create the RateLimiter
+
+        :param String config_file The path to a config file that ConfigParser can read and that has a "RateLimit" section with:
+            state_file: the file the buckets are kept in (everyone sharing it shares the limits)
+            rate, burst: the overall calls per second and how many can go at once
+            reserve: how many of those are held back for transactions
+            rate_<class>, burst_<class>: a class's own limits, if it has any
+            max_wait: the longest (in seconds) a call waits for its turn
+        :param String section The config section to read
+        :param Boolean DEBUG Debug level
+        """
+        self.version = 0
+
+        config = load_config( config_file )
+
+        def option( name, default ):
+            if config.has_option( section, name ):
+                return float( config.get( section, name ))
+            return default
+
+        self.state_file = config.get( section, 'state_file' )
+        self.max_wait   = option( 'max_wait', 30.0 )
+        self.priority   = set([ 'transactions' ])
+        self.DEBUG      = DEBUG
+
+        # The overall bucket, and those of the classes that have their own
+        self.buckets = { 'all': { 'rate': option( 'rate', 5.0 ), 'burst': option( 'burst', 10.0 ) } }
+        # Polling must still be able to get a token once the bucket is full
+        self.reserve = min( option( 'reserve', 2.0 ), self.buckets['all']['burst'] - 1.0 )
+        for name in set( ENDPOINT_CLASSES.values() ):
+            if config.has_option( section, 'rate_' + name ):
+                rate = option( 'rate_' + name, 0.0 )
+                self.buckets[name] = { 'rate': rate, 'burst': option( 'burst_' + name, max( rate, 1.0 )) }
+
+        self.lock = threading.Lock()
+        self.fd   = os.open( self.state_file, os.O_RDWR | os.O_CREAT, 0644 )
+        self.stats = { 'calls': 0, 'waits': 0, 'waited': 0.0 }
+
+
+    def __read__( self, now ):
+        """
+        Read the buckets from the state file, filled up with what they have
+        earned since they were last written. Buckets missing from it start
+        full.
+
+        :rtype: A dictionary with the tokens in each bucket
+        """
+
+        os.lseek( self.fd, 0, os.SEEK_SET )
+        data = os.read( self.fd, 65536 )
+        try:
+            state = json.loads( data ) if data else {}
+        except ValueError:
+            state = {}
+
+        tokens = {}
+        for name, bucket in self.buckets.items():
+            if name in state:
+                available, updated = state[name]
+                available += max( now - updated, 0.0 ) * bucket['rate']
+            else:
+                available = bucket['burst']
+            tokens[name] = min( available, bucket['burst'] )
+        return tokens
+
+
+    def __write__( self, tokens, now ):
+        data = json.dumps( dict( ( name, [ available, now ] ) for name, available in tokens.items() ))
+        os.lseek( self.fd, 0, os.SEEK_SET )
+        os.ftruncate( self.fd, 0 )
+        os.write( self.fd, data )
+
+
+    def __take__( self, name ):
+        """
+        Take a token for a call of the given class, if there is one.
+
+        :rtype: 0 if we got it, otherwise how many seconds until there should be one
+        """
+
+        keep = 0.0 if name in self.priority else self.reserve
+        with self.lock:
+            fcntl.flock( self.fd, fcntl.LOCK_EX )
+            try:
+                now = time.time()
+                tokens = self.__read__( now )
+
+                wait = 0.0
+                needed = { 'all': keep + 1.0 }
+                if name in self.buckets:
+                    needed[name] = 1.0
+                for bucket, amount in needed.items():
+                    if tokens[bucket] < amount:
+                        rate = self.buckets[bucket]['rate']
+                        wait = max( wait, ( amount - tokens[bucket] ) / rate if rate else self.max_wait + 1.0 )
+
+                if wait == 0.0:
+                    for bucket in needed:
+                        tokens[bucket] -= 1.0
+                    self.__write__( tokens, now )
+                return wait
+            finally:
+                fcntl.flock( self.fd, fcntl.LOCK_UN )
+
+
+    def acquire( self, endpoint ):
+        """
+        Wait for our turn to make a call to the broker.
+
+        :param String endpoint The call, e.g. 'get_ticker' (see `ENDPOINT_CLASSES`; calls without a class only count against the overall limit)
+
+        :rtype: The seconds we had to wait. A `RateLimitedError` is raised instead if it would be longer than max_wait.
+        """
+
+        name = ENDPOINT_CLASSES.get( endpoint, endpoint )
+        started = time.time()
+        waited = False
+        while True:
+            wait = self.__take__( name )
+            if not wait:
+                break
+            if time.time() + wait - started > self.max_wait:
+                raise RateLimitedError( 'No turn for ' + endpoint + ' within ' + str(self.max_wait) + ' seconds' )
+            if not waited:
+                waited = True
+                metrics.increment( 'rate_limited', { 'class': name } )
+                if self.DEBUG:
+                    print 'RateLimiter: Waiting ' + ( '%.3f' % wait ) + 's for ' + endpoint
+            time.sleep( wait )
+
+        elapsed = time.time() - started
+        with self.lock:
+            self.stats['calls'] += 1
+            if waited:
+                self.stats['waits']  += 1
+                self.stats['waited'] += elapsed
+        return elapsed
+
+
+    def close( self ):
+        """
+        Let go of the state file
+        """
+
+        with self.lock:
+            if self.fd is not None:
+                os.close( self.fd )
+                self.fd = None
@@ -4,52 +4,250 @@ Price Watcher recordkeeper class -- it encapsulates the system used to maintain
 At this time we are using Google Spresdsheets for this, with the help of the gspread module (https://github.com/burnash/gspread).
 """
 
-import ConfigParser
-import gspread
 import json
-import time
-from oauth2client.client import SignedJwtAssertionCredentials
 from datetime import datetime
 
+from metrics import metrics, timed
+from settings import load_config
+from transport import CircuitOpenError, Transport
+
+def transaction_rows( transactions, date ):
+    """
+    Build the rows that record a list of transactions in the transactions
+    worksheet (see `RecordKeeper.write_transactions`).
+
+    :rtype: A list of rows, each a list of cell values
+    """
+
+    rows = []
+    for t in transactions:
+        rows.append( [ date ] + [ t[key] for key in [ 'origin', 'destination', 'amount', 'base_currency' ] ] )
+    return rows
+
+
+def portfolio_rows( portfolio, total_value, date ):
+    """
+    Build the rows that record a portfolio, and its total value, in the
+    portfolios worksheet (see `RecordKeeper.write_portfolio`).
+
+    :rtype: A list of rows, each a list of cell values
+    """
+
+    rows = []
+    for currency,data in portfolio.items():
+        if currency == 'TOTAL':
+            continue
+        rows.append( [ date, currency, data['amount'], data['value'] ] )
+    rows.append( [ date, 'TOTAL', '', total_value ] )
+    return rows
+
+
 class RecordKeeper(object):
     """
     Represents our record
     """
 
-    def __init__( self, config_file ):
+    def __init__( self, config_file, spreadsheet=None ):
         """
         Create the RecordKeeper object
 
         :param String config_file The path to a config file that ConfigParser can read and has both a "RecordKeeper" and a "Google" section.
+        :param Object spreadsheet An object with gspread's Spreadsheet interface to use instead of opening the real one (e.g. a stand-in, for benchmarks)
         """
         self.version = 0
 
-        config = ConfigParser.ConfigParser()
-        config.read( config_file )
+        config = load_config( config_file )
+
+        self.credentials = None
+        self.gc          = None
+        if spreadsheet is None:
+            import gspread
+            from oauth2client.client import SignedJwtAssertionCredentials
 
-        # Get the credentials for OAuth 2 authentication
-        json_key = json.load(open(config.get('RecordKeeper','google_api_credentials_file')))
-        scope = ['https://spreadsheets.google.com/feeds']
-        credentials = SignedJwtAssertionCredentials(json_key['client_email'], json_key['private_key'], scope)
+            # Get the credentials for OAuth 2 authentication
+            json_key = json.load(open(config.get('RecordKeeper','google_api_credentials_file')))
+            scope = ['https://spreadsheets.google.com/feeds']
+            self.credentials = SignedJwtAssertionCredentials(json_key['client_email'], json_key['private_key'], scope)
 
-        # Authenticate and get the worksheets
-        gc = gspread.authorize(credentials)
-        ss = gc.open(config.get('RecordKeeper','spreadsheet_name'))
-        self.worksheet_transactions = ss.worksheet(config.get('RecordKeeper','worksheet_transactions'))
-        self.worksheet_portfolios = ss.worksheet(config.get('RecordKeeper','worksheet_portfolios'))
+            # Authenticate and get the worksheets
+            self.gc = gspread.authorize(self.credentials)
+            spreadsheet = self.gc.open(config.get('RecordKeeper','spreadsheet_name'))
+        self.spreadsheet = spreadsheet
+        self.worksheet_titles = {
+            'transactions': config.get('RecordKeeper','worksheet_transactions'),
+            'portfolios':   config.get('RecordKeeper','worksheet_portfolios'),
+        }
 
         self.max_retries = int( config.get( 'RecordKeeper','max_retries' ))
 
+        # Calls to the spreadsheet have timeouts and a circuit breaker; they
+        # aren't retried one by one, as whole writes are (see `__write_with_retries__`)
+        self.transport = Transport( 'recorder', config_file, 'RecordKeeper', {
+            'col_values':   { 'retries': 0 },
+            'range':        { 'retries': 0 },
+            'update_cells': { 'retries': 0 },
+        })
+        if self.gc is not None:
+            self.transport.pool( getattr( self.gc, 'session', None ))
+
+        # We keep count of the rows we write ourselves, and only check it
+        # against the worksheet every row_check_every writes
+        self.row_check_every = 20
+        if config.has_option( 'RecordKeeper', 'row_check_every' ):
+            self.row_check_every = int( config.get( 'RecordKeeper', 'row_check_every' ))
+        self.next_rows  = {}
+        self.row_checks = {}
+
+        # Once a worksheet has max_rows rows we carry on in a new, dated, one
+        self.max_rows = 0
+        if config.has_option( 'RecordKeeper', 'max_rows' ):
+            self.max_rows = int( config.get( 'RecordKeeper', 'max_rows' ))
+
+        titles = []
+        if self.max_rows:
+            titles = [ worksheet.title for worksheet in self.spreadsheet.worksheets() ]
+        for which, title in self.worksheet_titles.items():
+            # Pick up where we left off: the most recent of the rolled over worksheets
+            rolled_over = sorted( t for t in titles if t.startswith( title + ' ' ))
+            if rolled_over:
+                title = rolled_over[-1]
+            setattr( self, 'worksheet_' + which, self.spreadsheet.worksheet( title ))
+
+
+    def refresh( self ):
+        """
+        Get a new OAuth 2 access token if the one we have has expired (they
+        only last for an hour, which a long-running process will outlive).
+        """
+
+        if self.credentials and self.credentials.access_token_expired:
+            self.gc.login()
+
+
+    def get_working_row( self, which ):
+        """
+        Calculate the working row (the first empty one) for a worksheet.
+
+        Going through the worksheet's first column gets slower as it grows,
+        so we only do it every row_check_every calls and count the rows we
+        write in between.
+
+        :param String which The worksheet: 'transactions' or 'portfolios'
+        """
+
+        if which in self.next_rows and self.row_checks[which] < self.row_check_every:
+            self.row_checks[which] += 1
+            return self.next_rows[which]
+
+        all_rows = self.transport.call( 'col_values', getattr( self, 'worksheet_' + which ).col_values, 1 )
+        self.next_rows[which]  = len( all_rows ) + 1
+        self.row_checks[which] = 1
+        return self.next_rows[which]
+
 
     def get_transactions_working_row( self ):
         """
         Calculate the working row for the transactions worksheet
         """
-        all_rows = self.worksheet_transactions.col_values(1)
-        return len( all_rows ) + 1
+        return self.get_working_row( 'transactions' )
 
 
-    def write_transactions ( self, transactions, date=datetime.utcnow().strftime( '%Y-%m-%d %H:%M:%S +0000' ) ):
+    def get_portfolios_working_row( self ):
+        """
+        Calculate the working row for the full log worksheet
+        """
+        return self.get_working_row( 'portfolios' )
+
+
+    def __roll_over__( self, which ):
+        """
+        Carry on writing to a new worksheet, named after the original one and
+        today's date, so that the cost of writing doesn't keep growing.
+
+        :param String which The worksheet: 'transactions' or 'portfolios'
+        """
+
+        now = datetime.utcnow()
+        title = self.worksheet_titles[which] + ' ' + now.strftime( '%Y-%m-%d' )
+        if title in [ worksheet.title for worksheet in self.spreadsheet.worksheets() ]:
+            title = self.worksheet_titles[which] + ' ' + now.strftime( '%Y-%m-%d %H%M%S' )
+
+        print 'RecordKeeper: Worksheet ' + getattr( self, 'worksheet_' + which ).title + ' is full, carrying on in ' + title
+        setattr( self, 'worksheet_' + which, self.spreadsheet.add_worksheet( title, self.max_rows, 5 ))
+        self.next_rows[which]  = 1
+        self.row_checks[which] = 1
+
+
+    def write_rows( self, which, rows ):
+        """
+        Write some rows at the end of a worksheet, in a single update. There
+        are no retries here: any error is raised to the caller.
+
+        :param String which The worksheet: 'transactions' or 'portfolios'
+        :param List rows The rows to write, each a list of cell values (all of the same length)
+        """
+
+        if not rows:
+            return
+
+        row = self.get_working_row( which )
+        if self.max_rows and row > 1 and row + len(rows) - 1 > self.max_rows:
+            self.__roll_over__( which )
+            row = self.get_working_row( which )
+
+        worksheet = getattr( self, 'worksheet_' + which )
+        try:
+            start = worksheet.get_addr_int(row, 1)
+            end = worksheet.get_addr_int(row+len(rows)-1, len(rows[0]))
+            cells = self.transport.call( 'range', worksheet.range, start+':'+end )
+
+            i = 0
+            for values in rows:
+                for value in values:
+                    cells[i].value = value
+                    i += 1
+
+            self.transport.call( 'update_cells', worksheet.update_cells, cells )
+        except:
+            # We don't know what made it to the worksheet, so ask it next time
+            self.next_rows.pop( which, None )
+            raise
+
+        self.next_rows[which] = row + len(rows)
+
+
+    def __write_with_retries__( self, which, rows, what ):
+        """
+        Write some rows at the end of a worksheet, trying again (up to
+        max_retries times, backing off a little longer every time) if it
+        fails. We give up right away while the spreadsheet's circuit is open
+        (see `Transport`).
+
+        :param String which The worksheet: 'transactions' or 'portfolios'
+        :param List rows The rows to write (see `write_rows`)
+        :param String what What we are recording, for the error messages
+        """
+
+        attempt = 0
+        while True:
+            try:
+                self.write_rows( which, rows )
+                return
+            except CircuitOpenError:
+                print 'RecordKeeper: Could not record ' + what + ', the spreadsheet is failing'
+                raise
+            except:
+                attempt += 1
+                if attempt >= self.max_retries:
+                    print 'RecordKeeper: Could not record ' + what + ', giving up'
+                    raise
+                print 'RecordKeeper: Error trying to record ' + what + ', trying again'
+                metrics.increment( 'retries', { 'component': 'recorder' } )
+                self.transport.backoff( attempt )
+
+
+    @timed( 'write_transactions' )
+    def write_transactions ( self, transactions, date=None ):
         """
         Record the given transactions in the transactions worksheet, with full details.
 
@@ -73,46 +271,18 @@ class RecordKeeper(object):
         'value': 0.15714285714284948}]
         """
 
-        num_rows = len( transactions )
-
-        retries = self.max_retries
-        while retries > 0:
-            try:
-                row = self.get_transactions_working_row()
-                ws = self.worksheet_transactions
-                start = ws.get_addr_int(row, 1)
-                end = ws.get_addr_int(row+num_rows-1, 5)
-                cells = ws.range( start+':'+end )
-
-                i = 0
-                for t in transactions:
-                    cells[i].value = date
-                    i += 1
-                    for key in [ 'origin', 'destination', 'amount', 'base_currency' ]:
-                        cells[i].value = t[key]
-                        i += 1
+        if date is None:
+            date = datetime.utcnow().strftime( '%Y-%m-%d %H:%M:%S +0000' )
 
-                self.worksheet_transactions.update_cells( cells )
-                break
-            except:
-                print 'RecordKeeper: Error trying to record full log, trying again in one second'
-                time.sleep(1)
-                retries -= 1
-        if retries == 0:
-            print 'RecordKeeper: Could not record the full log, giving up'
-            raise
-            sys.exit()
+        self.__write_with_retries__(
+            'transactions',
+            transaction_rows( transactions, date ),
+            'full log'
+        )
 
 
-    def get_portfolios_working_row( self ):
-        """
-        Calculate the working row for the full log worksheet
-        """
-        all_rows = self.worksheet_portfolios.col_values(1)
-        return len( all_rows ) + 1
-
-
-    def write_portfolio( self, portfolio, total_value, date=datetime.utcnow().strftime( '%Y-%m-%d %H:%M:%S +0000' ) ):
+    @timed( 'write_portfolio' )
+    def write_portfolio( self, portfolio, total_value, date=None ):
         """
         Record the full portfolio in the portfolios worksheet, complete with
         the full value.
@@ -132,46 +302,19 @@ class RecordKeeper(object):
             }
         """
 
-        num_rows = len(portfolio)
+        if date is None:
+            date = datetime.utcnow().strftime( '%Y-%m-%d %H:%M:%S +0000' )
 
-        retries = self.max_retries
-        while retries > 0:
-            try:
-                row = self.get_portfolios_working_row()
-                ws = self.worksheet_portfolios
-                start = ws.get_addr_int(row, 1)
-                end = ws.get_addr_int(row+num_rows, 4)
-                cells = ws.range( start+':'+end )
-
-                i=0
-                for currency,data in portfolio.items():
-                    if currency == 'TOTAL':
-                        continue
-                    cells[i].value = date
-                    i += 1
-                    cells[i].value = currency
-                    i += 1
-                    cells[i].value = data['amount']
-                    i += 1
-                    cells[i].value = data['value']
-                    i += 1
+        self.__write_with_retries__(
+            'portfolios',
+            portfolio_rows( portfolio, total_value, date ),
+            'portfolio'
+        )
 
-                cells[i].value = date
-                i += 1
-                cells[i].value = 'TOTAL'
-                i += 1
-                cells[i].value = ''
-                i += 1
-                cells[i].value = total_value
 
-                ws.update_cells( cells )
-                break
-            except:
-                print 'RecordKeeper: Error trying to record portfolio, trying again in one second'
-                time.sleep(1)
-                retries -= 1
-        if retries == 0:
-            print 'RecordKeeper: Could not record portfolio, giving up'
-            raise
-            sys.exit()
+    def close( self ):
+        """
+        Nothing to release here: every write is done by the time it returns
+        """
 
+        pass
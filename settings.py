@@ -0,0 +1,31 @@
+"""
+Price Watcher settings -- every config file is read only once, however many components ask for it.
+"""
+
+import ConfigParser
+import os
+import threading
+
+# The config files read so far, by absolute path
+configs = {}
+configs_lock = threading.Lock()
+
+def load_config( config_file ):
+    """
+    Read a config file, unless it has been read already.
+
+    Everyone asking for the same file gets the same ConfigParser, so it must
+    be treated as read-only.
+
+    :param String config_file The path to a config file that ConfigParser can read
+
+    :rtype: A ConfigParser with the file's contents
+    """
+
+    path = os.path.abspath( config_file )
+    with configs_lock:
+        if path not in configs:
+            config = ConfigParser.ConfigParser()
+            config.read( path )
+            configs[path] = config
+        return configs[path]
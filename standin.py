@@ -0,0 +1,465 @@
+#!/bin/env python
+# coding=utf-8
+"""
+Price Watcher stand-ins -- local, offline, replacements for the broker's API, the record keeper's spreadsheet and the notifier's queue, for load testing.
+
+Every call the price watcher makes (`get_ticker`, `get_me`, `get_cards`, `prepare_txn`, `execute_txn`, `col_values`, `range`, `update_cells`, `send_message`, ...) goes through an endpoint that can be given a latency distribution, an error rate and a rate limit, so that a rebalance cycle can be run under realistic conditions on one machine. Run as a script, it drives price watchers against the stand-ins and reports their throughput and tail latency.
+"""
+
+import sys
+import argparse
+import ConfigParser
+import itertools
+import math
+import random
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+sys.path.append('.')
+
+
+class StandInError(Exception):
+    """
+    An error made up by a stand-in (an injected failure or a rate limit)
+    """
+    pass
+
+
+def percentile( values, p ):
+    """
+    :param List values The values, in any order
+    :param Number p The percentile wanted, from 0 to 100
+
+    :rtype: The nearest-rank percentile of the values (None if there are none)
+    """
+
+    if not values:
+        return None
+    values = sorted( values )
+    rank = int( math.ceil( p / 100.0 * len( values )))
+    return values[ max( rank, 1 ) - 1 ]
+
+
+class Endpoint(object):
+    """
+    Represents how one of the stand-ins' calls behaves: how long it takes,
+    how often it fails and how many calls per second it takes before
+    refusing them.
+    """
+
+    def __init__( self, name, latency='fixed 0', error_rate=0.0, rate_limit=0.0, burst=None ):
+        """
+        Create the Endpoint
+
+        :param String name The call's name
+        :param String latency The latency distribution, in seconds: 'fixed T', 'uniform MIN MAX', 'exponential MEAN' or 'lognormal MEDIAN SIGMA'
+        :param Number error_rate The fraction of the calls that fail
+        :param Number rate_limit How many calls per second are allowed, on average (0 for no limit)
+        :param Number burst How many calls can be made at once (defaults to one second's worth)
+        """
+        self.version = 0
+
+        self.name       = name
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.burst      = burst or max( rate_limit, 1.0 )
+
+        kind = latency.split()
+        self.distribution = kind[0]
+        self.parameters   = [ float( x ) for x in kind[1:] ]
+        if self.distribution not in ( 'fixed', 'uniform', 'exponential', 'lognormal' ):
+            raise ValueError( 'Endpoint: Unknown latency distribution ' + latency )
+
+        self.lock      = threading.Lock()
+        self.tokens    = self.burst
+        self.filled_at = time.time()
+        self.stats     = { 'calls': 0, 'errors': 0, 'throttled': 0, 'latencies': [] }
+
+
+    def __latency__( self ):
+        """
+        :rtype: A latency, in seconds, drawn from the distribution
+        """
+
+        if self.distribution == 'fixed':
+            return self.parameters[0]
+        if self.distribution == 'uniform':
+            return random.uniform( self.parameters[0], self.parameters[1] )
+        if self.distribution == 'exponential':
+            return random.expovariate( 1.0 / self.parameters[0] ) if self.parameters[0] else 0.0
+        return random.lognormvariate( math.log( self.parameters[0] ), self.parameters[1] )
+
+
+    def call( self ):
+        """
+        Go through one call: refuse it if we are over the rate limit, take
+        the time it takes and fail it if it's its turn to.
+        """
+
+        with self.lock:
+            self.stats['calls'] += 1
+            if self.rate_limit:
+                now = time.time()
+                self.tokens = min( self.burst, self.tokens + ( now - self.filled_at ) * self.rate_limit )
+                self.filled_at = now
+                if self.tokens < 1.0:
+                    self.stats['throttled'] += 1
+                    raise StandInError( '429 Too Many Requests (' + self.name + ')' )
+                self.tokens -= 1.0
+
+        latency = self.__latency__()
+        time.sleep( latency )
+
+        with self.lock:
+            self.stats['latencies'].append( latency )
+            if random.random() < self.error_rate:
+                self.stats['errors'] += 1
+                raise StandInError( '500 Internal Server Error (' + self.name + ')' )
+
+
+    def report( self ):
+        """
+        :rtype: A dictionary with the numbers of calls, errors and throttled calls and the p50, p95 and p99 latency
+        """
+
+        with self.lock:
+            latencies = list( self.stats['latencies'] )
+            report = dict( ( key, self.stats[key] ) for key in ( 'calls', 'errors', 'throttled' ))
+        for p in ( 50, 95, 99 ):
+            report['p' + str(p)] = percentile( latencies, p )
+        return report
+
+
+class Endpoints(object):
+    """
+    Represents the behaviour of all the stand-ins' calls, shared by every
+    account that talks to them (the rate limits are the server's, not each
+    account's).
+
+    They are read from a config file: a "StandIn" section with the defaults
+    and, optionally, a "StandIn <call>" section per call that overrides
+    them, each with the options latency, error_rate, rate_limit and burst.
+    """
+
+    def __init__( self, config_file=None ):
+        """
+        Create the Endpoints
+
+        :param String config_file The path to a config file that ConfigParser can read (None to have every call instant and flawless)
+        """
+        self.version = 0
+
+        self.config = ConfigParser.ConfigParser()
+        if config_file:
+            self.config.read( config_file )
+        self.lock      = threading.Lock()
+        self.endpoints = {}
+
+
+    def __option__( self, name, option, default ):
+        for section in ( 'StandIn ' + name, 'StandIn' ):
+            if self.config.has_option( section, option ):
+                return self.config.get( section, option )
+        return default
+
+
+    def get( self, name ):
+        """
+        :rtype: The Endpoint for a call, created the first time it is asked for
+        """
+
+        with self.lock:
+            if name not in self.endpoints:
+                burst = self.__option__( name, 'burst', None )
+                self.endpoints[name] = Endpoint(
+                    name,
+                    self.__option__( name, 'latency', 'fixed 0' ),
+                    float( self.__option__( name, 'error_rate', 0.0 )),
+                    float( self.__option__( name, 'rate_limit', 0.0 )),
+                    float( burst ) if burst else None
+                )
+            return self.endpoints[name]
+
+
+    def call( self, name ):
+        """
+        Go through one call to the named endpoint (see `Endpoint.call`)
+        """
+
+        self.get( name ).call()
+
+
+    def report( self ):
+        """
+        :rtype: A dictionary with every endpoint's report (see `Endpoint.report`), by name
+        """
+
+        with self.lock:
+            endpoints = self.endpoints.items()
+        return dict( ( name, endpoint.report() ) for name, endpoint in endpoints )
+
+
+class StandInBroker(object):
+    """
+    Stands in for the Bitreserve SDK (see `Broker`), holding one account's
+    cards and moving its rates a little every time they are asked for.
+    """
+
+    def __init__( self, endpoints, currencies, base_currency, value=100.0, volatility=0.01 ):
+        """
+        Create the StandInBroker
+
+        :param Endpoints endpoints How the calls behave
+        :param Dictionary currencies The currencies to hold (see `PriceWatcher`)
+        :param String base_currency The base currency identifier
+        :param Number value The value (in base_currency) held in each currency at first
+        :param Number volatility The standard deviation of each rate's relative move per ticker
+        """
+        self.version = 0
+
+        self.endpoints     = endpoints
+        self.base_currency = base_currency
+        self.volatility    = volatility
+        self.lock          = threading.Lock()
+        self.quotes        = {}
+        self.txn_ids       = itertools.count( 1 )
+
+        self.rates    = {}
+        self.balances = {}
+        for currency in currencies:
+            self.rates[currency] = 1.0 if currency == base_currency else random.uniform( 0.5, 500.0 )
+            self.balances[currency] = value / self.rates[currency]
+
+    def __move__( self ):
+        for currency in self.rates:
+            if currency != self.base_currency:
+                self.rates[currency] *= math.exp( random.gauss( 0.0, self.volatility ))
+
+    def auth_pat( self, pat ):
+        self.endpoints.call( 'auth_pat' )
+
+    def get_ticker( self ):
+        self.endpoints.call( 'get_ticker' )
+        with self.lock:
+            self.__move__()
+            return [ {
+                'pair':     currency + self.base_currency,
+                'ask':      repr( rate * 1.001 ),
+                'bid':      repr( rate * 0.999 ),
+                'currency': self.base_currency,
+            } for currency, rate in self.rates.items() ]
+
+    def get_me( self ):
+        self.endpoints.call( 'get_me' )
+        with self.lock:
+            self.__move__()
+            balances = {}
+            for currency, amount in self.balances.items():
+                balances[currency] = {
+                    'balance':  repr( amount ),
+                    'amount':   repr( amount * self.rates[currency] ),
+                    'rate':     repr( self.rates[currency] ),
+                    'currency': self.base_currency,
+                }
+        return {
+            'balances': { 'total': repr( sum( float( b['amount'] ) for b in balances.values() )), 'currencies': balances },
+            'settings': { 'currency': self.base_currency },
+        }
+
+    def get_cards( self ):
+        self.endpoints.call( 'get_cards' )
+        return [ { 'currency': currency, 'address': { 'bitcoin': 'address-' + currency } } for currency in self.balances ]
+
+    def prepare_txn( self, origin, destination, amount, currency ):
+        self.endpoints.call( 'prepare_txn' )
+        with self.lock:
+            txn_id = 'txn-' + str( next( self.txn_ids ))
+            self.quotes[txn_id] = ( origin[len( 'address-' ):], destination[len( 'address-' ):], float( amount ))
+        return txn_id
+
+    def execute_txn( self, origin, txn_id, message ):
+        self.endpoints.call( 'execute_txn' )
+        with self.lock:
+            origin, destination, amount = self.quotes.pop( txn_id )
+            self.balances[origin]      -= amount / self.rates[origin]
+            self.balances[destination] += amount / self.rates[destination]
+        return { 'id': txn_id, 'status': 'completed' }
+
+
+class StandInCell(object):
+    """
+    Stands in for a gspread Cell
+    """
+
+    __slots__ = ( 'row', 'col', 'value' )
+
+    def __init__( self, row, col, value='' ):
+        self.row   = row
+        self.col   = col
+        self.value = value
+
+
+class StandInWorksheet(object):
+    """
+    Stands in for a gspread Worksheet, keeping only its first column
+    """
+
+    def __init__( self, endpoints, title ):
+        self.endpoints = endpoints
+        self.title     = title
+        self.column    = []
+
+    def col_values( self, col ):
+        self.endpoints.call( 'col_values' )
+        return list( self.column )
+
+    def get_addr_int( self, row, col ):
+        return 'R' + str(row) + 'C' + str(col)
+
+    def range( self, cells ):
+        self.endpoints.call( 'range' )
+        start, end = cells.split( ':' )
+        start_row, start_col = [ int( x ) for x in start[1:].split( 'C' ) ]
+        end_row, end_col     = [ int( x ) for x in end[1:].split( 'C' ) ]
+        cells = []
+        for row in xrange( start_row, end_row + 1 ):
+            for col in xrange( start_col, end_col + 1 ):
+                cells.append( StandInCell( row, col ))
+        return cells
+
+    def update_cells( self, cells ):
+        self.endpoints.call( 'update_cells' )
+        for cell in cells:
+            if cell.col == 1:
+                self.column.extend( [ '' ] * ( cell.row - len( self.column )))
+                self.column[cell.row - 1] = cell.value
+
+
+class StandInSpreadsheet(object):
+    """
+    Stands in for a gspread Spreadsheet (see `RecordKeeper`)
+    """
+
+    def __init__( self, endpoints ):
+        self.endpoints = endpoints
+        self.sheets    = {}
+
+    def worksheet( self, title ):
+        self.endpoints.call( 'worksheet' )
+        return self.sheets.setdefault( title, StandInWorksheet( self.endpoints, title ))
+
+    def worksheets( self ):
+        self.endpoints.call( 'worksheets' )
+        return self.sheets.values()
+
+    def add_worksheet( self, title, rows, cols ):
+        self.endpoints.call( 'add_worksheet' )
+        return self.sheets.setdefault( title, StandInWorksheet( self.endpoints, title ))
+
+
+class StandInQueue(object):
+    """
+    Stands in for a boto3 SQS Queue (see `Notifier`), keeping the messages
+    """
+
+    def __init__( self, endpoints ):
+        self.endpoints = endpoints
+        self.lock      = threading.Lock()
+        self.messages  = []
+
+    def send_message( self, MessageBody ):
+        self.endpoints.call( 'send_message' )
+        with self.lock:
+            self.messages.append( MessageBody )
+        return { 'MessageId': str( len( self.messages )) }
+
+    def send_message_batch( self, Entries ):
+        self.endpoints.call( 'send_message' )
+        with self.lock:
+            self.messages.extend( entry['MessageBody'] for entry in Entries )
+        return { 'Successful': [ { 'Id': entry['Id'] } for entry in Entries ], 'Failed': [] }
+
+
+##############################################
+# Here we go
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "config",
+        help="the price watcher's config file"
+    )
+    parser.add_argument(
+        "--standin",
+        help="the config file describing how the stand-ins behave (see standin.cfg-dist)"
+    )
+    parser.add_argument(
+        "--cycles",
+        help="how many cycles each account runs",
+        type=int,
+        default=20
+    )
+    parser.add_argument(
+        "--accounts",
+        help="how many accounts run their cycles at the same time",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--volatility",
+        help="the standard deviation of each rate's relative move per ticker",
+        type=float,
+        default=0.01
+    )
+    args = parser.parse_args()
+
+    from watcher import PriceWatcher
+
+    config = ConfigParser.ConfigParser()
+    config.read( args.config )
+    base_currency = config.get( 'Setup', 'base_currency' )
+    currencies    = eval( config.get( 'Setup', 'currencies' ))
+
+    endpoints = Endpoints( args.standin )
+    watchers = [ PriceWatcher(
+        args.config,
+        api=StandInBroker( endpoints, currencies, base_currency, volatility=args.volatility ),
+        spreadsheet=StandInSpreadsheet( endpoints ),
+        queue=StandInQueue( endpoints )
+    ) for i in xrange( args.accounts ) ]
+
+    def run_account( watcher ):
+        cycles = []
+        for i in xrange( args.cycles ):
+            started = time.time()
+            try:
+                transactions = len( watcher.run_cycle() )
+                error = None
+            except Exception as e:
+                transactions = 0
+                error = str(e)
+            cycles.append( { 'time': time.time() - started, 'transactions': transactions, 'error': error } )
+        return cycles
+
+    started = time.time()
+    pool = ThreadPool( args.accounts )
+    cycles = sum( pool.map( run_account, watchers ), [] )
+    elapsed = time.time() - started
+    pool.close()
+    pool.join()
+    for watcher in watchers:
+        watcher.close()
+
+    times = [ cycle['time'] for cycle in cycles ]
+    print 'Cycles: ' + str(len( cycles )) + ' in ' + '%.3f' % elapsed + 's (' + '%.2f' % ( len( cycles ) / elapsed ) + ' cycles/s)'
+    print 'Cycles with transactions: ' + str(len( [ c for c in cycles if c['transactions'] ] )) \
+        + ', transactions: ' + str(sum( c['transactions'] for c in cycles )) \
+        + ', failed cycles: ' + str(len( [ c for c in cycles if c['error'] ] ))
+    print 'Cycle latency: p50 %.4fs  p95 %.4fs  p99 %.4fs  max %.4fs' % (
+        percentile( times, 50 ), percentile( times, 95 ), percentile( times, 99 ), max( times ))
+    print 'Calls:'
+    for name, report in sorted( endpoints.report().items() ):
+        print '    %-14s %6d calls %4d errors %4d throttled   p50 %.4fs  p95 %.4fs  p99 %.4fs' % (
+            name, report['calls'], report['errors'], report['throttled'],
+            report['p50'] or 0.0, report['p95'] or 0.0, report['p99'] or 0.0 )
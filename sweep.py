@@ -0,0 +1,164 @@
+"""
+Price Watcher parameter sweep -- it backtests a grid of rebalance_thresholds, min_transaction settings and currency sets, using every core, to help choose the production parameters.
+
+The history of rates is written once to a memory-mapped NumPy file that every worker process maps, instead of being pickled over to each of them.
+"""
+
+import csv
+import itertools
+import multiprocessing
+import os
+import tempfile
+import numpy
+
+from backtest import Backtester
+from moneymaker import MoneyMaker
+
+COLUMNS = [ 'threshold', 'min_scale', 'currencies', 'final_value', 'hold_value', 'turnover', 'fees', 'transactions', 'rebalances' ]
+
+# The state each worker process sets up once (see `init_worker`)
+worker = {}
+
+def init_worker( config_file, base_currency, wanted_currencies, currencies, rates_file, fee, initial_value ):
+    """
+    Set up a worker process: map the rates and remember the sweep settings.
+    """
+
+    worker['config_file']       = config_file
+    worker['base_currency']     = base_currency
+    worker['wanted_currencies'] = wanted_currencies
+    worker['currencies']        = currencies
+    worker['rates']             = numpy.load( rates_file, mmap_mode='r' )
+    worker['fee']               = fee
+    worker['initial_value']     = initial_value
+
+
+def run_point( point ):
+    """
+    Backtest one point of the grid, in a worker process.
+
+    :param Tuple point The threshold, the min_transaction scale and the currencies (a tuple of names)
+
+    :rtype: A dictionary with the point and its results (see `COLUMNS`)
+    """
+
+    threshold, min_scale, subset = point
+
+    # The base currency's min_transaction is needed even if we don't hold it
+    currencies = {}
+    for currency in set( subset ) | set( [ worker['base_currency'] ] ):
+        currencies[currency] = { 'min_transaction': worker['wanted_currencies'][currency]['min_transaction'] * min_scale }
+    money_maker = MoneyMaker( worker['config_file'], worker['base_currency'], currencies )
+    money_maker.rebalance_threshold = threshold
+
+    # Only the columns this point needs are copied out of the shared rates
+    columns = [ worker['currencies'].index( currency ) for currency in subset ]
+    results = Backtester( money_maker, worker['fee'] ).run(
+        list( subset ),
+        worker['rates'][:, columns],
+        worker['initial_value']
+    )
+
+    results['threshold']  = threshold
+    results['min_scale']  = min_scale
+    results['currencies'] = ' '.join( subset )
+    return results
+
+
+class ParameterSweep(object):
+    """
+    Represents a sweep over a grid of money maker parameters
+    """
+
+    def __init__( self, config_file, base_currency, wanted_currencies, fee=0.0, initial_value=1000.0, workers=None ):
+        """
+        Create the ParameterSweep
+
+        :param String config_file The path to a config file that ConfigParser can read and that has a "MoneyMaker" section.
+        :param String base_currency The base currency identifier
+        :param Dictionary wanted_currencies The [Setup] currencies, with their min_transaction
+        :param Number fee The fee charged on each transaction, as a fraction of the amount
+        :param Number initial_value The value of the portfolio at the first step
+        :param Integer workers How many processes to use (defaults to one per core)
+        """
+        self.version = 0
+
+        self.config_file       = config_file
+        self.base_currency     = base_currency
+        self.wanted_currencies = wanted_currencies
+        self.fee               = fee
+        self.initial_value     = initial_value
+        self.workers           = workers or multiprocessing.cpu_count()
+
+
+    def grid( self, currencies, thresholds, min_scales, subset_size=0 ):
+        """
+        Build the grid of points to backtest.
+
+        :param List currencies The currencies we have rates for
+        :param List thresholds The rebalance_thresholds to try
+        :param List min_scales The factors to multiply every min_transaction by
+        :param Integer subset_size If given, try every set of this many currencies instead of all of them
+
+        :rtype: A list of (threshold, min_scale, currencies) points
+        """
+
+        if subset_size:
+            subsets = list( itertools.combinations( currencies, subset_size ))
+        else:
+            subsets = [ tuple( currencies ) ]
+        return list( itertools.product( thresholds, min_scales, subsets ))
+
+
+    def run( self, currencies, rates, points, output ):
+        """
+        Backtest every point, spread over the worker processes.
+
+        The results are written to `output` (as CSV) as they come in and,
+        once they are all in, the file is rewritten ranked by final value.
+
+        :param List currencies The currencies, one per column of rates
+        :param Array rates The (steps x currencies) rates, in base_currency
+        :param List points The points to backtest (see `grid`)
+        :param String output The path of the results file
+
+        :rtype: The list of results, best first
+        """
+
+        fd, rates_file = tempfile.mkstemp( suffix='.npy' )
+        os.close( fd )
+        pool = None
+        try:
+            numpy.save( rates_file, numpy.asarray( rates, dtype=float ))
+
+            pool = multiprocessing.Pool(
+                self.workers,
+                init_worker,
+                ( self.config_file, self.base_currency, self.wanted_currencies, list( currencies ), rates_file, self.fee, self.initial_value )
+            )
+
+            results = []
+            with open( output, 'wb' ) as output_file:
+                writer = csv.DictWriter( output_file, COLUMNS, extrasaction='ignore' )
+                writer.writeheader()
+                for result in pool.imap_unordered( run_point, points ):
+                    results.append( result )
+                    writer.writerow( result )
+                    output_file.flush()
+            pool.close()
+            pool.join()
+        finally:
+            if pool:
+                pool.terminate()
+            os.remove( rates_file )
+
+        results.sort( key=lambda result: result['final_value'], reverse=True )
+        with open( output + '.tmp', 'wb' ) as output_file:
+            writer = csv.DictWriter( output_file, [ 'rank' ] + COLUMNS, extrasaction='ignore' )
+            writer.writeheader()
+            for rank, result in enumerate( results ):
+                result['rank'] = rank + 1
+                writer.writerow( result )
+        os.rename( output + '.tmp', output )
+
+        return results
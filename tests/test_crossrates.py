@@ -0,0 +1,121 @@
+"""
+Tests for the cross rates: whatever the tickers do, the incremental updates
+must end up where working everything out again from scratch does.
+"""
+
+import math
+import random
+import unittest
+
+import numpy
+
+from crossrates import CrossRates
+
+
+def ticker( sold, quoted, bid, ask ):
+    return { 'pair': sold + quoted, 'currency': quoted, 'bid': repr( bid ), 'ask': repr( ask ) }
+
+
+class CrossRatesTest(unittest.TestCase):
+
+    def assertRecomputed( self, cross_rates ):
+        """
+        Check the cross rates against a full recompute of the same conversions
+        """
+
+        reference = CrossRates( cross_rates.tolerance )
+        reference.index   = cross_rates.index
+        reference.names   = cross_rates.names
+        reference.weights = cross_rates.weights.copy()
+        reference.__recompute__()
+        self.assertEqual( len( cross_rates.cycles ), len( reference.cycles ))
+        if reference.cycles:
+            return
+        self.assertTrue( numpy.allclose( cross_rates.dist, reference.dist, rtol=0, atol=1e-7, equal_nan=True ))
+        for origin in cross_rates.names:
+            for destination in cross_rates.names:
+                path = cross_rates.path( origin, destination )
+                if not numpy.isfinite( cross_rates.dist[cross_rates.index[origin], cross_rates.index[destination]] ):
+                    self.assertEqual( path, None )
+                    continue
+                weight = sum( cross_rates.weights[cross_rates.index[a], cross_rates.index[b]] for a, b in zip( path, path[1:] ))
+                self.assertAlmostEqual( weight, cross_rates.dist[cross_rates.index[origin], cross_rates.index[destination]], places=7 )
+
+
+    def test_rate_and_path( self ):
+        cross_rates = CrossRates()
+        cross_rates.update_tickers([ ticker( 'BTC', 'USD', 250.0, 251.0 ), ticker( 'EUR', 'USD', 1.1, 1.1 ) ])
+        self.assertAlmostEqual( cross_rates.rate( 'BTC', 'EUR' ), 250.0 / 1.1 )
+        self.assertEqual( cross_rates.path( 'BTC', 'EUR' ), [ 'BTC', 'USD', 'EUR' ] )
+        self.assertEqual( cross_rates.rate( 'BTC', 'GBP' ), 0.0 )
+
+
+    def test_arbitrage( self ):
+        cross_rates = CrossRates()
+        cross_rates.update_tickers([ ticker( 'BTC', 'USD', 250.0, 251.0 ), ticker( 'EUR', 'USD', 1.0, 1.01 ) ])
+        self.assertEqual( cross_rates.arbitrage(), [] )
+        cycles = cross_rates.update_tickers([ ticker( 'BTC', 'EUR', 260.0, 261.0 ) ])
+        self.assertEqual( len( cycles ), 1 )
+        self.assertTrue( cycles[0]['profit'] > 0 )
+        self.assertEqual( set( cycles[0]['cycle'] ), set([ 'BTC', 'USD', 'EUR' ]))
+
+
+    def test_zero_spread_widening( self ):
+        cross_rates = CrossRates()
+        cross_rates.update_tickers([ ticker( 'USD', 'EUR', 1.0, 1.0 ), ticker( 'BTC', 'USD', 250.0, 251.0 ) ])
+        cross_rates.update_tickers([ ticker( 'USD', 'EUR', 0.99, 1.01 ) ])
+        self.assertEqual( cross_rates.stats['incremental'], 1 )
+        self.assertEqual( list( numpy.diag( cross_rates.dist )), [ 0.0, 0.0, 0.0 ] )
+        self.assertRecomputed( cross_rates )
+
+
+    def random_market( self, zero_spreads ):
+        """
+        :rtype: A tuple with the prices of a dozen currencies, some of the pairs between them and the spread of each pair
+        """
+
+        random.seed( 1 )
+        names = [ 'C%02d' % i for i in xrange( 12 ) ]
+        prices = dict( ( name, random.uniform( 0.1, 100.0 )) for name in names )
+        pairs = [ ( a, b ) for i, a in enumerate( names ) for b in names[i + 1:] if random.random() < 0.5 ]
+        spreads = dict( ( pair, self.random_spread( zero_spreads )) for pair in pairs )
+        return prices, pairs, spreads
+
+
+    def random_spread( self, zero_spreads ):
+        if zero_spreads and random.random() < 0.33:
+            return 0.0
+        return random.uniform( 0.005, 0.02 )
+
+
+    def quote( self, prices, spreads, pair ):
+        rate = prices[pair[0]] / prices[pair[1]]
+        return ticker( pair[0], pair[1], rate * ( 1.0 - spreads[pair] ), rate * ( 1.0 + spreads[pair] ))
+
+
+    def test_random_spreads( self ):
+        # A third of the quotes have no spread, so a round trip through them is free
+        prices, pairs, spreads = self.random_market( True )
+        cross_rates = CrossRates()
+        cross_rates.update_tickers([ self.quote( prices, spreads, pair ) for pair in pairs ])
+        for step in xrange( 300 ):
+            pair = random.choice( pairs )
+            spreads[pair] = self.random_spread( True )
+            cross_rates.update_tickers([ self.quote( prices, spreads, pair ) ])
+            self.assertRecomputed( cross_rates )
+
+
+    def test_random_prices( self ):
+        prices, pairs, spreads = self.random_market( False )
+        cross_rates = CrossRates()
+        cross_rates.update_tickers([ self.quote( prices, spreads, pair ) for pair in pairs ])
+        for step in xrange( 300 ):
+            pair = random.choice( pairs )
+            prices[pair[0]] *= math.exp( random.gauss( 0.0, 0.001 ))
+            cross_rates.update_tickers([ self.quote( prices, spreads, pair ) ])
+            self.assertRecomputed( cross_rates )
+        self.assertTrue( cross_rates.stats['incremental'] > 250 )
+
+
+if __name__ == '__main__':
+    unittest.main()
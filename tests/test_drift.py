@@ -0,0 +1,77 @@
+"""
+Tests for the drift tracker: however the rates move, its total, percentages
+and spread must be those of the portfolio valued again from scratch.
+"""
+
+import random
+import unittest
+
+from drift import DriftTracker
+
+
+def random_portfolio( n ):
+    portfolio = {}
+    for i in xrange( n ):
+        amount = random.uniform( 1, 10 )
+        portfolio['C' + str(i)] = { 'amount': amount, 'value': amount, 'rate': 1.0, 'base_currency': 'USD' }
+    portfolio['TOTAL'] = { 'value': sum( holding['value'] for holding in portfolio.values() ), 'base_currency': 'USD' }
+    return portfolio
+
+
+class DriftTrackerTest(unittest.TestCase):
+
+    def assertRevalued( self, tracker, portfolio, rates ):
+        """
+        Check the tracker against the portfolio valued at the given rates
+        """
+
+        values = dict( ( currency, portfolio[currency]['amount'] * rate ) for currency, rate in rates.items() )
+        total = sum( values.values() )
+        self.assertAlmostEqual( tracker.total_value(), total, places=9 )
+        self.assertAlmostEqual( tracker.spread(), ( max( values.values() ) - min( values.values() )) / total, places=12 )
+        for currency, value in values.items():
+            self.assertAlmostEqual( tracker.percentage( currency ), value / total, places=12 )
+
+
+    def test_random_updates( self ):
+        random.seed( 0 )
+        portfolio = random_portfolio( 50 )
+        tracker = DriftTracker( portfolio, 0.05, resum_every=100 )
+        rates = dict( ( currency, 1.0 ) for currency in portfolio if currency != 'TOTAL' )
+        for update in xrange( 20000 ):
+            currency = random.choice( rates.keys() )
+            rates[currency] = random.uniform( 0.5, 2.0 )
+            tracker.update( currency, rates[currency] )
+            # The stale entries are dropped, so the heaps never grow far past the currencies
+            self.assertTrue( len( tracker.lowest ) <= 4 * len( rates ) + 1 )
+            if update % 97 == 0:
+                self.assertRevalued( tracker, portfolio, rates )
+        self.assertEqual( portfolio['C1']['rate'], 1.0 )
+        self.assertFalse( 'pctg' in portfolio['C1'] )
+
+
+    def test_same_currency_over_and_over( self ):
+        random.seed( 1 )
+        portfolio = random_portfolio( 3 )
+        tracker = DriftTracker( portfolio, 0.05 )
+        rates = { 'C0': 1.0, 'C1': 1.0, 'C2': 1.0 }
+        for update in xrange( 1000 ):
+            rates['C0'] = random.uniform( 0.1, 10.0 )
+            tracker.update( 'C0', rates['C0'] )
+        self.assertRevalued( tracker, portfolio, rates )
+
+
+    def test_update_tickers( self ):
+        portfolio = { 'BTC': { 'amount': 1.0, 'value': 250.0 }, 'EUR': { 'amount': 250.0, 'value': 250.0 } }
+        tracker = DriftTracker( portfolio, 0.1 )
+        self.assertFalse( tracker.crossed() )
+        tracker.update_tickers({ 'BTC': { 'bid': 299.0, 'ask': 301.0 }, 'GBP': { 'bid': 1.5, 'ask': 1.5 } })
+        self.assertEqual( tracker.total_value(), 550.0 )
+        self.assertAlmostEqual( tracker.spread(), 50.0 / 550.0 )
+        self.assertFalse( tracker.crossed() )
+        tracker.update_tickers({ 'BTC': { 'bid': 350.0, 'ask': 350.0 } })
+        self.assertTrue( tracker.crossed() )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+"""
+Tests for the matching engine: the heaps must pair the currencies up exactly
+the way re-sorting both lists on every step always did.
+"""
+
+import random
+import unittest
+
+from matching import MatchingEngine, transaction_deltas
+
+
+def sorted_transactions( currencies, base_currency, portfolio, target_value ):
+    """
+    The transactions as they were worked out before the matching engine:
+    round every currency's distance to its target, then sort both lists again
+    before each transfer.
+    """
+
+    senders   = []
+    receivers = []
+    for currency in portfolio:
+        if currency == 'TOTAL':
+            continue
+        value = portfolio[currency]['value']
+        min_transaction = currencies[portfolio[currency]['base_currency']]['min_transaction']
+        if value == target_value:
+            continue
+        transaction_value = round( abs( value - target_value ) / min_transaction ) * min_transaction
+        if transaction_value < min_transaction:
+            continue
+        if value > target_value:
+            senders.append({ 'currency': currency, 'value': transaction_value })
+        else:
+            receivers.append({ 'currency': currency, 'value': transaction_value })
+
+    transactions = []
+    while senders and receivers:
+        senders.sort( key=lambda currency: currency['value'], reverse=True )
+        receivers.sort( key=lambda currency: currency['value'], reverse=True )
+        sender   = senders[0]
+        receiver = receivers[0]
+        amount = min( sender['value'], receiver['value'] )
+        transactions.append({ 'origin': sender['currency'], 'destination': receiver['currency'], 'amount': amount, 'base_currency': base_currency })
+        if sender['value'] >= receiver['value']:
+            receivers.pop( 0 )
+            sender['value'] -= amount
+            if sender['value'] < currencies[sender['currency']]['min_transaction']:
+                senders.pop( 0 )
+        else:
+            senders.pop( 0 )
+            receiver['value'] -= amount
+            if receiver['value'] < currencies[receiver['currency']]['min_transaction']:
+                receivers.pop( 0 )
+    return transactions
+
+
+def random_portfolio( n ):
+    """
+    A portfolio of n currencies worth the same in all of them, with the
+    min_transactions and values (many of them equal, to exercise the ties)
+    picked at random
+    """
+
+    currencies = { 'USD': { 'min_transaction': random.choice([ 0.01, 0.05, 0.1, 1.0 ]) } }
+    portfolio  = {}
+    for i in xrange( n ):
+        currency = 'C' + str(i)
+        currencies[currency] = { 'min_transaction': random.choice([ 0.001, 0.01, 0.5, 1.0, 2.0 ]) }
+        value = random.choice([ random.uniform( 0, 100 ), float( random.randint( 0, 20 )), round( random.uniform( 0, 10 ), 2 ) ])
+        portfolio[currency] = { 'amount': value, 'value': value, 'rate': 1.0, 'base_currency': 'USD' }
+    return currencies, portfolio
+
+
+class MatchingEngineTest(unittest.TestCase):
+
+    def test_deltas_round_like_round( self ):
+        random.seed( 0 )
+        for trial in xrange( 1000 ):
+            value, target, min_transaction = random.uniform( 0, 100 ), random.uniform( 0, 100 ), random.choice([ 0.01, 0.5, 1.0, 2.0 ])
+            amounts, avoided = transaction_deltas([ value ], target, [ min_transaction ])
+            rounded = round( abs( value - target ) / min_transaction ) * min_transaction
+            if rounded >= min_transaction:
+                self.assertEqual( amounts.tolist(), [ rounded ] )
+            else:
+                self.assertEqual( ( amounts.tolist(), avoided.tolist() ), ( [ 0.0 ], [ rounded ] ))
+
+
+    def test_largest_first( self ):
+        currencies = { 'USD': { 'min_transaction': 0.01 }, 'BTC': { 'min_transaction': 0.01 }, 'EUR': { 'min_transaction': 0.01 }, 'GBP': { 'min_transaction': 0.01 } }
+        engine = MatchingEngine( currencies, 'USD' )
+        transactions = engine.match(
+            [ { 'currency': 'BTC', 'value': 3.0 } ],
+            [ { 'currency': 'EUR', 'value': 1.0 }, { 'currency': 'GBP', 'value': 2.0 } ] )
+        self.assertEqual( transactions, [
+            { 'origin': 'BTC', 'destination': 'GBP', 'amount': 2.0, 'base_currency': 'USD' },
+            { 'origin': 'BTC', 'destination': 'EUR', 'amount': 1.0, 'base_currency': 'USD' },
+        ])
+
+
+    def test_same_as_sorting( self ):
+        random.seed( 1 )
+        for trial in xrange( 20000 ):
+            currencies, portfolio = random_portfolio( random.randint( 2, 30 ))
+            target_value = sum( holding['value'] for holding in portfolio.values() ) / len( portfolio )
+            engine = MatchingEngine( currencies, 'USD' )
+            transactions = engine.transactions( portfolio, target_value )
+            self.assertEqual( transactions, sorted_transactions( currencies, 'USD', portfolio, target_value ), trial )
+            self.assertTrue( all( type( transaction['amount'] ) is float for transaction in transactions ))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+"""
+Tests for the model: holdings, transactions and portfolios must behave like
+the dictionaries they replaced, for any code written for those.
+"""
+
+import copy
+import json
+import os
+import random
+import tempfile
+import unittest
+
+from model import Holding, Portfolio, Transaction
+from moneymaker import MoneyMaker
+
+
+class RecordTest(unittest.TestCase):
+
+    def test_holding_as_dictionary( self ):
+        holding = Holding( amount=0.0543, value=13.88, rate=255.705, base_currency='USD' )
+        self.assertEqual( holding['value'], 13.88 )
+        self.assertEqual( holding, { 'amount': 0.0543, 'value': 13.88, 'rate': 255.705, 'base_currency': 'USD' } )
+        self.assertEqual( sorted( holding ), [ 'amount', 'base_currency', 'rate', 'value' ] )
+        self.assertEqual( len( holding ), 4 )
+        self.assertEqual( dict( holding.items() ), holding.to_dict() )
+        self.assertEqual( sorted( holding.values() ), sorted( holding.to_dict().values() ))
+
+        # A slot that was never set is a missing key
+        self.assertFalse( 'pctg' in holding )
+        self.assertEqual( holding.get( 'pctg' ), None )
+        self.assertEqual( holding.get( 'pctg', 0.5 ), 0.5 )
+        self.assertRaises( KeyError, lambda: holding['pctg'] )
+        holding['pctg'] = 0.25
+        self.assertTrue( 'pctg' in holding )
+        self.assertEqual( holding['pctg'], 0.25 )
+
+        # Unlike a dictionary, a record only takes its own keys
+        self.assertFalse( 'currency' in holding )
+        self.assertRaises( KeyError, lambda: holding['currency'] )
+        def set_currency():
+            holding['currency'] = 'BTC'
+        self.assertRaises( KeyError, set_currency )
+
+
+    def test_holding_leaves_out_none( self ):
+        holding = Holding( value=10.0, base_currency='USD' )
+        self.assertEqual( holding, { 'value': 10.0, 'base_currency': 'USD' } )
+        self.assertNotEqual( holding, { 'value': 10.0, 'base_currency': 'USD', 'amount': None } )
+
+
+    def test_transaction_as_dictionary( self ):
+        transaction = Transaction( 'BTC', 'EUR', 5.0, 'USD' )
+        self.assertEqual( transaction, { 'origin': 'BTC', 'destination': 'EUR', 'amount': 5.0, 'base_currency': 'USD' } )
+        self.assertEqual( transaction, Transaction( 'BTC', 'EUR', 5.0, 'USD' ))
+        self.assertNotEqual( transaction, Transaction( 'BTC', 'EUR', 6.0, 'USD' ))
+        self.assertFalse( 'route' in transaction )
+        transaction['route'] = [ 'BTC', 'GBP', 'EUR' ]
+        self.assertEqual( json.loads( json.dumps( transaction.to_dict() ))['route'], [ 'BTC', 'GBP', 'EUR' ] )
+        self.assertEqual( eval( repr( transaction )), transaction.to_dict() )
+
+
+    def test_copies( self ):
+        holding = Holding( amount=1.0, value=2.0 )
+        copied = copy.deepcopy( holding )
+        copied['value'] = 3.0
+        self.assertEqual( holding['value'], 2.0 )
+        self.assertEqual( copy.copy( holding ), holding )
+
+
+class PortfolioTest(unittest.TestCase):
+
+    def setUp( self ):
+        handle, self.config_file = tempfile.mkstemp( suffix='.cfg' )
+        with os.fdopen( handle, 'w' ) as config_file:
+            config_file.write( '[MoneyMaker]\nrebalance_threshold: 0.0\n' )
+
+
+    def tearDown( self ):
+        os.remove( self.config_file )
+
+
+    def test_round_trip( self ):
+        plain = {
+            'BTC': { 'amount': 0.0543, 'value': 13.88, 'rate': 255.705, 'base_currency': 'USD' },
+            'TOTAL': { 'value': 13.88, 'base_currency': 'USD' },
+        }
+        portfolio = Portfolio.from_dict( plain )
+        self.assertTrue( isinstance( portfolio['BTC'], Holding ))
+        self.assertEqual( portfolio, plain )
+        self.assertEqual( portfolio.to_dict(), plain )
+        self.assertTrue( type( portfolio.to_dict()['BTC'] ) is dict )
+        self.assertTrue( Portfolio.from_dict( portfolio )['BTC'] is portfolio['BTC'] )
+
+
+    def test_rebalances_like_dictionaries( self ):
+        random.seed( 0 )
+        currencies = { 'USD': { 'min_transaction': 0.01 } }
+        for trial in xrange( 200 ):
+            plain = {}
+            for i in xrange( random.randint( 2, 10 )):
+                currencies['C' + str(i)] = { 'min_transaction': random.choice([ 0.01, 1.0 ]) }
+                value = random.uniform( 0, 100 )
+                plain['C' + str(i)] = { 'amount': value, 'value': value, 'rate': 1.0, 'base_currency': 'USD' }
+            plain['TOTAL'] = { 'value': sum( holding['value'] for holding in plain.values() ), 'base_currency': 'USD' }
+            money_maker = MoneyMaker( self.config_file, 'USD', currencies )
+            self.assertEqual( money_maker.shake( Portfolio.from_dict( plain )), money_maker.shake( copy.deepcopy( plain )))
+
+
+if __name__ == '__main__':
+    unittest.main()
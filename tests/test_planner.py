@@ -0,0 +1,120 @@
+"""
+Tests for the min transfer planner: its zero-sum groups must be as many as
+an exhaustive search finds, and its plans must move exactly what the greedy
+pairing moves, in no more transfers.
+"""
+
+import random
+import unittest
+
+from matching import MatchingEngine
+from planner import MinTransferPlanner
+
+
+def most_zero_sum_groups( units ):
+    """
+    The largest number of disjoint groups of units adding up to zero, by
+    trying every way of picking them
+    """
+
+    known = {}
+    def best( mask ):
+        if mask not in known:
+            groups = 0
+            subset = mask
+            while subset:
+                if sum( units[i] for i in xrange( len( units )) if subset >> i & 1 ) == 0:
+                    groups = max( groups, 1 + best( mask ^ subset ))
+                subset = ( subset - 1 ) & mask
+            known[mask] = groups
+        return known[mask]
+    return best( ( 1 << len( units )) - 1 )
+
+
+def net_flows( transactions ):
+    """
+    How much value each currency gets (or, when negative, gives) out of the transactions
+    """
+
+    flows = {}
+    for transaction in transactions:
+        flows[transaction['origin']]      = round( flows.get( transaction['origin'], 0.0 ) - transaction['amount'], 6 )
+        flows[transaction['destination']] = round( flows.get( transaction['destination'], 0.0 ) + transaction['amount'], 6 )
+    return flows
+
+
+def balanced_deltas( n ):
+    """
+    Senders and receivers whose values add up to the same total, with some
+    of them matching one another exactly. The values are whole quarters, so
+    no rounding error makes a leftover fall under the min_transaction.
+    """
+
+    units = [ random.randint( 1, 50 ) for i in xrange( n ) ]
+    split = random.randint( 1, n - 1 )
+    senders, receivers = units[:split], units[split:]
+    if random.random() < 0.5:
+        receivers[0] = senders[0]
+    difference = sum( senders ) - sum( receivers )
+    if difference > 0:
+        receivers.append( difference )
+    elif difference < 0:
+        senders.append( -difference )
+    names = iter( 'C' + str(i) for i in xrange( 2 * n + 2 ))
+    return (
+        [ { 'currency': next( names ), 'value': value / 4.0 } for value in senders ],
+        [ { 'currency': next( names ), 'value': value / 4.0 } for value in receivers ],
+    )
+
+
+class MinTransferPlannerTest(unittest.TestCase):
+
+    def setUp( self ):
+        self.currencies = dict( ( 'C' + str(i), { 'min_transaction': 0.25 } ) for i in xrange( 40 ))
+        self.currencies['USD'] = { 'min_transaction': 0.25 }
+
+
+    def test_zero_sum_groups( self ):
+        random.seed( 0 )
+        planner = MinTransferPlanner( self.currencies, 'USD' )
+        for trial in xrange( 500 ):
+            units = [ random.choice([ -1, 1 ]) * random.randint( 1, 6 ) for i in xrange( random.randint( 1, 8 )) ]
+            groups = planner.__zero_sum_groups__( units )
+            self.assertEqual( sorted( index for group in groups for index in group ), range( len( units )))
+            zero_sum = [ group for group in groups if sum( units[index] for index in group ) == 0 ]
+            self.assertTrue( len( groups ) - len( zero_sum ) <= 1 )
+            self.assertEqual( len( zero_sum ), most_zero_sum_groups( units ), units )
+
+
+    def test_pairs_settled_directly( self ):
+        planner = MinTransferPlanner( self.currencies, 'USD' )
+        transactions = planner.plan(
+            [ { 'currency': 'C0', 'value': 5.0 }, { 'currency': 'C1', 'value': 3.0 } ],
+            [ { 'currency': 'C2', 'value': 4.0 }, { 'currency': 'C3', 'value': 3.0 }, { 'currency': 'C4', 'value': 1.0 } ] )
+        self.assertEqual( len( transactions ), 3 )
+        self.assertEqual( net_flows( transactions ), { 'C0': -5.0, 'C1': -3.0, 'C2': 4.0, 'C3': 3.0, 'C4': 1.0 } )
+
+
+    def test_no_worse_than_greedy( self ):
+        random.seed( 1 )
+        planner = MinTransferPlanner( self.currencies, 'USD' )
+        engine  = MatchingEngine( self.currencies, 'USD' )
+        for trial in xrange( 1000 ):
+            senders, receivers = balanced_deltas( random.randint( 2, 12 ))
+            greedy  = engine.match( [ dict( item ) for item in senders ], [ dict( item ) for item in receivers ] )
+            planned = planner.plan( [ dict( item ) for item in senders ], [ dict( item ) for item in receivers ] )
+            self.assertTrue( len( planned ) <= len( greedy ), trial )
+            self.assertEqual( net_flows( planned ), net_flows( greedy ), trial )
+            self.assertTrue( all( transaction['amount'] >= 0.25 for transaction in planned ))
+
+
+    def test_greedy_above_max_exact( self ):
+        random.seed( 2 )
+        planner = MinTransferPlanner( self.currencies, 'USD', max_exact=4 )
+        engine  = MatchingEngine( self.currencies, 'USD' )
+        senders, receivers = balanced_deltas( 8 )
+        self.assertEqual( planner.plan( senders, receivers ), engine.match( senders, receivers ))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,259 @@
+"""
+Price Watcher transport -- the policy every call to an outside service (the broker, the spreadsheet, the queue) goes through: a timeout per endpoint, retries with jittered exponential backoff and a circuit breaker that fails fast while the service is struggling, instead of letting every cycle stall on it.
+
+When the service's client talks HTTP through a requests Session (http://python-requests.org/), the transport also sizes its pool of keep-alive connections and applies the endpoints' timeouts to its sockets. Any other client is never interrupted: a call that runs past its timeout only counts as failed once it returns.
+"""
+
+import random
+import threading
+import time
+
+from metrics import metrics
+from settings import load_config
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a service that has been failing (see `Transport`)
+    """
+    pass
+
+
+def timeout_adapter( transport, pool_size ):
+    """
+    Build a requests transport adapter that keeps up to pool_size keep-alive
+    connections per host and applies the timeout of the endpoint being called
+    (see `Transport.call`) to any request made without one.
+
+    :rtype: A requests HTTPAdapter
+    """
+
+    # requests is only needed by the clients that use it
+    from requests.adapters import HTTPAdapter
+
+    class TimeoutAdapter(HTTPAdapter):
+        def send( self, request, **kwargs ):
+            if kwargs.get( 'timeout' ) is None:
+                kwargs['timeout'] = getattr( transport.local, 'timeout', None )
+            return HTTPAdapter.send( self, request, **kwargs )
+
+    # Retrying is the transport's job, not the adapter's
+    return TimeoutAdapter( pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0 )
+
+
+class Transport(object):
+    """
+    Represents the way we call a service.
+
+    Every call has a timeout (seconds) and a number of retries, which can be
+    set for all of the service's endpoints and for each one. A failed call is
+    retried after an exponential backoff with some jitter, so that several
+    callers don't all come back at the same time.
+
+    After breaker_failures failures in a row (calls that take longer than
+    their timeout count as failures too, even if they succeed) the circuit
+    opens: for breaker_reset seconds every call fails right away with a
+    `CircuitOpenError`. Then one call is let through to try the service; if
+    it works the circuit closes again, otherwise it stays open for another
+    breaker_reset seconds.
+
+    The timeout only cuts a call short when the client uses a requests
+    Session (see `pool`); for other clients it is advisory, the call runs to
+    the end and is then counted as failed if it took too long.
+    """
+
+    def __init__( self, name, config_file, section, endpoints=None, DEBUG=False, limiter=None ):
+        """
+        Create the Transport
+
+        :param String name The service's name, for the messages and metrics, e.g. 'broker'
+        :param String config_file The path to a config file that ConfigParser can read
+        :param String section The config section with the transport's options: timeout, retries, backoff_base, backoff_max, breaker_failures, breaker_reset and pool_size, plus timeout_<endpoint> and retries_<endpoint> for any endpoint
+        :param Dictionary endpoints The endpoints' defaults, where they differ from the service's, e.g. { 'execute_txn': { 'retries': 0 } }
+        :param Boolean DEBUG Debug level
+        :param RateLimiter limiter Every call waits for its turn with it, if given (see `RateLimiter`)
+        """
+        self.version = 0
+
+        self.config  = load_config( config_file )
+        self.section = section
+
+        self.name             = name
+        self.DEBUG            = DEBUG
+        self.limiter          = limiter
+        self.timeout          = self.option( 'timeout', 10.0 )
+        self.retries          = int( self.option( 'retries', 2 ))
+        self.backoff_base     = self.option( 'backoff_base', 0.25 )
+        self.backoff_max      = self.option( 'backoff_max', 5.0 )
+        self.breaker_failures = int( self.option( 'breaker_failures', 5 ))
+        self.breaker_reset    = self.option( 'breaker_reset', 30.0 )
+        self.pool_size        = int( self.option( 'pool_size', 10 ))
+
+        self.defaults  = endpoints or {}
+        self.endpoints = {}
+
+        self.lock      = threading.Lock()
+        self.local     = threading.local()
+        self.failures  = 0
+        self.opened_at = None
+        self.trying    = False
+
+
+    def option( self, name, default ):
+        """
+        :rtype: A number from our config section, or the default if it isn't there
+        """
+
+        if self.config.has_option( self.section, name ):
+            return float( self.config.get( self.section, name ))
+        return default
+
+
+    def endpoint( self, endpoint ):
+        """
+        :param String endpoint The endpoint's name, e.g. 'get_ticker'
+
+        :rtype: A dictionary with the endpoint's timeout and retries
+        """
+
+        settings = self.endpoints.get( endpoint )
+        if settings is None:
+            defaults = self.defaults.get( endpoint, {} )
+            settings = self.endpoints[endpoint] = {
+                'timeout': self.option( 'timeout_' + endpoint, defaults.get( 'timeout', self.timeout )),
+                'retries': int( self.option( 'retries_' + endpoint, defaults.get( 'retries', self.retries ))),
+            }
+        return settings
+
+
+    def pool( self, session ):
+        """
+        Have a client's requests Session keep pool_size keep-alive connections
+        per host and use our endpoints' timeouts. Anything that isn't a
+        requests Session is left alone.
+
+        :param Object session The client's session
+
+        :rtype: Whether the session is now pooled
+        """
+
+        if session is None or not hasattr( session, 'mount' ):
+            return False
+        adapter = timeout_adapter( self, self.pool_size )
+        session.mount( 'https://', adapter )
+        session.mount( 'http://', adapter )
+        return True
+
+
+    def state( self ):
+        """
+        :rtype: The circuit's state: 'closed', 'open' or 'half-open' (while a call is trying the service)
+        """
+
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            return 'half-open' if self.trying else 'open'
+
+
+    def __admit__( self, endpoint ):
+        """
+        Let a call through, unless the circuit is open.
+
+        :rtype: Whether this call is the one trying the service after the circuit opened
+        """
+
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            if self.trying or time.time() - self.opened_at < self.breaker_reset:
+                metrics.increment( 'circuit_rejections', { 'component': self.name } )
+                raise CircuitOpenError( self.name + ' is failing, not calling ' + endpoint + ' for now' )
+            self.trying = True
+            return True
+
+
+    def __abandon__( self, trial ):
+        """
+        Give up on a call we were let through for without making it
+        """
+
+        if trial:
+            with self.lock:
+                self.trying = False
+
+
+    def __succeeded__( self ):
+        with self.lock:
+            if self.opened_at is not None and self.DEBUG:
+                print 'Transport: ' + self.name + ' is back, closing the circuit'
+            self.failures  = 0
+            self.opened_at = None
+            self.trying    = False
+
+
+    def __failed__( self, trial ):
+        with self.lock:
+            self.failures += 1
+            if trial or ( self.opened_at is None and self.failures >= self.breaker_failures ):
+                print 'Transport: ' + self.name + ' failed ' + str(self.failures) + ' times in a row, failing fast for ' + str(self.breaker_reset) + ' seconds'
+                metrics.increment( 'circuit_opened', { 'component': self.name } )
+                self.opened_at = time.time()
+            if trial:
+                self.trying = False
+
+
+    def backoff( self, attempt ):
+        """
+        Wait before trying again: twice as long on every attempt (up to
+        backoff_max seconds), half of it at random.
+
+        :param Integer attempt How many attempts have failed so far
+        """
+
+        delay = min( self.backoff_base * 2 ** ( attempt - 1 ), self.backoff_max )
+        time.sleep( delay / 2.0 + random.uniform( 0, delay / 2.0 ))
+
+
+    def call( self, endpoint, call, *args ):
+        """
+        Make a call to the service, with the endpoint's timeout and retries.
+
+        :param String endpoint The name of the call, e.g. 'get_ticker'
+        :param Function call The call
+        :param List args Its arguments
+
+        :rtype: Whatever the call returns. The last error is raised if every attempt failed, or a `CircuitOpenError` if the circuit is open.
+        """
+
+        settings = self.endpoint( endpoint )
+        attempt = 0
+        while True:
+            trial = self.__admit__( endpoint )
+            if self.limiter:
+                try:
+                    self.limiter.acquire( endpoint )
+                except Exception:
+                    self.__abandon__( trial )
+                    raise
+            self.local.timeout = settings['timeout'] or None
+            started = time.time()
+            try:
+                result = metrics.api_call( endpoint, call, *args )
+            except Exception as e:
+                self.local.timeout = None
+                self.__failed__( trial )
+                attempt += 1
+                if attempt > settings['retries']:
+                    raise
+                metrics.increment( 'retries', { 'component': self.name } )
+                if self.DEBUG:
+                    print 'Transport: ' + endpoint + ' failed (' + str(e) + '), trying again'
+                self.backoff( attempt )
+                continue
+
+            self.local.timeout = None
+            if settings['timeout'] and time.time() - started > settings['timeout']:
+                self.__failed__( trial )
+            else:
+                self.__succeeded__()
+            return result
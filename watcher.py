@@ -0,0 +1,564 @@
+"""
+Price Watcher watcher class -- it ties the broker, the money maker, the record keeper and the notifier together and runs the rebalancing cycles, either once or as a long-running daemon.
+"""
+
+import functools
+import importlib
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from drift import DriftTracker
+from metrics import metrics
+from settings import load_config
+
+# The pool every price watcher in the process (e.g. a fleet's) sets its
+# components up on, created the first time one is needed
+setup_pool = None
+setup_pool_lock = threading.Lock()
+SETUP_THREADS = 8
+
+def get_setup_pool():
+    """
+    :rtype: The ThreadPool the components are set up on
+    """
+
+    global setup_pool
+    with setup_pool_lock:
+        if setup_pool is None:
+            setup_pool = ThreadPool( SETUP_THREADS )
+        return setup_pool
+
+class PriceWatcher(object):
+    """
+    Represents a running price watcher
+
+    All the components (and their connections to the outside world) are
+    created once and kept alive between cycles, so a daemon only pays for the
+    authentication and session setup when it starts up. The record keeper
+    and the notifier are only created once there is something to record or
+    send, as most cycles find nothing to do.
+
+    The components are set up concurrently, so starting up takes as long as
+    the slowest of them rather than all of them together.
+    """
+
+    def __init__( self, config_file, DEBUG=False, dry_run=False, api=None, spreadsheet=None, queue=None, profiler=None, export_metrics=True ):
+        """
+        Create the PriceWatcher and all of its components
+
+        :param String config_file The path to a config file that ConfigParser can read and that has a "Setup" section.
+        :param Boolean DEBUG Debug level
+        :param Boolean dry_run Analise but don't effect any change
+        :param Object api Stand-in for the broker's API (see `Broker`)
+        :param Object spreadsheet Stand-in for the record keeper's spreadsheet (see `RecordKeeper`)
+        :param Object queue Stand-in for the notifier's queue (see `Notifier`)
+        :param Profiler profiler Profiles every cycle, if given (see `Profiler`)
+        :param Boolean export_metrics Export the metrics after every cycle (a fleet exports them once for all of its accounts instead)
+        """
+        self.version = 0
+
+        config = load_config( config_file )
+
+        self.DEBUG         = DEBUG
+        self.dry_run       = dry_run
+        self.running       = False
+        self.profiler      = profiler
+        self.export_metrics = export_metrics
+
+        self.poll_interval = 60.0
+        if config.has_option( 'PriceWatcher', 'poll_interval' ):
+            self.poll_interval = float( config.get( 'PriceWatcher', 'poll_interval' ))
+
+        # Between trades only the rates change, so we can keep the amounts we
+        # hold and track their drift with the (cheaper) tickers, only asking
+        # for the whole portfolio every resync_interval seconds or when it
+        # looks like we need to rebalance
+        self.resync_interval = 0.0
+        if config.has_option( 'PriceWatcher', 'resync_interval' ):
+            self.resync_interval = float( config.get( 'PriceWatcher', 'resync_interval' ))
+        self.drift     = None
+        self.synced_at = 0.0
+
+        # Set up our currencies
+        # TODO: kill this eval with extreme prejudice!
+        self.base_currency = config.get('Setup','base_currency')
+        self.currencies    = eval(config.get('Setup','currencies'))
+
+        # Where the cycles' timings go, if anywhere
+        if config.has_section( 'Metrics' ):
+            metrics.configure(
+                config.get( 'Metrics', 'prometheus_file' ) if config.has_option( 'Metrics', 'prometheus_file' ) else None,
+                config.get( 'Metrics', 'json_file' ) if config.has_option( 'Metrics', 'json_file' ) else None,
+                config.getboolean( 'Metrics', 'debug_dumps' ) if config.has_option( 'Metrics', 'debug_dumps' ) else True
+            )
+
+        if self.DEBUG:
+            metrics.dump( "PriceWatcher: Currencies I'm looking for:", self.currencies )
+
+        # How long it took to import and set up each component, and why
+        # the ones that failed did
+        self.timings  = {}
+        self.failures = {}
+
+        # Every component is set up in the background, on a pool shared by
+        # every price watcher, so they all wait on the network at the same
+        # time; whoever uses one first waits for it (see `__resolve__`)
+        self.config_file = config_file
+        self.spreadsheet = spreadsheet
+        self.queue       = queue
+        self.has_recorder = config.has_section('RecordKeeper')
+        self.has_notifier = config.has_section('Notifier')
+        self.components   = {}
+        self.setting_up   = {}
+        self.builders     = {}
+        self.setup_lock   = threading.RLock()
+
+        # The broker keeps the cross rates up to date with the tickers it
+        # gets, and the money maker routes the transactions with them
+        self.cross_rates = None
+        if config.has_section( 'CrossRates' ):
+            from crossrates import CrossRates
+            self.cross_rates = CrossRates.from_config( config_file, DEBUG )
+
+        # Set up the broker object for dealing with the money
+        self.__start__( 'broker', functools.partial(
+            self.__timed__,
+            'broker', 'broker.Broker', [ 'bitreserve' ] if api is None else [],
+            config_file,
+            self.currencies,
+            self.base_currency,
+            self.DEBUG,
+            api,
+            self.cross_rates
+        ))
+
+        # Set up the money maker that finds the new currency equilibrium
+        self.__start__( 'money_maker', functools.partial(
+            self.__timed__,
+            'money_maker', 'moneymaker.MoneyMaker', [],
+            config_file,
+            self.base_currency,
+            self.currencies,
+            self.DEBUG,
+            self.cross_rates
+        ))
+
+        # The record keeper and the notifier wait until there is something to
+        # record or send, unless the journal still has records waiting to be
+        # written or we'll be telling about every cycle (in DEBUG)
+        if self.has_recorder and config.has_option( 'RecordKeeper', 'journal_file' ):
+            journal_file = config.get( 'RecordKeeper', 'journal_file' )
+            if os.path.exists( journal_file ) and os.path.getsize( journal_file ):
+                self.__start_recorder__()
+        if self.DEBUG:
+            self.__start_notifier__()
+
+
+    def __timed__( self, component, class_name, sdks, *args ):
+        """
+        Import a component's class (and the SDKs it uses) and then create it,
+        keeping how long each of those took in `timings`.
+
+        :param String component The component's name
+        :param String class_name The component's class, as module.Class
+        :param List sdks The modules of the SDKs it uses
+        :param List args The arguments to create it with
+
+        :rtype: The component
+        """
+
+        started = time.time()
+        module_name, name = class_name.rsplit( '.', 1 )
+        module = importlib.import_module( module_name )
+        for sdk in sdks:
+            importlib.import_module( sdk )
+        imported = time.time()
+        built = getattr( module, name )( *args )
+        self.timings[component] = { 'import': imported - started, 'init': time.time() - imported }
+        return built
+
+
+    def __start__( self, component, builder ):
+        """
+        Start setting a component up in the background, unless it is already
+        set up or on its way.
+
+        :param String component The component's name
+        :param Function builder Creates the component
+        """
+
+        with self.setup_lock:
+            self.builders[component] = builder
+            if component not in self.components and component not in self.setting_up:
+                setup = { 'done': threading.Event(), 'built': None, 'error': None }
+                self.setting_up[component] = setup
+                get_setup_pool().apply_async( self.__build__, ( builder, setup ))
+
+
+    def __build__( self, builder, setup ):
+        """
+        Set a component up, on the setup pool, and let whoever is waiting for
+        it know. (The pool's own results only wake up one of the threads
+        waiting for them.)
+        """
+
+        try:
+            setup['built'] = builder()
+        except Exception as e:
+            setup['error'] = e
+        finally:
+            setup['done'].set()
+
+
+    def __resolve__( self, component ):
+        """
+        Get a component, waiting for it to be set up if need be (callers
+        that ask at the same time all wait for the same setup). One that
+        failed to set up is started again, so the next caller gets another go.
+
+        :param String component The component's name
+
+        :rtype: The component
+        """
+
+        with self.setup_lock:
+            if component in self.components:
+                return self.components[component]
+            if component not in self.setting_up:
+                self.__start__( component, self.builders[component] )
+            pending = self.setting_up[component]
+
+        # Whoever gets there first takes the component off setting_up
+        pending['done'].wait()
+        error = pending['error']
+        with self.setup_lock:
+            if self.setting_up.get( component ) is pending:
+                del self.setting_up[component]
+                if error is not None:
+                    self.failures[component] = str(error)
+                    print 'PriceWatcher: Could not set up the ' + component + ' (' + str(error) + ')'
+                else:
+                    built = pending['built']
+                    if self.profiler and component in ( 'broker', 'recorder', 'notifier' ):
+                        built = self.profiler.wrap( component, built )
+                    self.components[component] = built
+                    self.failures.pop( component, None )
+            if error is not None:
+                raise error
+            return self.components[component]
+
+
+    @property
+    def broker( self ):
+        return self.__resolve__( 'broker' )
+
+
+    @property
+    def money_maker( self ):
+        return self.__resolve__( 'money_maker' )
+
+
+    def __build_recorder__( self ):
+        """
+        Create the record keeper (see `get_recorder`)
+        """
+
+        config = load_config( self.config_file )
+        sdks = [ 'gspread', 'oauth2client.client' ] if self.spreadsheet is None else []
+        build = functools.partial( self.__timed__, 'recorder', 'recordkeeper.RecordKeeper', sdks, self.config_file, self.spreadsheet )
+        if not config.has_option( 'RecordKeeper', 'journal_file' ):
+            return build()
+
+        # Keep the spreadsheet off the trading path, setting up the record
+        # keeper included, if we were asked to
+        from journal import JournaledRecordKeeper
+        flush_interval = 5.0
+        if config.has_option( 'RecordKeeper', 'flush_interval' ):
+            flush_interval = float( config.get( 'RecordKeeper', 'flush_interval' ))
+        max_backoff = 300.0
+        if config.has_option( 'RecordKeeper', 'max_backoff' ):
+            max_backoff = float( config.get( 'RecordKeeper', 'max_backoff' ))
+        return JournaledRecordKeeper(
+            build,
+            config.get( 'RecordKeeper', 'journal_file' ),
+            flush_interval,
+            max_backoff,
+            self.DEBUG
+        )
+
+
+    def __start_recorder__( self ):
+        if self.has_recorder:
+            self.__start__( 'recorder', self.__build_recorder__ )
+
+
+    def __start_notifier__( self ):
+        if self.has_notifier:
+            sdks = [ 'boto3' ] if self.queue is None else []
+            self.__start__( 'notifier', functools.partial( self.__timed__, 'notifier', 'notifications.Notifier', sdks, self.config_file, self.queue ))
+
+
+    def get_recorder( self ):
+        """
+        Get the record keeper, setting it up the first time.
+
+        :rtype: The record keeper, or None if there is no "RecordKeeper" section in the config
+        """
+
+        if not self.has_recorder:
+            return None
+        self.__start_recorder__()
+        return self.__resolve__( 'recorder' )
+
+
+    def get_notifier( self ):
+        """
+        Get the notifier, setting it up the first time.
+
+        :rtype: The notifier, or None if there is no "Notifier" section in the config
+        """
+
+        if not self.has_notifier:
+            return None
+        self.__start_notifier__()
+        return self.__resolve__( 'notifier' )
+
+
+    def sync_portfolio( self ):
+        """
+        Get our portfolio from the broker and, if we revalue it between syncs,
+        start tracking its drift from here.
+
+        :rtype: The portfolio (see `Broker.get_portfolio`)
+        """
+
+        portfolio = self.broker.get_portfolio()
+        self.synced_at = time.time()
+        if self.resync_interval:
+            self.drift = DriftTracker( portfolio, self.money_maker.rebalance_threshold )
+        return portfolio
+
+
+    def reads_tickers( self ):
+        """
+        :rtype: Whether our cycles use the tickers: to track the drift between syncs, or to keep the cross rates
+        """
+
+        return bool( self.resync_interval ) or self.cross_rates is not None
+
+
+    def __drifted__( self ):
+        """
+        Between syncs with the broker, feed the current tickers to the drift
+        tracker and see if the portfolio has drifted far enough to need a
+        rebalance.
+
+        :rtype: True if the portfolio may need rebalancing (or it's time to sync it anyway)
+        """
+
+        if not self.resync_interval or self.drift is None or time.time() - self.synced_at >= self.resync_interval:
+            return True
+
+        self.drift.update_tickers( self.broker.get_tickers() )
+        if self.DEBUG:
+            print 'PriceWatcher: Revalued portfolio spread: ' + str(self.drift.spread())
+        return self.drift.crossed()
+
+
+    def run_cycle( self ):
+        """
+        Run one full cycle: get the portfolio, find the transactions needed to
+        rebalance it, run them and record and notify what was done.
+
+        The cycle is timed, and its metrics exported, as it finishes (see
+        `Metrics`; exporting them never fails the cycle), and profiled if we
+        have a profiler.
+
+        :rtype: The list of transactions that the money maker asked for (see `MoneyMaker.shake`)
+        """
+
+        try:
+            if self.profiler:
+                with self.profiler.cycle():
+                    with metrics.span( 'cycle' ):
+                        return self.__cycle__()
+            with metrics.span( 'cycle' ):
+                return self.__cycle__()
+        finally:
+            if self.export_metrics:
+                metrics.export()
+
+
+    def __cycle__( self ):
+        """
+        Run one full cycle (see `run_cycle`)
+        """
+
+        # Between syncs only the rates change, which the tickers tell us about
+        if not self.__drifted__():
+            if self.DEBUG and self.has_notifier:
+                self.get_notifier().notify(
+                  'No change needed in portfolio -- ' + str( self.drift.total_value() ),
+                  key='no change needed'
+                )
+            return []
+
+        current_portfolio = self.sync_portfolio()
+        if self.DEBUG:
+            metrics.dump( "PriceWatcher: Current portfolio:", current_portfolio )
+
+        transactions = self.money_maker.shake( current_portfolio )
+
+        # No transactions were deemed necessary
+        if not transactions:
+            if self.DEBUG and self.has_notifier:
+                self.get_notifier().notify(
+                  'No change needed in portfolio -- ' \
+                  + str(
+                    self.money_maker.__calculate_portfolio_value__(current_portfolio)
+                  ),
+                  key='no change needed'
+                )
+            return transactions
+
+        # Let's run those transactions
+        if self.DEBUG:
+            metrics.dump( "PriceWatcher: Transactions to run:", transactions )
+
+        if self.dry_run:
+            return transactions
+
+        # There will be something to record and send, so get those ready
+        # while the transactions run
+        self.__start_recorder__()
+        self.__start_notifier__()
+
+        results = self.broker.run_transactions( transactions, current_portfolio )
+        executed = [ result['transaction'] for result in results if result['status'] == 'executed' ]
+
+        # Whatever didn't run is reported (no results at all means none ran)
+        missed = {}
+        for result in results:
+            if result['status'] != 'executed':
+                missed[result['status']] = missed.get( result['status'], 0 ) + 1
+        if not results:
+            missed['not run'] = len( transactions )
+        for status, count in missed.items():
+            metrics.increment( 'transactions_missed', { 'status': status }, count )
+        summary = ', '.join( str(count) + ' ' + status for status, count in sorted( missed.items() ))
+        if missed:
+            print 'PriceWatcher: ' + str(len( executed )) + ' of ' + str(len( transactions )) + ' transactions executed (' + summary + ')'
+
+        if not executed:
+            if self.has_notifier:
+                self.get_notifier().notify( 'Could not rebalance portfolio: none of the ' + str(len( transactions )) + ' transactions were executed (' + summary + ')' )
+            return transactions
+
+        # What we hold has changed, so we'll need the real portfolio next time
+        self.drift = None
+
+        new_portfolio = None
+        if self.has_recorder:
+            recorder = self.get_recorder()
+            recorder.refresh()
+            # Record the original portfolio
+            recorder.write_portfolio(
+                current_portfolio,
+                self.money_maker.__calculate_portfolio_value__( current_portfolio )
+            )
+            # Record the new portfolio
+            new_portfolio = self.broker.get_portfolio()
+            recorder.write_portfolio(
+                new_portfolio,
+                self.money_maker.__calculate_portfolio_value__( new_portfolio )
+            )
+            # Record the transactions that were carried out
+            recorder.write_transactions( executed )
+
+        if self.has_notifier:
+            if new_portfolio is None:
+                new_portfolio = self.broker.get_portfolio()
+            if missed:
+                message = 'Partly rebalanced portfolio, ' + str(len( executed )) + ' of ' + str(len( transactions )) \
+                    + ' transactions executed (' + summary + '). New value: '
+            else:
+                message = 'Done rebalancing portfolio. New value: '
+            message += str(self.money_maker.__calculate_portfolio_value__( new_portfolio )) \
+                + ' ' \
+                + self.base_currency
+            if self.money_maker.round_trips_saved:
+                message += ' (' + str(self.money_maker.round_trips_saved) + ' round trips saved by the planner)'
+            self.get_notifier().notify( message )
+
+        return transactions
+
+
+    def refresh_sessions( self ):
+        """
+        Refresh the authentication of the components that hold long-lived
+        sessions (needed after a failure or when a token has expired).
+        """
+
+        self.broker.reauthenticate()
+        if 'recorder' in self.components:
+            self.components['recorder'].refresh()
+
+
+    def run_forever( self, interval=None ):
+        """
+        Keep running cycles, one every `interval` seconds, until `stop` is
+        called (usually from a signal handler).
+
+        A failing cycle does not stop the daemon: the sessions are refreshed
+        and we try again on the next tick.
+
+        :param Number interval Seconds between the start of two cycles (defaults to the configured poll_interval)
+        """
+
+        if interval is None:
+            interval = self.poll_interval
+
+        self.running = True
+        while self.running:
+            started = time.time()
+            try:
+                self.run_cycle()
+            except Exception as e:
+                print 'PriceWatcher: Error running cycle (' + str(e) + '), refreshing sessions'
+                try:
+                    self.refresh_sessions()
+                except Exception as e:
+                    print 'PriceWatcher: Could not refresh sessions (' + str(e) + ')'
+
+            wait = interval - ( time.time() - started )
+            if self.running and wait > 0:
+                # A signal interrupts the sleep, so a stop request is honoured right away
+                time.sleep( wait )
+
+
+    def stop( self ):
+        """
+        Ask a running daemon to stop after the current cycle
+        """
+
+        self.running = False
+
+
+    def close( self ):
+        """
+        Release whatever the components are holding on to (once those still
+        being set up are ready)
+        """
+
+        with self.setup_lock:
+            pending = self.setting_up.keys()
+        for component in pending:
+            try:
+                self.__resolve__( component )
+            except Exception:
+                pass
+        for component in [ 'broker', 'recorder', 'notifier' ]:
+            if component in self.components:
+                self.components[component].close()